@@ -0,0 +1,98 @@
+"""Benchmark the buffered and streaming modes of the reviews service's get_reviews
+
+Runs get-reviews.py against an in-memory mock review store that generates a
+large dealer's reviews lazily, then reports peak traced memory and
+time to first byte for:
+
+    buffered   every document collected into a list and serialized with jsonify
+    streaming  GET /api/get_reviews?stream=true
+
+Usage:
+    python bench_get_reviews.py [number_of_reviews]
+"""
+import importlib.util
+import os
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+from flask import jsonify
+
+
+class MockReviewStore:
+    """Mimics the read side of the stores in reviews_store"""
+
+    def __init__(self, count):
+        self.count = count
+
+    def iter_reviews(self, dealership_id, page_size=100):
+        for number in range(self.count):
+            yield {
+                "_id": "review-{}".format(number),
+                "id": number,
+                "name": "Reviewer {}".format(number),
+                "dealership": 15,
+                "review": "Great service and a fair price, would buy again " * 4,
+                "purchase": True,
+                "purchase_date": "07/11/2020",
+                "car_make": "Audi",
+                "car_model": "A6",
+                "car_year": 2010,
+            }
+
+    def query_page(self, dealership_id, limit, bookmark=None):
+        return list(self.iter_reviews(dealership_id))[:limit], None
+
+
+def load_service(store):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "get-reviews.py")
+    spec = importlib.util.spec_from_file_location("get_reviews", path)
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch("reviews_store.open_store", return_value=store):
+        spec.loader.exec_module(module)
+    return module
+
+
+def measure(produce_chunks):
+    tracemalloc.start()
+    start = time.perf_counter()
+    first_byte = None
+    size = 0
+    for chunk in produce_chunks():
+        if first_byte is None:
+            first_byte = time.perf_counter() - start
+        size += len(chunk)
+    total = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return first_byte, total, peak, size
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    store = MockReviewStore(count)
+    service = load_service(store)
+    app = service.app
+
+    def buffered():
+        with app.test_request_context():
+            yield jsonify(list(store.iter_reviews(15))).get_data()
+
+    def streaming():
+        response = app.test_client().get("/api/get_reviews?id=15&stream=true", buffered=False)
+        try:
+            for chunk in response.response:
+                yield chunk
+        finally:
+            response.close()
+
+    print("{} reviews".format(count))
+    for label, produce_chunks in (("buffered", buffered), ("streaming", streaming)):
+        first_byte, total, peak, size = measure(produce_chunks)
+        print("{:<10} first byte {:8.1f} ms  total {:8.1f} ms  peak memory {:8.1f} MiB  body {:.1f} MiB".format(
+            label, first_byte * 1000, total * 1000, peak / 2 ** 20, size / 2 ** 20))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark review search on the SQLite store as the corpus grows
+
+Fills SQLite review stores of increasing size with generated reviews, then
+times the same searches through the full-text index (store.search) and
+through a LIKE scan over every stored document, which is what a search
+without an index would have to do.
+
+Usage:
+    python bench_search_reviews.py [corpus_size ...]
+"""
+import itertools
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from reviews_store import SQLiteReviewStore, parse_search
+
+# Word frequencies in text follow Zipf's law: a few words are everywhere, most are rare
+VOCABULARY = ['word{}'.format(rank) for rank in range(20000)]
+WEIGHTS = [1 / (rank + 1) for rank in range(len(VOCABULARY))]
+MAKES = {'Audi': ('A4', 'A6', 'Q5'), 'BMW': ('X3', '330i', 'M5'), 'Toyota': ('Camry', 'Corolla', 'RAV4'),
+         'Honda': ('Civic', 'Accord', 'Pilot'), 'Saturn': ('Ion', 'Vue', 'Sky')}
+# From a rare word to a make present in a fifth of the corpus
+QUERIES = ('word15000', 'word900*', 'word3000 word40', 'audi word2000', 'camry')
+
+
+def generate(count, rng):
+    cum_weights = list(itertools.accumulate(WEIGHTS))
+    for number in range(count):
+        make = rng.choice(sorted(MAKES))
+        yield {
+            '_id': 'review-{}'.format(number),
+            'name': 'Reviewer {}'.format(number),
+            'dealership': rng.randint(1, 50),
+            'review': ' '.join(rng.choices(VOCABULARY, cum_weights, k=rng.randint(6, 20))),
+            'purchase': True,
+            'car_make': make,
+            'car_model': rng.choice(MAKES[make]),
+            'car_year': rng.randint(2000, 2021),
+        }
+
+
+def like_scan(store, query):
+    # Without an index, every document is read to find, then rank, the matches
+    words = [word for word, _ in parse_search(query)]
+    sql = 'SELECT doc FROM reviews WHERE ' + ' AND '.join(['lower(doc) LIKE ?'] * len(words))
+    return store._connection().execute(sql, ['%{}%'.format(word) for word in words]).fetchall()
+
+
+def time_ms(call, repeat=20):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        timings.append((time.perf_counter() - start) * 1000)
+    return statistics.median(timings)
+
+
+def main():
+    sizes = [int(size) for size in sys.argv[1:]] or [10000, 50000, 200000]
+    rng = random.Random(1)
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            store = SQLiteReviewStore(os.path.join(directory, 'reviews-{}.sqlite3'.format(size)))
+            reviews = list(generate(size, rng))
+            start = time.perf_counter()
+            for offset in range(0, size, 1000):
+                store.create_many(reviews[offset:offset + 1000])
+            load = time.perf_counter() - start
+            index_size = store._connection().execute(
+                "SELECT sum(length(block)) FROM reviews_search_data").fetchone()[0]
+            print('{:,} reviews (written in {:.1f} s, search index {:.1f} MiB)'.format(
+                size, load, index_size / 2 ** 20))
+            for query in QUERIES:
+                terms = parse_search(query)
+                indexed = time_ms(lambda: store.search(terms))
+                scan = time_ms(lambda: like_scan(store, query), repeat=3)
+                print('  {:<26} index {:8.2f} ms   LIKE scan {:9.2f} ms'.format(query, indexed, scan))
+
+
+if __name__ == '__main__':
+    main()
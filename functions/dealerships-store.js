@@ -0,0 +1,251 @@
+const fs = require('fs');
+const path = require('path');
+
+// Storage backends for the dealership service.
+// Every store exposes find({ state, id, limit, bookmark }) resolving to { docs, bookmark },
+// where bookmark continues the listing and is undefined on the last page,
+// findByIds(ids) resolving to the dealerships with those ids, in no particular order, and
+// near({ lat, long, limit, radius }) resolving to the `limit` dealerships nearest to a point,
+// optionally within `radius` km, closest first, each with its `distance` in km.
+
+const EARTH_RADIUS_KM = 6371.0088;
+const HALF_CIRCUMFERENCE_KM = Math.PI * EARTH_RADIUS_KM;
+const toRadians = (degrees) => degrees * Math.PI / 180;
+const toDegrees = (radians) => radians * 180 / Math.PI;
+
+function haversineKm(lat1, lon1, lat2, lon2) {
+    const a = Math.sin(toRadians(lat2 - lat1) / 2) ** 2
+        + Math.cos(toRadians(lat1)) * Math.cos(toRadians(lat2)) * Math.sin(toRadians(lon2 - lon1) / 2) ** 2;
+    return 2 * EARTH_RADIUS_KM * Math.asin(Math.min(1, Math.sqrt(a)));
+}
+
+// Spatial index bucketing dealerships into cells of `cellDegrees` by `cellDegrees`.
+// A query only visits the cells overlapping the bounding box of its search circle,
+// so its cost follows the number of dealerships near the point rather than the total.
+class GeoGrid {
+    constructor(dealerships, cellDegrees = 1) {
+        this.cellDegrees = cellDegrees;
+        this.rows = Math.ceil(180 / cellDegrees);
+        this.columns = Math.ceil(360 / cellDegrees);
+        this.cells = new Map();
+        for (const dealer of dealerships) {
+            const lat = parseFloat(dealer.lat);
+            const long = parseFloat(dealer.long);
+            if (!(Math.abs(lat) <= 90 && Math.abs(long) <= 180)) {
+                continue;
+            }
+            const key = this.row(lat) * this.columns + this.column(long);
+            if (!this.cells.has(key)) {
+                this.cells.set(key, []);
+            }
+            this.cells.get(key).push({ lat, long, dealer });
+        }
+    }
+
+    row(lat) {
+        return Math.min(Math.floor((lat + 90) / this.cellDegrees), this.rows - 1);
+    }
+
+    column(long) {
+        return ((Math.floor((long + 180) / this.cellDegrees) % this.columns) + this.columns) % this.columns;
+    }
+
+    within(lat, long, radius) {
+        // Bounding box of the circle on the sphere, widened to every longitude around a pole
+        const angle = radius / EARTH_RADIUS_KM;
+        const south = lat - toDegrees(angle);
+        const north = lat + toDegrees(angle);
+        let columns;
+        if (south <= -90 || north >= 90 || Math.sin(angle) >= Math.cos(toRadians(lat))) {
+            columns = [...Array(this.columns).keys()];
+        } else {
+            const spread = toDegrees(Math.asin(Math.sin(angle) / Math.cos(toRadians(lat))));
+            const first = Math.floor((long - spread + 180) / this.cellDegrees);
+            const last = Math.min(Math.floor((long + spread + 180) / this.cellDegrees), first + this.columns - 1);
+            columns = [];
+            for (let column = first; column <= last; column++) {
+                columns.push(((column % this.columns) + this.columns) % this.columns);
+            }
+        }
+        const found = [];
+        for (let row = this.row(Math.max(south, -90)); row <= this.row(Math.min(north, 90)); row++) {
+            for (const column of columns) {
+                for (const entry of this.cells.get(row * this.columns + column) || []) {
+                    const distance = haversineKm(lat, long, entry.lat, entry.long);
+                    if (distance <= radius) {
+                        found.push({ ...entry.dealer, distance });
+                    }
+                }
+            }
+        }
+        return found.sort((a, b) => a.distance - b.distance);
+    }
+
+    // Grow the search circle fourfold from 50 km until it holds `limit` dealerships,
+    // reaches `radius` or covers the globe
+    near(lat, long, limit, radius) {
+        const maxRadius = Math.min(radius || HALF_CIRCUMFERENCE_KM, HALF_CIRCUMFERENCE_KM);
+        let searchRadius = Math.min(50, maxRadius);
+        for (;;) {
+            const found = this.within(lat, long, searchRadius);
+            if (found.length >= limit || searchRadius >= maxRadius) {
+                return found.slice(0, limit);
+            }
+            searchRadius = Math.min(searchRadius * 4, maxRadius);
+        }
+    }
+}
+
+// How long the Cloudant store reuses the spatial index it built from the dealerships database
+const GEO_INDEX_TTL_MS = parseInt(process.env.GEO_INDEX_TTL_MS) || 5 * 60 * 1000;
+
+// Thrown by find() for a bookmark that the store did not issue
+class InvalidBookmark extends Error {
+    constructor(bookmark) {
+        super(`Invalid bookmark: ${bookmark}`);
+        this.name = 'InvalidBookmark';
+    }
+}
+
+// Cloudant-backed store (the production default)
+class CloudantDealershipStore {
+    constructor(iamApiKey, couchUrl) {
+        const Cloudant = require('@cloudant/cloudant');
+        const cloudant = Cloudant({
+            plugins: { iamauth: { iamApiKey: iamApiKey } },
+            url: couchUrl,
+        });
+        this.db = cloudant.use('dealerships');
+        console.info('Connect success! Connected to DB');
+    }
+
+    find({ state, id, limit, bookmark }) {
+        // Create a selector object based on query parameters
+        const selector = {};
+        if (state) {
+            selector.state = state;
+        }
+        if (id !== undefined) {
+            selector.id = id;
+        }
+        const queryOptions = { selector, limit };
+        if (bookmark) {
+            queryOptions.bookmark = bookmark;
+        }
+        return new Promise((resolve, reject) => {
+            this.db.find(queryOptions, (err, body) => {
+                if (err) {
+                    // Cloudant answers 400 to a malformed bookmark
+                    reject(bookmark && err.statusCode === 400 ? new InvalidBookmark(bookmark) : err);
+                    return;
+                }
+                // A short page is the last one
+                const next = body.docs.length === limit ? body.bookmark : undefined;
+                resolve({ docs: body.docs, bookmark: next });
+            });
+        });
+    }
+
+    findByIds(ids) {
+        // A single $in query instead of one request per id
+        return new Promise((resolve, reject) => {
+            this.db.find({ selector: { id: { $in: ids } }, limit: ids.length }, (err, body) => {
+                if (err) {
+                    reject(err);
+                    return;
+                }
+                resolve(body.docs);
+            });
+        });
+    }
+
+    // Cloudant has no spatial query on this database; index every dealership in memory,
+    // rebuilding the index at most once per GEO_INDEX_TTL_MS
+    geoIndex() {
+        if (!this.geo || Date.now() - this.geo.builtAt > GEO_INDEX_TTL_MS) {
+            this.geo = {
+                builtAt: Date.now(),
+                index: this.db.list({ include_docs: true }).then((body) => new GeoGrid(
+                    body.rows.map((row) => row.doc).filter((doc) => !doc._id.startsWith('_design/')))),
+            };
+            this.geo.index.catch(() => { this.geo = undefined; });
+        }
+        return this.geo.index;
+    }
+
+    async near({ lat, long, limit, radius }) {
+        return (await this.geoIndex()).near(lat, long, limit, radius);
+    }
+}
+
+// Embedded store holding every dealership in memory with indexes by id and by state, and a
+// spatial grid. Dealerships are few and change rarely, so lookups involve no I/O at all.
+class MemoryDealershipStore {
+    constructor(dealerships) {
+        this.dealerships = [...dealerships].sort((a, b) => a.id - b.id);
+        this.byId = new Map();
+        this.byState = new Map();
+        for (const dealer of this.dealerships) {
+            this.byId.set(dealer.id, dealer);
+            // Index both the full state name and its abbreviation ("Texas" and "TX")
+            for (const key of new Set([dealer.state, dealer.st])) {
+                if (key) {
+                    if (!this.byState.has(key)) {
+                        this.byState.set(key, []);
+                    }
+                    this.byState.get(key).push(dealer);
+                }
+            }
+        }
+        this.geo = new GeoGrid(this.dealerships);
+    }
+
+    static fromSeedFile(seedPath) {
+        const data = JSON.parse(fs.readFileSync(seedPath, 'utf8'));
+        console.info(`Loaded ${data.dealerships.length} dealerships from ${seedPath}`);
+        return new MemoryDealershipStore(data.dealerships);
+    }
+
+    async find({ state, id, limit, bookmark }) {
+        let docs = this.dealerships;
+        if (state) {
+            docs = this.byState.get(state) || [];
+        }
+        if (id !== undefined) {
+            const dealer = this.byId.get(id);
+            docs = dealer && docs.includes(dealer) ? [dealer] : [];
+        }
+        // Bookmarks are the decimal offsets of the pages this store returned
+        if (bookmark && !/^[0-9]+$/.test(bookmark)) {
+            throw new InvalidBookmark(bookmark);
+        }
+        const offset = bookmark ? Number(bookmark) : 0;
+        const page = docs.slice(offset, offset + limit);
+        const next = offset + limit < docs.length ? String(offset + limit) : undefined;
+        return { docs: page, bookmark: next };
+    }
+
+    async findByIds(ids) {
+        return ids.map((id) => this.byId.get(id)).filter(Boolean);
+    }
+
+    async near({ lat, long, limit, radius }) {
+        return this.geo.near(lat, long, limit, radius);
+    }
+}
+
+// Pick the backend from DEALERSHIPS_BACKEND: "cloudant" (default) or "memory"
+function openStore() {
+    const backend = process.env.DEALERSHIPS_BACKEND || 'cloudant';
+    if (backend === 'memory') {
+        const seedPath = process.env.DEALERSHIPS_SEED
+            || path.join(__dirname, '..', 'cloudant', 'data', 'dealerships.json');
+        return MemoryDealershipStore.fromSeedFile(seedPath);
+    }
+    if (backend === 'cloudant') {
+        return new CloudantDealershipStore(process.env.IAM_API_KEY, process.env.COUCH_URL);
+    }
+    throw new Error(`Unknown DEALERSHIPS_BACKEND: ${backend}`);
+}
+
+module.exports = { CloudantDealershipStore, GeoGrid, InvalidBookmark, MemoryDealershipStore, haversineKm, openStore };
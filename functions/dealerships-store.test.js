@@ -0,0 +1,98 @@
+// Tests of the in-memory dealerships store; run with `npm test`
+const assert = require('node:assert/strict');
+const test = require('node:test');
+const { CloudantDealershipStore, GeoGrid, InvalidBookmark, MemoryDealershipStore, haversineKm } = require('./dealerships-store');
+
+const dealer = (id, state, st, lat, long) => ({ id, state, st, lat: String(lat), long: String(long), city: `City ${id}` });
+
+// Twelve Texan dealerships, then eight in Kansas, inserted out of id order
+const dealerships = [
+    ...Array.from({ length: 8 }, (_, index) => dealer(20 - index, 'Kansas', 'KS', 38 + index / 10, -97 - index / 10)),
+    ...Array.from({ length: 12 }, (_, index) => dealer(index + 1, 'Texas', 'TX', 30 + index / 5, -97 + index / 5)),
+];
+
+const ids = (docs) => docs.map((doc) => doc.id);
+
+test('pages follow the bookmarks in id order', async () => {
+    const store = new MemoryDealershipStore(dealerships);
+    const seen = [];
+    let bookmark;
+    do {
+        const page = await store.find({ limit: 6, bookmark });
+        assert.ok(page.docs.length <= 6);
+        seen.push(...ids(page.docs));
+        ({ bookmark } = page);
+    } while (bookmark !== undefined);
+    assert.deepEqual(seen, Array.from({ length: 20 }, (_, index) => index + 1));
+});
+
+test('rejects bookmarks that are not page offsets', async () => {
+    const store = new MemoryDealershipStore(dealerships);
+    for (const bookmark of ['zz', '-5', '1.5', '6abc']) {
+        await assert.rejects(store.find({ limit: 6, bookmark }), InvalidBookmark);
+    }
+    assert.deepEqual(ids((await store.find({ limit: 2, bookmark: '' })).docs), [1, 2]);
+});
+
+test('the Cloudant store turns a rejected bookmark into InvalidBookmark', async () => {
+    const store = Object.create(CloudantDealershipStore.prototype);
+    const rejected = Object.assign(new Error('Invalid bookmark value'), { statusCode: 400 });
+    const unavailable = Object.assign(new Error('Service unavailable'), { statusCode: 503 });
+    store.db = { find: (query, callback) => callback(query.bookmark === 'zz' ? rejected : unavailable) };
+    await assert.rejects(store.find({ limit: 6, bookmark: 'zz' }), InvalidBookmark);
+    await assert.rejects(store.find({ limit: 6, bookmark: 'g1AAAA' }), unavailable);
+    await assert.rejects(store.find({ limit: 6 }), unavailable);
+});
+
+test('finds by state name or abbreviation', async () => {
+    const store = new MemoryDealershipStore(dealerships);
+    const byName = await store.find({ state: 'Kansas', limit: 5 });
+    assert.deepEqual(ids(byName.docs), [13, 14, 15, 16, 17]);
+    assert.equal(byName.bookmark, '5');
+    const rest = await store.find({ state: 'KS', limit: 5, bookmark: byName.bookmark });
+    assert.deepEqual(ids(rest.docs), [18, 19, 20]);
+    assert.equal(rest.bookmark, undefined);
+    assert.deepEqual(await store.find({ state: 'Ohio', limit: 5 }), { docs: [], bookmark: undefined });
+});
+
+test('finds by id, within a state if one is given', async () => {
+    const store = new MemoryDealershipStore(dealerships);
+    assert.deepEqual(ids((await store.find({ id: 3, limit: 10 })).docs), [3]);
+    assert.deepEqual(ids((await store.find({ state: 'TX', id: 3, limit: 10 })).docs), [3]);
+    assert.deepEqual((await store.find({ state: 'KS', id: 3, limit: 10 })).docs, []);
+    assert.deepEqual((await store.find({ id: 99, limit: 10 })).docs, []);
+    assert.deepEqual(ids(await store.findByIds([15, 99, 2])), [15, 2]);
+});
+
+test('nearest dealerships match a scan of every dealership', async () => {
+    const store = new MemoryDealershipStore(dealerships);
+    for (const [lat, long] of [[30, -97], [38.5, -97.5], [34.1, -96.8], [-33.9, 151.2]]) {
+        for (const limit of [1, 5, 20, 50]) {
+            const expected = dealerships
+                .map((doc) => ({ id: doc.id, distance: haversineKm(lat, long, parseFloat(doc.lat), parseFloat(doc.long)) }))
+                .sort((a, b) => a.distance - b.distance)
+                .slice(0, limit);
+            const found = await store.near({ lat, long, limit });
+            assert.deepEqual(ids(found), ids(expected));
+            found.forEach((doc, index) => assert.ok(Math.abs(doc.distance - expected[index].distance) < 1e-9));
+        }
+    }
+});
+
+test('radius bounds the nearest dealerships', async () => {
+    const store = new MemoryDealershipStore(dealerships);
+    const found = await store.near({ lat: 30, long: -97, limit: 50, radius: 100 });
+    assert.ok(found.length > 0 && found.length < 12);
+    assert.ok(found.every((doc) => doc.distance <= 100 && doc.state === 'Texas'));
+});
+
+test('the grid skips dealerships without coordinates and wraps around the antimeridian', () => {
+    const grid = new GeoGrid([
+        { id: 1, lat: '10', long: '179.9' },
+        { id: 2, lat: '10', long: '-179.9' },
+        { id: 3, lat: '', long: '' },
+        { id: 4, lat: '95', long: '0' },
+    ]);
+    assert.deepEqual(ids(grid.within(10, 179.95, 50)), [1, 2]);
+    assert.deepEqual(ids(grid.near(0, 0, 10)).sort(), [1, 2]);
+});
@@ -1,65 +1,106 @@
 const express = require('express');
+const { InvalidBookmark, openStore } = require('./dealerships-store');
 const app = express();
 const port = process.env.PORT || 3000;
-const iamApiKey = process.env.IAM_API_KEY;
-const couchUrl= process.env.COUCH_URL;
-const Cloudant = require('@cloudant/cloudant');
 
-// Initialize Cloudant connection with IAM authentication
-async function dbCloudantConnect() {
-    try {
-        const cloudant = Cloudant({
-            plugins: { iamauth: { iamApiKey: iamApiKey} }, // Replace with your IAM API key
-            url: couchUrl, // Replace with your Cloudant URL
-        });
-
-        const db = cloudant.use('dealerships');
-        console.info('Connect success! Connected to DB');
-        return db;
-    } catch (err) {
-        console.error('Connect failure: ' + err.message + ' for Cloudant DB');
-        throw err;
-    }
+// Open the storage backend selected by DEALERSHIPS_BACKEND (Cloudant by default)
+let store;
+try {
+    store = openStore();
+} catch (err) {
+    console.error('Connect failure: ' + err.message + ' for dealerships store');
+    throw err;
 }
 
-let db;
-
-(async () => {
-    db = await dbCloudantConnect();
-})();
-
 app.use(express.json());
 
-// Define a route to get all dealerships with optional state and ID filters
-app.get('/dealerships/get', (req, res) => {
-    const { state, id } = req.query;
+const DEFAULT_PAGE_SIZE = 50;
+const MAX_PAGE_SIZE = 200;
+// Every bookmark this service issues, memory offsets and Cloudant's base64 bookmarks alike, fits this
+const BOOKMARK_PATTERN = /^[\w:=-]{0,2048}$/;
+const INVALID_BOOKMARK = "'bookmark' parameter is not a bookmark returned by this service";
 
-    // Create a selector object based on query parameters
-    const selector = {};
-    if (state) {
-        selector.state = state;
+// Get many dealerships by id in one round trip: ?ids=1,2,3 returns an object mapping each id
+// to its dealership; ids that match no dealership are left out.
+async function getDealershipsByIds(req, res) {
+    const ids = [...new Set((req.query.ids || '').split(',').filter(Boolean).map(Number))];
+    if (!ids.length || !ids.every(Number.isInteger)) {
+        res.status(400).json({ error: "Expected 'ids' as a comma-separated list of integers" });
+        return;
     }
-    
-    if (id) {
-        selector.id = parseInt(id); // Filter by "id" with a value of 1
+    if (ids.length > MAX_PAGE_SIZE) {
+        res.status(400).json({ error: `At most ${MAX_PAGE_SIZE} ids per request` });
+        return;
     }
 
-    const queryOptions = {
-        selector,
-        limit: 10, // Limit the number of documents returned to 10
-    };
+    try {
+        const byId = {};
+        for (const dealer of await store.findByIds(ids)) {
+            byId[dealer.id] = dealer;
+        }
+        res.json(byId);
+    } catch (err) {
+        console.error('Error fetching dealerships:', err);
+        res.status(500).json({ error: 'An error occurred while fetching dealerships.' });
+    }
+}
+
+// Define a route to get dealerships with optional state and ID filters, one page at a time.
+// Pass `limit` (page size) and the `bookmark` returned in the X-Bookmark header to get the next page.
+// Pass `ids` instead to get many dealerships at once (see getDealershipsByIds).
+app.get('/dealerships/get', async (req, res) => {
+    if (req.query.ids !== undefined) {
+        await getDealershipsByIds(req, res);
+        return;
+    }
+    const { state, id, bookmark } = req.query;
+    const limit = Math.min(parseInt(req.query.limit) || DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE);
+    if (bookmark !== undefined && !(typeof bookmark === 'string' && BOOKMARK_PATTERN.test(bookmark))) {
+        res.status(400).json({ error: INVALID_BOOKMARK });
+        return;
+    }
 
-    db.find(queryOptions, (err, body) => {
-        if (err) {
-            console.error('Error fetching dealerships:', err);
-            res.status(500).json({ error: 'An error occurred while fetching dealerships.' });
-        } else {
-            const dealerships = body.docs;
-            res.json(dealerships);
+    try {
+        const page = await store.find({
+            state,
+            id: id ? parseInt(id) : undefined,
+            limit,
+            bookmark,
+        });
+        if (page.bookmark) {
+            res.set('X-Bookmark', page.bookmark);
         }
-    });
+        res.json(page.docs);
+    } catch (err) {
+        if (err instanceof InvalidBookmark) {
+            res.status(400).json({ error: INVALID_BOOKMARK });
+            return;
+        }
+        console.error('Error fetching dealerships:', err);
+        res.status(500).json({ error: 'An error occurred while fetching dealerships.' });
+    }
+});
+
+// Define a route to get the `limit` dealerships nearest to `lat`/`long`, optionally within
+// `radius` km, closest first; each one carries its `distance` in km.
+app.get('/dealerships/near', async (req, res) => {
+    const lat = parseFloat(req.query.lat);
+    const long = parseFloat(req.query.long);
+    const radius = req.query.radius ? parseFloat(req.query.radius) : undefined;
+    const limit = Math.min(parseInt(req.query.limit) || 10, MAX_PAGE_SIZE);
+    if (!(Math.abs(lat) <= 90 && Math.abs(long) <= 180) || (radius !== undefined && !(radius > 0))) {
+        res.status(400).json({ error: 'Expected numeric lat and long, and optionally limit and radius' });
+        return;
+    }
+
+    try {
+        res.json(await store.near({ lat, long, limit, radius }));
+    } catch (err) {
+        console.error('Error fetching nearby dealerships:', err);
+        res.status(500).json({ error: 'An error occurred while fetching nearby dealerships.' });
+    }
 });
 
 app.listen(port, () => {
     console.log(`Server is running on port ${port}`);
-});
\ No newline at end of file
+});
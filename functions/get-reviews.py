@@ -1,25 +1,126 @@
-from cloudant.client import Cloudant
-from cloudant.query import Query
-from flask import Flask, abort, jsonify, request
+from flask import Flask, Response, abort, jsonify, request, stream_with_context
 import atexit
+import json
 import os
+import queue
+import threading
+import uuid
+from reviews_store import InvalidBookmark, open_store, parse_search
 
-#Add your Cloudant service credentials here
-cloudant_username = os.environ.get('CLOUDANT_USERNAME')
-cloudant_api_key = os.environ.get('IAM_API_KEY')
-cloudant_url = os.environ.get('COUCH_URL')
+try:
+    from ibm_watson import NaturalLanguageUnderstandingV1
+    from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+    from ibm_watson.natural_language_understanding_v1 import Features, SentimentOptions
+except ImportError:
+    NaturalLanguageUnderstandingV1 = None
 
-client = Cloudant.iam(cloudant_username, cloudant_api_key, connect=True, url=cloudant_url)
+# Open the storage backend selected by REVIEWS_BACKEND (Cloudant by default)
+store = open_store()
 
-session = client.session()
-print('Databases:', client.all_dbs())
+# Compute review sentiment once, when the review is written, instead of on every read
+nlu_api_key = os.environ.get('NLU_API_KEY')
+nlu_url = os.environ.get('NLU_URL')
+nlu_version = os.environ.get('NLU_VERSION', '2022-04-07')
+sentiment_on_write = (os.environ.get('SENTIMENT_ON_WRITE', '').lower() in ('1', 'true', 'yes')
+                      and NaturalLanguageUnderstandingV1 is not None
+                      and bool(nlu_api_key and nlu_url))
 
-db = client['reviews']
+sentiment_queue = queue.Queue()
+# Ids of the reviews waiting in sentiment_queue, so a review read many times is queued once
+queued_reviews = set()
+queued_lock = threading.Lock()
+nlu = None
+
+
+def analyze_sentiment(text):
+    global nlu
+    if nlu is None:
+        nlu = NaturalLanguageUnderstandingV1(version=nlu_version,
+                                             authenticator=IAMAuthenticator(nlu_api_key))
+        nlu.set_service_url(nlu_url)
+    response = nlu.analyze(text=text,
+                           features=Features(sentiment=SentimentOptions(targets=[text])),
+                           language='en').get_result()
+    return response['sentiment']['document']['label']
+
+
+def sentiment_worker():
+    # Label queued review documents in the background so post_review never waits on NLU
+    while True:
+        review_id, text = sentiment_queue.get()
+        try:
+            store.update(review_id, {'sentiment': analyze_sentiment(text),
+                                     'sentiment_version': nlu_version})
+        except Exception as err:
+            print('Sentiment for review {} failed: {}'.format(review_id, err))
+        finally:
+            with queued_lock:
+                queued_reviews.discard(review_id)
+            sentiment_queue.task_done()
+
+
+def queue_sentiment(review_id, text):
+    with queued_lock:
+        if review_id in queued_reviews:
+            return
+        queued_reviews.add(review_id)
+    sentiment_queue.put((review_id, text))
+
+
+def current_sentiment(document):
+    # A label computed by another NLU model version is served as missing, so the caller labels the review
+    # itself, and is computed again in the background when sentiment is computed on write
+    if 'sentiment' not in document or document.get('sentiment_version') == nlu_version:
+        return document
+    if sentiment_on_write:
+        queue_sentiment(document['_id'], document['review'])
+    return {key: value for key, value in document.items() if key not in ('sentiment', 'sentiment_version')}
+
+
+if sentiment_on_write:
+    threading.Thread(target=sentiment_worker, daemon=True).start()
+    atexit.register(lambda: print('Reviews still waiting for sentiment:', sentiment_queue.qsize()))
 
 app = Flask(__name__)
 
+DEFAULT_PAGE_SIZE = 25
+MAX_PAGE_SIZE = 200
+STREAM_PAGE_SIZE = 100
+MAX_BULK_SIZE = 1000
+
+
+def stream_json_array(documents):
+    # Yield a JSON array one document at a time, so a response never holds the full result set
+    yield '['
+    for index, document in enumerate(documents):
+        yield (',' if index else '') + json.dumps(document, separators=(',', ':'))
+    yield ']'
+
+
+def get_reviews_by_dealership():
+    # Batch mode, ?ids=1,2,3: the first page of `limit` reviews of each dealership in one response,
+    # as an object keyed by dealership id
+    try:
+        dealership_ids = list(dict.fromkeys(int(value) for value in request.args['ids'].split(',') if value))
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "'ids' must be a comma-separated list of integers and 'limit' an integer"}), 400
+    if not dealership_ids:
+        return jsonify({"error": "Missing 'ids' parameter in the URL"}), 400
+    if len(dealership_ids) > MAX_PAGE_SIZE:
+        return jsonify({"error": f"At most {MAX_PAGE_SIZE} ids per request"}), 400
+    if limit < 1:
+        return jsonify({"error": "'limit' parameter must be positive"}), 400
+    grouped = store.reviews_by_dealership(dealership_ids, limit)
+    return jsonify({str(dealership_id): list(map(current_sentiment, reviews))
+                    for dealership_id, reviews in grouped.items()})
+
+
 @app.route('/api/get_reviews', methods=['GET'])
 def get_reviews():
+    if 'ids' in request.args:
+        return get_reviews_by_dealership()
+
     dealership_id = request.args.get('id')
 
     # Check if "id" parameter is missing
@@ -32,22 +133,73 @@ def get_reviews():
     except ValueError:
         return jsonify({"error": "'id' parameter must be an integer"}), 400
 
-    # Define the query based on the 'dealership' ID
-    selector = {
-        'dealership': { "$eq" : dealership_id }
-    }
+    # Streaming mode sends every matching review without holding them all in memory
+    if request.args.get('stream', '').lower() in ('1', 'true', 'yes'):
+        result = map(current_sentiment, store.iter_reviews(dealership_id, page_size=STREAM_PAGE_SIZE))
+        return Response(stream_with_context(stream_json_array(result)),
+                        mimetype='application/json')
+
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "'limit' parameter must be an integer"}), 400
+    if limit < 1:
+        return jsonify({"error": "'limit' parameter must be positive"}), 400
+
+    # Fetch a single page; the bookmark of the previous page continues where it stopped
+    try:
+        data_list, bookmark = store.query_page(dealership_id, limit, request.args.get('bookmark'))
+    except InvalidBookmark:
+        return jsonify({"error": "'bookmark' parameter is not a bookmark returned by this service"}), 400
+
+    # Return the data as JSON, with the next page's bookmark unless this page is the last
+    response = jsonify(list(map(current_sentiment, data_list)))
+    if bookmark:
+        response.headers['X-Bookmark'] = bookmark
+    return response
+
+
+@app.route('/api/search_reviews', methods=['GET'])
+def search_reviews():
+    # Full-text search over review text, car make and model, served from an index kept up to date on write.
+    # Every word must match; a word ending in * matches as a prefix: ?q=reliab* audi
+    terms = parse_search(request.args.get('q', ''))
+    if not terms:
+        return jsonify({"error": "Missing 'q' parameter in the URL"}), 400
+    try:
+        limit = min(int(request.args.get('limit', DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        dealership_id = int(request.args['id']) if request.args.get('id') else None
+    except ValueError:
+        return jsonify({"error": "'limit' and 'id' parameters must be integers"}), 400
+    if limit < 1:
+        return jsonify({"error": "'limit' parameter must be positive"}), 400
+    return jsonify(list(map(current_sentiment, store.search(terms, dealership_id, limit))))
+
 
-    # Execute the query using the query method
-    result = db.get_query_result(selector)
-    # Create a list to store the documents
-    data_list = []
+@app.route('/api/review_summaries', methods=['GET'])
+def review_summaries():
+    # Aggregates maintained on every write: the cost per dealership does not grow with its reviews
+    try:
+        dealership_ids = [int(value) for value in request.args.get('ids', '').split(',') if value]
+    except ValueError:
+        return jsonify({"error": "'ids' parameter must be a comma-separated list of integers"}), 400
+    if not dealership_ids:
+        return jsonify({"error": "Missing 'ids' parameter in the URL"}), 400
+    if len(dealership_ids) > MAX_PAGE_SIZE:
+        return jsonify({"error": f"At most {MAX_PAGE_SIZE} ids per request"}), 400
+    return jsonify(store.summaries(list(dict.fromkeys(dealership_ids))))
 
-    # Iterate through the results and add documents to the list
-    for doc in result:
-        data_list.append(doc)
 
-    # Return the data as JSON
-    return jsonify(data_list)
+@app.route('/api/explain_reviews', methods=['GET'])
+def explain_reviews():
+    # Debug endpoint: show the query plan the store uses for a dealership's reviews
+    if not (app.debug or os.environ.get('ENABLE_EXPLAIN', '').lower() in ('1', 'true', 'yes')):
+        abort(404)
+    try:
+        dealership_id = int(request.args.get('id', ''))
+    except ValueError:
+        return jsonify({"error": "'id' parameter must be an integer"}), 400
+    return jsonify(store.explain(dealership_id))
 
 
 @app.route('/api/post_review', methods=['POST'])
@@ -64,10 +216,44 @@ def post_review():
         if field not in review_data:
             abort(400, description=f'Missing required field: {field}')
 
-    # Save the review data as a new document in the Cloudant database
-    db.create_document(review_data)
+    # Save the review data as a new document in the reviews store
+    review_id = store.create(review_data)
+    if sentiment_on_write:
+        queue_sentiment(review_id, review_data['review'])
+
+    return jsonify({"message": "Review posted successfully", "id": review_id}), 201
+
+
+@app.route('/api/post_reviews', methods=['POST'])
+def post_reviews():
+    # Bulk endpoint for imports: store a JSON array of reviews in a single write
+    reviews = request.get_json(silent=True)
+    if not isinstance(reviews, list) or not all(isinstance(review, dict) for review in reviews):
+        abort(400, description='Expected a JSON array of reviews')
+    if len(reviews) > MAX_BULK_SIZE:
+        abort(413, description=f'At most {MAX_BULK_SIZE} reviews per request')
+
+    required_fields = ['name', 'dealership', 'review', 'purchase']
+    for index, review_data in enumerate(reviews):
+        for field in required_fields:
+            if field not in review_data:
+                abort(400, description=f'Review {index}: missing required field: {field}')
+
+    # Ids are assigned here so that each stored review can be matched to its text
+    for review_data in reviews:
+        review_data.setdefault('_id', uuid.uuid4().hex)
+    statuses = store.create_many(reviews)
+    review_ids = [review_id for review_id, status in statuses.items() if status == 'stored']
+    if sentiment_on_write:
+        texts = {review_data['_id']: review_data['review'] for review_data in reviews}
+        for review_id in review_ids:
+            queue_sentiment(review_id, texts[review_id])
 
-    return jsonify({"message": "Review posted successfully"}), 201
+    # "results" tells the outcome of every _id: stored, conflict (already stored) or failed, to retry;
+    # 207 Multi-Status flags a batch that was not stored in full
+    failed = sum(status == 'failed' for status in statuses.values())
+    return jsonify({"message": "Reviews posted successfully" if not failed else f"{failed} reviews failed",
+                    "created": len(review_ids), "results": statuses}), 207 if failed else 201
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,483 @@
+"""Storage backends for the reviews service
+
+Every store offers the same small interface used by get-reviews.py:
+
+    query_page(dealership_id, limit, bookmark)  one page of reviews and the next bookmark; raises
+                                                InvalidBookmark for a bookmark the store did not issue
+    iter_reviews(dealership_id)                 every review, fetched lazily
+    reviews_by_dealership(dealership_ids, limit)  the first page of limit reviews of each dealership
+    create(review)                              store a new review, returns its id
+    create_many(reviews)                        store many reviews at once, returns a dict mapping
+                                                each _id to "stored", "conflict" (already held)
+                                                or "failed"
+    update(review_id, fields)                   merge fields into a stored review
+    summaries(dealership_ids)                   review aggregates of each dealership
+    search(terms, dealership_id, limit)         reviews matching every term, best first
+    explain(dealership_id)                      the query plan used for a dealership
+
+Pick the backend with REVIEWS_BACKEND: "cloudant" (default) or "sqlite", an
+embedded database with indexes on dealership and review_date that needs no
+outside service.
+
+The aggregates behind summaries() and the full-text index behind search()
+are kept up to date as reviews are written, so neither reads scan the reviews.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import uuid
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from requests.exceptions import HTTPError
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cloudant', 'data')
+
+TOP_MAKES = 3
+
+# Cloudant queries a batch read keeps in flight at once
+QUERY_WORKERS = 8
+
+# The review fields covered by full-text search
+SEARCH_FIELDS = ('review', 'car_make', 'car_model')
+
+
+class InvalidBookmark(ValueError):
+    """Raised by query_page for a bookmark that the store did not issue"""
+
+
+def parse_search(query):
+    """Split a search query into (word, is_prefix) terms; a trailing * marks a prefix"""
+    return [(match.group(1).lower(), bool(match.group(2)))
+            for match in re.finditer(r'(\w+)(\*)?', query)]
+
+
+def record_status(statuses, review_id, status):
+    """Record the outcome of writing a review; a review posted twice in a batch counts as stored once"""
+    if statuses.get(review_id) != 'stored':
+        statuses[review_id] = status
+
+
+def count_keys(review):
+    """Return the (kind, key) counters a review adds to its dealership's aggregates"""
+    keys = [('reviews', '')]
+    if review.get('purchase'):
+        keys.append(('purchases', ''))
+        if review.get('car_make'):
+            keys.append(('makes', review['car_make']))
+    if review.get('sentiment'):
+        keys.append(('sentiment', review['sentiment']))
+    return keys
+
+
+def summarize(dealership_id, counts):
+    """Build a dealership's summary from its (kind, key, count) counters"""
+    totals = {}
+    sentiment = {}
+    makes = []
+    for kind, key, count in counts:
+        if kind == 'sentiment':
+            sentiment[key] = count
+        elif kind == 'makes':
+            makes.append((count, key))
+        else:
+            totals[kind] = count
+    reviews = totals.get('reviews', 0)
+    purchases = totals.get('purchases', 0)
+    makes.sort(key=lambda make: (-make[0], make[1]))
+    return {
+        'dealership': dealership_id,
+        'reviews': reviews,
+        'purchases': purchases,
+        'purchase_ratio': round(purchases / reviews, 3) if reviews else None,
+        'sentiment': sentiment,
+        'top_makes': [{'make': key, 'reviews': count} for count, key in makes[:TOP_MAKES]],
+    }
+
+
+class CloudantReviewStore:
+    """Reviews kept in the Cloudant 'reviews' database, queried through a declared index"""
+
+    DESIGN_DOC = 'reviews-by-dealership'
+    DEALERSHIP_INDEX = 'dealership'
+    DEALERSHIP_DATE_INDEX = 'dealership-review_date'
+    SUMMARY_DESIGN_DOC = '_design/review-summaries'
+    SUMMARY_VIEW = 'counts'
+    # Emits the counters of count_keys(); Cloudant keeps the _count reduction up to date
+    SUMMARY_MAP = '''function (doc) {
+        if (doc.dealership === undefined) return;
+        emit([doc.dealership, 'reviews', ''], null);
+        if (doc.purchase) {
+            emit([doc.dealership, 'purchases', ''], null);
+            if (doc.car_make) emit([doc.dealership, 'makes', doc.car_make], null);
+        }
+        if (doc.sentiment) emit([doc.dealership, 'sentiment', doc.sentiment], null);
+    }'''
+    SEARCH_DESIGN_DOC = '_design/review-search'
+    SEARCH_INDEX = 'text'
+    # A Cloudant Search (Lucene) index over SEARCH_FIELDS, maintained by Cloudant as documents change
+    SEARCH_FUNCTION = '''function (doc) {
+        if (doc.dealership === undefined) return;
+        index('dealership', doc.dealership);
+        index('default', [doc.review, doc.car_make, doc.car_model].filter(Boolean).join(' '));
+        if (doc.car_make) index('car_make', doc.car_make);
+        if (doc.car_model) index('car_model', doc.car_model);
+    }'''
+
+    def __init__(self, client, sort_by_date=False, query_workers=QUERY_WORKERS):
+        self.client = client
+        self.db = client['reviews']
+        # Runs the per-dealership queries of a batch read concurrently
+        self.executor = ThreadPoolExecutor(max_workers=query_workers, thread_name_prefix='cloudant')
+        # Newest-first ordering only returns reviews that have a review_date
+        self.sort_by_date = sort_by_date
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        try:
+            self.db.create_query_index(design_document_id=self.DESIGN_DOC,
+                                       index_name=self.DEALERSHIP_INDEX, fields=['dealership'])
+            if self.sort_by_date:
+                self.db.create_query_index(design_document_id=self.DESIGN_DOC,
+                                           index_name=self.DEALERSHIP_DATE_INDEX,
+                                           fields=['dealership', 'review_date'])
+            from cloudant.design_document import DesignDocument
+            summaries = DesignDocument(self.db, self.SUMMARY_DESIGN_DOC)
+            if not summaries.exists():
+                summaries.add_view(self.SUMMARY_VIEW, self.SUMMARY_MAP, reduce_func='_count')
+                summaries.save()
+            search = DesignDocument(self.db, self.SEARCH_DESIGN_DOC)
+            if not search.exists():
+                search.add_search_index(self.SEARCH_INDEX, self.SEARCH_FUNCTION, analyzer='english')
+                search.save()
+        except Exception as err:
+            print('Unable to ensure the reviews indexes:', err)
+
+    def _query(self, dealership_id):
+        # Return the selector and options of the indexed query for a dealership's reviews
+        selector = {
+            'dealership': {"$eq": dealership_id}
+        }
+        if self.sort_by_date:
+            selector['review_date'] = {'$gt': None}
+            options = {'use_index': [self.DESIGN_DOC, self.DEALERSHIP_DATE_INDEX],
+                       'sort': [{'dealership': 'desc'}, {'review_date': 'desc'}]}
+        else:
+            options = {'use_index': [self.DESIGN_DOC, self.DEALERSHIP_INDEX]}
+        return selector, options
+
+    def query_page(self, dealership_id, limit, bookmark=None):
+        selector, options = self._query(dealership_id)
+        if bookmark:
+            options['bookmark'] = bookmark
+        try:
+            result = self.db.get_query_result(selector, raw_result=True, limit=limit, **options)
+        except HTTPError as err:
+            # Cloudant answers 400 to a malformed bookmark
+            if bookmark and err.response is not None and err.response.status_code == 400:
+                raise InvalidBookmark(bookmark) from err
+            raise
+        docs = result['docs']
+        # A short page is the last one
+        next_bookmark = result.get('bookmark') if len(docs) == limit else None
+        return docs, next_bookmark
+
+    def iter_reviews(self, dealership_id, page_size=100):
+        selector, options = self._query(dealership_id)
+        return iter(self.db.get_query_result(selector, page_size=page_size, **options))
+
+    def reviews_by_dealership(self, dealership_ids, limit):
+        # Cloudant cannot cap an $in query per dealership, and the index returns one dealership's
+        # reviews after the other, so a single query would read every review of the dealerships.
+        # Each dealership gets its own query of `limit` reviews instead, all of them sent at once.
+        dealership_ids = list(dealership_ids)
+        pages = self.executor.map(lambda dealership_id: self.query_page(dealership_id, limit)[0], dealership_ids)
+        return dict(zip(dealership_ids, pages))
+
+    def create(self, review):
+        return self.db.create_document(review)['_id']
+
+    def create_many(self, reviews):
+        # One _bulk_docs request per batch; a document whose _id already exists is skipped
+        statuses = {}
+        failed = []
+        for result in self.db.bulk_docs(reviews):
+            error = result.get('error')
+            if error not in (None, 'conflict'):
+                failed.append(result)
+            record_status(statuses, result['id'],
+                          'stored' if error is None else 'conflict' if error == 'conflict' else 'failed')
+        if failed:
+            print('Unable to store {} reviews, e.g. {}'.format(len(failed), failed[0]))
+        return statuses
+
+    def update(self, review_id, fields):
+        document = self.db[review_id]
+        document.update(fields)
+        document.save()
+
+    def summaries(self, dealership_ids):
+        # A grouped view read per dealership, touching only its handful of counters, all sent in
+        # one request to the view's multi-query endpoint
+        url = '{}/{}/_view/{}/queries'.format(self.db.database_url, self.SUMMARY_DESIGN_DOC, self.SUMMARY_VIEW)
+        queries = [{'group_level': 3, 'startkey': [dealership_id], 'endkey': [dealership_id, {}]}
+                   for dealership_id in dealership_ids]
+        response = self.client.r_session.post(url, json={'queries': queries})
+        response.raise_for_status()
+        return [summarize(dealership_id, [(row['key'][1], row['key'][2], row['value']) for row in result['rows']])
+                for dealership_id, result in zip(dealership_ids, response.json()['results'])]
+
+    def search(self, terms, dealership_id=None, limit=25):
+        # Every term must match; make and model matches rank above matches in the text
+        clauses = ['({0}{1} OR car_make:{0}{1}^2 OR car_model:{0}{1}^2)'.format(word, '*' if prefix else '')
+                   for word, prefix in terms]
+        if dealership_id is not None:
+            clauses.append('dealership:{}'.format(int(dealership_id)))
+        result = self.db.get_search_result(self.SEARCH_DESIGN_DOC, self.SEARCH_INDEX,
+                                           query=' AND '.join(clauses), limit=limit, include_docs=True)
+        return [row['doc'] for row in result['rows']]
+
+    def explain(self, dealership_id):
+        selector, options = self._query(dealership_id)
+        response = self.client.r_session.post(self.db.database_url + '/_explain',
+                                              json=dict(options, selector=selector, limit=25))
+        return response.json()
+
+
+class SQLiteReviewStore:
+    """Reviews kept in an embedded SQLite database
+
+    Each review is one row holding the JSON document, with the dealership and
+    review date copied into indexed columns. Pages are keyed on the row id, so
+    fetching page N costs the same as fetching page 1. The per-dealership
+    counters of count_keys() live in review_counts and are adjusted in the same
+    transaction as every write. reviews_search is a contentless FTS5 index over
+    SEARCH_FIELDS: it keeps only the stemmed terms, with prefix indexes for
+    search-as-you-type, and its rowids point back at the reviews.
+    """
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS reviews (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            dealership INTEGER NOT NULL,
+            review_date TEXT,
+            doc TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS reviews_dealership ON reviews (dealership, seq);
+        CREATE INDEX IF NOT EXISTS reviews_dealership_date ON reviews (dealership, review_date);
+        CREATE TABLE IF NOT EXISTS review_counts (
+            dealership INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            key TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (dealership, kind, key)
+        ) WITHOUT ROWID;
+        CREATE VIRTUAL TABLE IF NOT EXISTS reviews_search USING fts5(
+            review, car_make, car_model,
+            content='', tokenize='porter unicode61 remove_diacritics 2', prefix='2 3'
+        );
+    '''
+
+    def __init__(self, path, seed_path=None):
+        self.path = path
+        self._local = threading.local()
+        connection = self._connection()
+        connection.executescript(self.SCHEMA)
+        # Rank make and model matches above matches in the review text
+        connection.execute("INSERT INTO reviews_search (reviews_search, rank) VALUES ('rank', 'bm25(1.0, 2.0, 2.0)')")
+        if not connection.execute('SELECT 1 FROM reviews LIMIT 1').fetchone():
+            if seed_path:
+                self.seed(seed_path)
+        else:
+            # A database created before the aggregates or the search index existed
+            if not connection.execute('SELECT 1 FROM review_counts LIMIT 1').fetchone():
+                self.rebuild_counts()
+            if not connection.execute('SELECT 1 FROM reviews_search LIMIT 1').fetchone():
+                self.rebuild_search()
+
+    def _connection(self):
+        # sqlite3 connections must not be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def seed(self, seed_path):
+        with open(seed_path, encoding='utf-8') as seed:
+            reviews = json.load(seed)['reviews']
+        self.create_many(reviews)
+        print('Seeded {} reviews from {}'.format(len(reviews), seed_path))
+
+    @staticmethod
+    def _row(review):
+        review = dict(review)
+        review.setdefault('_id', uuid.uuid4().hex)
+        return (review['_id'], int(review['dealership']), review.get('review_date'),
+                json.dumps(review, separators=(',', ':')))
+
+    @staticmethod
+    def _count(connection, dealership_id, keys, delta):
+        connection.executemany(
+            'INSERT INTO review_counts (dealership, kind, key, count) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (dealership, kind, key) DO UPDATE SET count = count + excluded.count',
+            [(dealership_id, kind, key, delta) for kind, key in keys])
+
+    @staticmethod
+    def _search_values(review):
+        return tuple(str(review.get(field) or '') for field in SEARCH_FIELDS)
+
+    def _index_text(self, connection, seq, review):
+        connection.execute('INSERT INTO reviews_search (rowid, review, car_make, car_model) VALUES (?, ?, ?, ?)',
+                           (seq,) + self._search_values(review))
+
+    def create_many(self, reviews):
+        # A review whose _id is already stored is skipped; the batch is stored in full or not at all
+        connection = self._connection()
+        statuses = {}
+        with connection:
+            connection.execute('BEGIN')
+            for review in reviews:
+                row = self._row(review)
+                cursor = connection.execute('INSERT OR IGNORE INTO reviews (id, dealership, review_date, doc) '
+                                            'VALUES (?, ?, ?, ?)', row)
+                record_status(statuses, row[0], 'stored' if cursor.rowcount else 'conflict')
+                if cursor.rowcount:
+                    self._count(connection, row[1], count_keys(review), 1)
+                    self._index_text(connection, cursor.lastrowid, review)
+        return statuses
+
+    def rebuild_counts(self):
+        counts = Counter()
+        connection = self._connection()
+        for dealership_id, doc in connection.execute('SELECT dealership, doc FROM reviews'):
+            counts.update((dealership_id, kind, key) for kind, key in count_keys(json.loads(doc)))
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute('DELETE FROM review_counts')
+            connection.executemany('INSERT INTO review_counts (dealership, kind, key, count) '
+                                   'VALUES (?, ?, ?, ?)', [key + (count,) for key, count in counts.items()])
+
+    def query_page(self, dealership_id, limit, bookmark=None):
+        # Bookmarks are the sequence numbers of the pages' last reviews
+        if bookmark and not (bookmark.isascii() and bookmark.isdigit()):
+            raise InvalidBookmark(bookmark)
+        after = int(bookmark) if bookmark else 0
+        rows = self._connection().execute(
+            'SELECT seq, doc FROM reviews WHERE dealership = ? AND seq > ? ORDER BY seq LIMIT ?',
+            (dealership_id, after, limit)).fetchall()
+        docs = [json.loads(doc) for _, doc in rows]
+        next_bookmark = str(rows[-1][0]) if len(rows) == limit else None
+        return docs, next_bookmark
+
+    def iter_reviews(self, dealership_id, page_size=100):
+        cursor = self._connection().execute(
+            'SELECT doc FROM reviews WHERE dealership = ? ORDER BY seq', (dealership_id,))
+        while True:
+            rows = cursor.fetchmany(page_size)
+            if not rows:
+                return
+            for (doc,) in rows:
+                yield json.loads(doc)
+
+    def reviews_by_dealership(self, dealership_ids, limit):
+        # The first `limit` reviews of every dealership in one statement, read in index order
+        grouped = {dealership_id: [] for dealership_id in dealership_ids}
+        rows = self._connection().execute(
+            'SELECT dealership, doc FROM (SELECT dealership, seq, doc, row_number() OVER '
+            '(PARTITION BY dealership ORDER BY seq) AS position FROM reviews WHERE dealership IN ({})) '
+            'WHERE position <= ? ORDER BY dealership, seq'.format(', '.join('?' * len(grouped))),
+            list(grouped) + [limit])
+        for dealership_id, doc in rows:
+            grouped[dealership_id].append(json.loads(doc))
+        return grouped
+
+    def rebuild_search(self):
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.execute("INSERT INTO reviews_search (reviews_search) VALUES ('delete-all')")
+            for seq, doc in connection.execute('SELECT seq, doc FROM reviews').fetchall():
+                self._index_text(connection, seq, json.loads(doc))
+
+    def create(self, review):
+        row = self._row(review)
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN')
+            seq = connection.execute(
+                'INSERT INTO reviews (id, dealership, review_date, doc) VALUES (?, ?, ?, ?)', row).lastrowid
+            self._count(connection, row[1], count_keys(review), 1)
+            self._index_text(connection, seq, review)
+        return row[0]
+
+    def update(self, review_id, fields):
+        connection = self._connection()
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            seq, dealership_id, doc = connection.execute(
+                'SELECT seq, dealership, doc FROM reviews WHERE id = ?', (review_id,)).fetchone()
+            previous = json.loads(doc)
+            review = dict(previous, **fields)
+            connection.execute('UPDATE reviews SET doc = ? WHERE id = ?',
+                               (json.dumps(review, separators=(',', ':')), review_id))
+            if count_keys(previous) != count_keys(review):
+                self._count(connection, dealership_id, count_keys(previous), -1)
+                self._count(connection, dealership_id, count_keys(review), 1)
+            if self._search_values(previous) != self._search_values(review):
+                # A contentless index forgets a row given the values it was indexed with
+                connection.execute("INSERT INTO reviews_search (reviews_search, rowid, review, car_make, "
+                                   "car_model) VALUES ('delete', ?, ?, ?, ?)",
+                                   (seq,) + self._search_values(previous))
+                self._index_text(connection, seq, review)
+
+    def summaries(self, dealership_ids):
+        counts = {dealership_id: [] for dealership_id in dealership_ids}
+        rows = self._connection().execute(
+            'SELECT dealership, kind, key, count FROM review_counts WHERE dealership IN ({}) AND count > 0'
+            .format(', '.join('?' * len(counts))), list(counts)).fetchall()
+        for dealership_id, kind, key, count in rows:
+            counts[dealership_id].append((kind, key, count))
+        return [summarize(dealership_id, counts[dealership_id]) for dealership_id in dealership_ids]
+
+    def search(self, terms, dealership_id=None, limit=25):
+        # Every term must match. Hits are ranked inside the index and only the best
+        # `limit` documents are read back, unless a dealership filter needs them all
+        match = ' '.join('"{}"{}'.format(word, '*' if prefix else '') for word, prefix in terms)
+        if dealership_id is None:
+            rows = self._connection().execute(
+                'SELECT reviews.doc FROM (SELECT rowid, rank FROM reviews_search WHERE reviews_search MATCH ? '
+                'ORDER BY rank LIMIT ?) AS hits JOIN reviews ON reviews.seq = hits.rowid ORDER BY hits.rank',
+                (match, limit))
+        else:
+            rows = self._connection().execute(
+                'SELECT reviews.doc FROM reviews_search JOIN reviews ON reviews.seq = reviews_search.rowid '
+                'WHERE reviews_search MATCH ? AND reviews.dealership = ? ORDER BY reviews_search.rank LIMIT ?',
+                (match, int(dealership_id), limit))
+        return [json.loads(doc) for (doc,) in rows]
+
+    def explain(self, dealership_id):
+        rows = self._connection().execute(
+            'EXPLAIN QUERY PLAN SELECT seq, doc FROM reviews WHERE dealership = ? AND seq > ? '
+            'ORDER BY seq LIMIT ?', (dealership_id, 0, 25)).fetchall()
+        return {'plan': [row[-1] for row in rows]}
+
+
+def open_store():
+    """Open the backend selected by the REVIEWS_BACKEND environment variable"""
+    backend = os.environ.get('REVIEWS_BACKEND', 'cloudant')
+    if backend == 'sqlite':
+        seed_path = os.environ.get('REVIEWS_SEED', os.path.join(DATA_DIR, 'reviews-full.json'))
+        return SQLiteReviewStore(os.environ.get('REVIEWS_SQLITE_PATH', 'reviews.sqlite3'), seed_path)
+    if backend == 'cloudant':
+        from cloudant.client import Cloudant
+        client = Cloudant.iam(os.environ.get('CLOUDANT_USERNAME'), os.environ.get('IAM_API_KEY'),
+                              connect=True, url=os.environ.get('COUCH_URL'))
+        print('Databases:', client.all_dbs())
+        sort_by_date = os.environ.get('REVIEWS_SORT_BY_DATE', '').lower() in ('1', 'true', 'yes')
+        return CloudantReviewStore(client, sort_by_date=sort_by_date)
+    raise ValueError('Unknown REVIEWS_BACKEND: {}'.format(backend))
@@ -7,6 +7,21 @@ from cloudant.client import Cloudant
 from cloudant.error import CloudantException
 import requests
 
+# Kept between invocations while the action's container stays warm
+_client = None
+
+
+def get_client(param_dict):
+    """Return the Cloudant client, connecting on the first invocation only"""
+    global _client  # pylint: disable=global-statement
+    if _client is None:
+        _client = Cloudant.iam(
+            account_name=param_dict["COUCH_USERNAME"],
+            api_key=param_dict["IAM_API_KEY"],
+            connect=True,
+        )
+    return _client
+
 
 def main(param_dict):
     """Main Function
@@ -19,12 +34,8 @@ def main(param_dict):
     """
 
     try:
-        client = Cloudant.iam(
-            account_name=param_dict["COUCH_USERNAME"],
-            api_key=param_dict["IAM_API_KEY"],
-            connect=True,
-        )
-        print(f"Databases: {client.all_dbs()}")
+        dbs = get_client(param_dict).all_dbs()
+        print(f"Databases: {dbs}")
     except CloudantException as cloudant_exception:
         print("unable to connect")
         return {"error": cloudant_exception}
@@ -32,4 +43,4 @@ def main(param_dict):
         print("connection error")
         return {"error": err}
 
-    return {"dbs": client.all_dbs()}
+    return {"dbs": dbs}
@@ -0,0 +1,57 @@
+"""Tests of the reviews service's endpoints; run with `python -m pytest functions` or `python -m unittest`"""
+import importlib.util
+import os
+import tempfile
+import unittest
+from unittest import mock
+from reviews_store import SQLiteReviewStore
+
+
+def load_service(store):
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'get-reviews.py')
+    spec = importlib.util.spec_from_file_location('get_reviews', path)
+    module = importlib.util.module_from_spec(spec)
+    with mock.patch('reviews_store.open_store', return_value=store):
+        spec.loader.exec_module(module)
+    return module
+
+
+class SentimentVersionTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        store = SQLiteReviewStore(os.path.join(directory.name, 'reviews.sqlite3'))
+        texts = {'current': 'Great service', 'stale': 'Slow service', 'unlabelled': 'Fine'}
+        store.create_many([{'_id': review_id, 'dealership': 1, 'name': 'Reviewer', 'review': text,
+                            'purchase': False} for review_id, text in texts.items()])
+        self.service = load_service(store)
+        store.update('current', {'sentiment': 'positive', 'sentiment_version': self.service.nlu_version})
+        store.update('stale', {'sentiment': 'neutral', 'sentiment_version': '2019-07-12'})
+        self.client = self.service.app.test_client()
+
+    def labels(self, reviews):
+        return {review['_id']: review.get('sentiment') for review in reviews}
+
+    def test_labels_of_another_model_version_are_missing(self):
+        expected = {'current': 'positive', 'stale': None, 'unlabelled': None}
+        self.assertEqual(self.labels(self.client.get('/api/get_reviews?id=1').get_json()), expected)
+        self.assertEqual(self.labels(self.client.get('/api/get_reviews?id=1&stream=true').get_json()), expected)
+        self.assertEqual(self.labels(self.client.get('/api/get_reviews?ids=1').get_json()['1']), expected)
+        self.assertEqual(self.labels(self.client.get('/api/search_reviews?q=service').get_json()),
+                         {'current': 'positive', 'stale': None})
+        stale = self.client.get('/api/get_reviews?id=1').get_json()[1]
+        self.assertNotIn('sentiment_version', stale)
+
+    def test_stale_labels_are_queued_once_for_analysis(self):
+        self.service.sentiment_on_write = True
+        self.client.get('/api/get_reviews?id=1')
+        self.client.get('/api/get_reviews?ids=1')
+        queued = []
+        while not self.service.sentiment_queue.empty():
+            queued.append(self.service.sentiment_queue.get_nowait())
+        self.assertEqual(queued, [('stale', 'Slow service')])
+
+
+if __name__ == '__main__':
+    unittest.main()
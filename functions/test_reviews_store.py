@@ -0,0 +1,181 @@
+"""Tests of the reviews stores; run with `python -m pytest functions` or `python -m unittest`"""
+import os
+import tempfile
+import threading
+import unittest
+from collections import Counter
+from reviews_store import CloudantReviewStore, InvalidBookmark, SQLiteReviewStore, count_keys, parse_search
+
+
+def review(dealership, text, review_id=None, **fields):
+    document = dict({'dealership': dealership, 'name': 'Reviewer', 'review': text, 'purchase': False}, **fields)
+    if review_id is not None:
+        document['_id'] = review_id
+    return document
+
+
+class SQLiteReviewStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.store = SQLiteReviewStore(os.path.join(directory.name, 'reviews.sqlite3'))
+
+    def test_create_many_reports_each_id(self):
+        statuses = self.store.create_many([review(1, 'Great service', 'a'), review(1, 'Slow service', 'b'),
+                                           review(1, 'Great service', 'a')])
+        self.assertEqual(statuses, {'a': 'stored', 'b': 'stored'})
+        statuses = self.store.create_many([review(1, 'Posted again', 'a'), review(2, 'New one', 'c')])
+        self.assertEqual(statuses, {'a': 'conflict', 'c': 'stored'})
+        self.assertEqual([doc['review'] for doc in self.store.iter_reviews(1)], ['Great service', 'Slow service'])
+
+    def test_pages_follow_bookmarks(self):
+        self.store.create_many([review(dealership, 'Review {}'.format(number))
+                                for number in range(25) for dealership in (1, 2)])
+        texts, bookmark = [], None
+        while True:
+            page, bookmark = self.store.query_page(1, 10, bookmark)
+            texts.extend(doc['review'] for doc in page)
+            if bookmark is None:
+                break
+        self.assertEqual(texts, ['Review {}'.format(number) for number in range(25)])
+        self.assertEqual(self.store.query_page(3, 10), ([], None))
+
+    def test_rejects_foreign_bookmarks(self):
+        for bookmark in ('zz', '-5', '1.5', ' 3'):
+            with self.subTest(bookmark=bookmark), self.assertRaises(InvalidBookmark):
+                self.store.query_page(1, 10, bookmark)
+
+    def test_reviews_by_dealership(self):
+        self.store.create_many([review(dealership, 'Review {}'.format(number))
+                                for number in range(5) for dealership in (1, 2)])
+        grouped = self.store.reviews_by_dealership([2, 1, 3], 3)
+        self.assertEqual(list(grouped), [2, 1, 3])
+        self.assertEqual([doc['review'] for doc in grouped[1]], ['Review 0', 'Review 1', 'Review 2'])
+        self.assertEqual(grouped[3], [])
+
+    def test_summaries_follow_writes(self):
+        self.store.create_many([review(1, 'Nice', 'a', purchase=True, car_make='Audi'),
+                                review(1, 'Fine', 'b', purchase=True, car_make='BMW'),
+                                review(1, 'Meh', 'c')])
+        self.store.update('c', {'sentiment': 'neutral'})
+        self.store.update('b', {'car_make': 'Audi'})
+        summary, empty = self.store.summaries([1, 2])
+        self.assertEqual(summary['reviews'], 3)
+        self.assertEqual(summary['purchases'], 2)
+        self.assertEqual(summary['sentiment'], {'neutral': 1})
+        self.assertEqual(summary['top_makes'], [{'make': 'Audi', 'reviews': 2}])
+        self.assertEqual(empty['reviews'], 0)
+
+    def test_search_follows_updates(self):
+        self.store.create_many([review(1, 'Reliable car and friendly staff', 'a', car_make='Audi'),
+                                review(2, 'Unreliable paperwork', 'b')])
+        self.assertEqual([doc['_id'] for doc in self.store.search(parse_search('reliab*'))], ['a'])
+        self.assertEqual([doc['_id'] for doc in self.store.search(parse_search('audi staff'), 1)], ['a'])
+        self.assertEqual(self.store.search(parse_search('audi'), 2), [])
+        self.store.update('a', {'review': 'Pushy staff'})
+        self.assertEqual(self.store.search(parse_search('reliable')), [])
+        self.assertEqual([doc['_id'] for doc in self.store.search(parse_search('pushy'))], ['a'])
+
+
+class FakeCloudantDatabase:
+    """Answers the Cloudant queries of CloudantReviewStore from a list of documents, counting those read"""
+
+    def __init__(self, docs):
+        self.docs = sorted(docs, key=lambda doc: (doc['dealership'], doc['_id']))
+        self.queries = []
+        self.read = 0
+        self._lock = threading.Lock()
+
+    def get_query_result(self, selector, raw_result=False, limit=None, use_index=None, bookmark=None):
+        # The dealership index returns a dealership's reviews by _id; bookmarks here are offsets
+        dealership_id = selector['dealership']['$eq']
+        matching = [doc for doc in self.docs if doc['dealership'] == dealership_id]
+        offset = int(bookmark or 0)
+        page = matching[offset:offset + limit]
+        with self._lock:
+            self.queries.append((dealership_id, limit))
+            self.read += len(page)
+        return {'docs': page, 'bookmark': str(offset + len(page))}
+
+
+class FakeCloudantSession:
+    """Answers multi-query requests to the summary view, whose map function emits count_keys()"""
+
+    def __init__(self, docs):
+        self.counts = Counter((doc['dealership'], kind, key) for doc in docs for kind, key in count_keys(doc))
+        self.requests = []
+
+    def post(self, url, json):
+        self.requests.append(url)
+        results = [{'rows': [{'key': list(key), 'value': count} for key, count in sorted(self.counts.items())
+                             if key[0] == query['startkey'][0]]}
+                   for query in json['queries']]
+        return FakeResponse({'results': results})
+
+
+class FakeResponse:
+
+    def __init__(self, body):
+        self.body = body
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+
+class FakeCloudantClient(dict):
+
+    def __init__(self, db, session):
+        super().__init__(reviews=db)
+        self.r_session = session
+
+
+class FakeCloudantStore(CloudantReviewStore):
+
+    def ensure_indexes(self):
+        pass
+
+
+class CloudantReviewStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.docs = [dict(review(dealership, 'Review {:03}'.format(number), 'r{}-{:03}'.format(dealership, number)))
+                     for dealership in (1, 2, 3) for number in range(100 * dealership)]
+        for number, doc in enumerate(self.docs):
+            doc.update(purchase=number % 3 == 0, car_make=('Audi', 'BMW', 'Kia', 'Ford')[number % 4],
+                       sentiment=('positive', 'negative')[number % 2])
+        self.db = FakeCloudantDatabase(self.docs)
+        self.db.database_url = 'https://cloudant.example/reviews'
+        self.session = FakeCloudantSession(self.docs)
+        self.store = FakeCloudantStore(FakeCloudantClient(self.db, self.session))
+
+    def test_reviews_by_dealership_reads_one_page_per_dealership(self):
+        grouped = self.store.reviews_by_dealership([3, 1, 4], 5)
+        # Each dealership costs its page, not every review it has
+        self.assertEqual(sorted(self.db.queries), [(1, 5), (3, 5), (4, 5)])
+        self.assertEqual(self.db.read, 10)
+        self.assertEqual(list(grouped), [3, 1, 4])
+        self.assertEqual([doc['review'] for doc in grouped[3]], ['Review {:03}'.format(number) for number in range(5)])
+        self.assertEqual(grouped[1], self.store.query_page(1, 5)[0])
+        self.assertEqual(grouped[4], [])
+
+
+    def test_summaries_take_one_request(self):
+        summaries = self.store.summaries([2, 9, 1])
+        self.assertEqual(self.session.requests,
+                         ['https://cloudant.example/reviews/_design/review-summaries/_view/counts/queries'])
+        self.assertEqual([summary['dealership'] for summary in summaries], [2, 9, 1])
+        self.assertEqual(summaries[1]['reviews'], 0)
+        # The same aggregates as the SQLite store keeps for the same reviews
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        sqlite = SQLiteReviewStore(os.path.join(directory.name, 'reviews.sqlite3'))
+        sqlite.create_many(self.docs)
+        self.assertEqual(summaries, sqlite.summaries([2, 9, 1]))
+
+
+if __name__ == '__main__':
+    unittest.main()
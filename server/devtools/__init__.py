@@ -0,0 +1,3 @@
+"""
+Development and test helpers; not used by the application at runtime.
+"""
@@ -0,0 +1,363 @@
+"""
+Local stand-ins for the upstream microservices.
+
+They serve the seed data in `cloudant/data`, optionally scaled up to any
+number of dealers and reviews, over plain HTTP so the benchmark commands can
+run without Cloudant or IBM Cloud credentials. `nlu_routes` stands in for
+both Natural Language Understanding and the IAM token service.
+"""
+import itertools
+import json
+import threading
+import time
+import zlib
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from django.conf import settings
+from djangoapp.geo import haversine_km
+
+DATA_DIR = settings.BASE_DIR.parent / 'cloudant' / 'data'
+
+
+def load_seed(name):
+    """
+    Load one of the `cloudant/data/*.json` seed files and return its document list.
+    """
+    with open(DATA_DIR / '{}.json'.format(name), encoding='utf-8') as seed:
+        data = json.load(seed)
+    return data[name.split('-')[0]]
+
+
+def scale_dealers(dealers, count):
+    """
+    Return `count` dealers cycled from `dealers`, with ids 1 to `count`.
+    """
+    return [dict(dealer, id=number + 1)
+            for number, dealer in zip(range(count), itertools.cycle(dealers))]
+
+
+def scale_reviews(reviews, dealer_count, per_dealer):
+    """
+    Return `per_dealer` reviews for each of `dealer_count` dealers, cycled from `reviews`.
+
+    Every text is unique, so sentiment caching sees a realistic miss rate.
+    """
+    scaled = []
+    source = itertools.cycle(reviews)
+    for dealer_id in range(1, dealer_count + 1):
+        for _ in range(per_dealer):
+            review = next(source)
+            number = len(scaled) + 1
+            scaled.append(dict(review, id=number, dealership=dealer_id,
+                               review='{} (#{})'.format(review['review'], number)))
+    return scaled
+
+
+def summarize_reviews(dealer_id, reviews):
+    """
+    Build the summary the reviews service keeps for a dealer with `reviews`.
+    """
+    purchased = [review for review in reviews if review.get('purchase')]
+    makes = Counter(review['car_make'] for review in purchased if review.get('car_make'))
+    return {
+        'dealership': dealer_id,
+        'reviews': len(reviews),
+        'purchases': len(purchased),
+        'purchase_ratio': round(len(purchased) / len(reviews), 3) if reviews else None,
+        'sentiment': dict(Counter(review['sentiment'] for review in reviews if review.get('sentiment'))),
+        'top_makes': [{'make': make, 'reviews': count}
+                      for make, count in sorted(makes.items(), key=lambda item: (-item[1], item[0]))[:3]],
+    }
+
+
+def paginate(documents, query):
+    """
+    Cut one page out of `documents` the way the microservices do, with an X-Bookmark header.
+
+    Raises ValueError, answered with a 400, for a bookmark that is not the offset of a page.
+    """
+    limit = int(query.get('limit', 25))
+    bookmark = query.get('bookmark') or '0'
+    if not bookmark.isascii() or not bookmark.isdigit():
+        raise ValueError(bookmark)
+    offset = int(bookmark)
+    page = documents[offset:offset + limit]
+    headers = {}
+    if len(page) == limit and offset + limit < len(documents):
+        headers['X-Bookmark'] = str(offset + limit)
+    return page, headers
+
+
+class _StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 drops connections under benchmark concurrency
+    request_queue_size = 1024
+
+
+class StubUpstream:
+    """
+    A threaded HTTP server answering requests from a route table.
+
+    GET routes are keyed by path and called with the parsed query string; POST
+    routes are keyed by `"POST <path>"` and called with the query string and
+    the decoded JSON body (None for other bodies). Both return a
+    `(status, payload)` tuple; the payload is sent as JSON, or as is when it is
+    `bytes`. Every response is delayed by `latency` seconds to imitate a remote
+    service.
+    """
+
+    def __init__(self, routes, latency=0.0):
+        self.routes = routes
+        self.latency = latency
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            """
+            Keep-alive request handler dispatching to the stub's routes.
+            """
+            protocol_version = 'HTTP/1.1'
+            disable_nagle_algorithm = True
+
+            def do_GET(self):  # pylint: disable=invalid-name
+                self._dispatch('GET')
+
+            def do_POST(self):  # pylint: disable=invalid-name
+                self._dispatch('POST')
+
+            def _dispatch(self, method):
+                parts = urlsplit(self.path)
+                query = {key: values[-1] for key, values in parse_qs(parts.query).items()}
+                arguments = (query,)
+                if method == 'POST':
+                    # Always read the body, so the kept-alive connection stays in step
+                    body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                    try:
+                        arguments = (query, json.loads(body))
+                    except ValueError:
+                        arguments = (query, None)
+                route = stub.routes.get(parts.path if method == 'GET' else method + ' ' + parts.path)
+                if stub.latency:
+                    time.sleep(stub.latency)
+                if route is None:
+                    status, payload = 404, {"error": "Not found"}
+                else:
+                    status, payload = route(*arguments)
+                headers = {}
+                if method == 'GET' and status == 200 and isinstance(payload, list):
+                    try:
+                        payload, headers = paginate(payload, query)
+                    except ValueError:
+                        status, payload = 400, {"error": "Invalid bookmark"}
+                body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+                pass
+
+        return Handler
+
+    def start(self):
+        self.server = _StubServer(('127.0.0.1', 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def dealerships_routes(count=None):
+    """
+    Routes imitating the Node dealership service (`functions/get-dealership.js`).
+
+    Serves the seed dealerships, or `count` dealers cycled from them.
+    """
+    dealers = load_seed('dealerships')
+    if count:
+        dealers = scale_dealers(dealers, count)
+    by_id = {dealer['id']: dealer for dealer in dealers}
+    by_state = {}
+    for dealer in dealers:
+        by_state.setdefault(dealer['state'], []).append(dealer)
+
+    def get_dealerships(query):
+        if 'ids' in query:
+            found = (by_id.get(int(value)) for value in query['ids'].split(','))
+            return 200, {str(dealer['id']): dealer for dealer in found if dealer}
+        docs = by_state.get(query['state'], []) if 'state' in query else dealers
+        if 'id' in query:
+            dealer = by_id.get(int(query['id']))
+            docs = [dealer] if dealer in docs else []
+        return 200, docs
+
+    def near_dealerships(query):
+        lat, lon = float(query['lat']), float(query['long'])
+        radius_km = float(query['radius']) if 'radius' in query else None
+        found = sorted((dict(dealer, distance=haversine_km(lat, lon, dealer['lat'], dealer['long']))
+                        for dealer in dealers), key=lambda dealer: dealer['distance'])
+        return 200, [dealer for dealer in found
+                     if radius_km is None or dealer['distance'] <= radius_km][:int(query.get('limit', 10))]
+
+    return {'/dealerships/get': get_dealerships, '/dealerships/near': near_dealerships}
+
+
+def reviews_routes(dealer_count=None, per_dealer=None):
+    """
+    Routes imitating the Flask reviews service (`functions/get-reviews.py`).
+
+    Serves the seed reviews, or `per_dealer` reviews for each of `dealer_count` dealers.
+    """
+    reviews = load_seed('reviews-full')
+    if dealer_count and per_dealer:
+        reviews = scale_reviews(reviews, dealer_count, per_dealer)
+    by_dealer = {}
+    for review in reviews:
+        by_dealer.setdefault(review['dealership'], []).append(review)
+    posted = itertools.count(1)
+    summaries = {dealer_id: summarize_reviews(dealer_id, dealer_reviews)
+                 for dealer_id, dealer_reviews in by_dealer.items()}
+
+    def review_summaries(query):
+        if not query.get('ids'):
+            return 400, {"error": "Missing 'ids' parameter in the URL"}
+        dealer_ids = [int(value) for value in query['ids'].split(',')]
+        return 200, [summaries.get(dealer_id) or summarize_reviews(dealer_id, [])
+                     for dealer_id in dealer_ids]
+
+    def get_reviews(query):
+        if 'ids' in query:
+            limit = int(query.get('limit', 25))
+            return 200, {value: by_dealer.get(int(value), [])[:limit] for value in query['ids'].split(',')}
+        if 'id' not in query:
+            return 400, {"error": "Missing 'id' parameter in the URL"}
+        return 200, by_dealer.get(int(query['id']), [])
+
+    def post_review(query, review):
+        if not isinstance(review, dict):
+            return 400, {"error": "Invalid JSON data"}
+        # Posted reviews are acknowledged but not stored, so every run sees the same data
+        return 201, {"message": "Review posted successfully", "id": "stub-{}".format(next(posted))}
+
+    def post_reviews(query, reviews):
+        if not isinstance(reviews, list):
+            return 400, {"error": "Expected a JSON array of reviews"}
+        return 201, {"message": "Reviews posted successfully", "created": len(reviews),
+                     "results": {review.get('_id', str(number)): 'stored' for number, review in enumerate(reviews)}}
+
+    return {'/api/get_reviews': get_reviews, '/api/review_summaries': review_summaries,
+            'POST /api/post_review': post_review, 'POST /api/post_reviews': post_reviews}
+
+
+class ChangesFeed:
+    """
+    An in-memory stand-in for the CouchDB/Cloudant `_changes` feeds of some databases.
+
+    `record()` stores a document revision; `routes()` serves
+    `/<database>/_changes` with the `since`, `limit`, `feed` (normal or
+    longpoll), `timeout` and `include_docs` parameters. As in CouchDB, only a
+    document's latest change is listed, and a longpoll with nothing to report
+    waits for the next change.
+    """
+
+    def __init__(self, databases):
+        self._changes = {database: [] for database in databases}
+        self._revisions = Counter()
+        self._sequence = itertools.count(1)
+        self._condition = threading.Condition()
+
+    def record(self, database, doc, deleted=False):
+        """
+        Store a new revision of `doc` (which must have an `_id`) in `database`; return its change.
+        """
+        with self._condition:
+            self._revisions[database, doc['_id']] += 1
+            rev = '{}-stub'.format(self._revisions[database, doc['_id']])
+            doc = {'_id': doc['_id'], '_rev': rev, '_deleted': True} if deleted else dict(doc, _rev=rev)
+            change = {'seq': '{}-stub'.format(next(self._sequence)), 'id': doc['_id'],
+                      'changes': [{'rev': rev}], 'doc': doc}
+            if deleted:
+                change['deleted'] = True
+            changes = self._changes[database]
+            changes[:] = [other for other in changes if other['id'] != doc['_id']] + [change]
+            self._condition.notify_all()
+            return change
+
+    @staticmethod
+    def _number(seq):
+        return int(str(seq).split('-', 1)[0])
+
+    def _last_seq(self):
+        return '{}-stub'.format(max([self._number(change['seq']) for changes in self._changes.values()
+                                     for change in changes], default=0))
+
+    def routes(self):
+        def changes_of(database):
+            def changes(query):
+                with self._condition:
+                    since = self._last_seq() if query.get('since') == 'now' else query.get('since', '0')
+                    limit = int(query.get('limit', 1000))
+
+                    def pending():
+                        return [change for change in self._changes[database]
+                                if self._number(change['seq']) > self._number(since)]
+                    if not pending() and query.get('feed') == 'longpoll':
+                        self._condition.wait_for(pending, int(query.get('timeout', 60000)) / 1000)
+                    found = pending()
+                    results = [change if query.get('include_docs') == 'true'
+                               else {key: value for key, value in change.items() if key != 'doc'}
+                               for change in found[:limit]]
+                    last_seq = results[-1]['seq'] if results else since
+                    return 200, {'results': results, 'last_seq': last_seq,
+                                 'pending': max(len(found) - limit, 0)}
+            return changes
+        return {'/{}/_changes'.format(database): changes_of(database) for database in self._changes}
+
+
+def nlu_routes():
+    """
+    Routes imitating Watson Natural Language Understanding and the IAM token service.
+
+    Point both NLU_URL and NLU_IAM_URL at the stub. The sentiment label is
+    derived from a checksum of the text, so it is stable from run to run.
+    """
+    import jwt  # pylint: disable=import-outside-toplevel
+    labels = ('positive', 'neutral', 'negative')
+
+    def token(query, body):
+        now = int(time.time())
+        access_token = jwt.encode({'iat': now, 'exp': now + 3600}, 'local-stub-signing-key-not-a-secret',
+                                  algorithm='HS256')
+        if isinstance(access_token, bytes):
+            access_token = access_token.decode('ascii')
+        return 200, {'access_token': access_token, 'refresh_token': 'stub', 'token_type': 'Bearer',
+                     'expires_in': 3600, 'expiration': now + 3600}
+
+    def analyze(query, body):
+        text = (body or {}).get('text', '')
+        label = labels[zlib.crc32(text.encode('utf-8')) % len(labels)]
+        return 200, {'language': 'en', 'sentiment': {'document': {'score': 0.0, 'label': label}}}
+
+    return {'POST /identity/token': token, 'POST /v1/analyze': analyze}
@@ -2,7 +2,7 @@
 Defines the admin interface for the models in the app
 """
 from django.contrib import admin
-from .models import CarMake, CarModel
+from .models import CarMake, CarModel, ReviewOutbox
 
 # Register models
 admin.site.register(CarMake)
@@ -31,3 +31,12 @@ class CarMakeAdmin(admin.ModelAdmin):
     It includes the `CarModelInline` inline model for managing related CarModel objects.
     """
     inlines = [CarModelInline]
+
+@admin.register(ReviewOutbox)
+class ReviewOutboxAdmin(admin.ModelAdmin):
+    """
+    Admin class for inspecting the reviews waiting to be sent to the reviews service.
+    """
+    list_display = ('key', 'dealer_id', 'created', 'attempts', 'next_attempt')
+    list_filter = ('attempts',)
+    ordering = ('next_attempt',)
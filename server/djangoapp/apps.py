@@ -9,3 +9,7 @@ class DjangoappConfig(AppConfig):
     AppConfig class for the 'djangoapp' app.
     """
     name = 'djangoapp'
+
+    def ready(self):
+        # Connect the cache invalidation signal handlers
+        from . import signals  # pylint: disable=import-outside-toplevel,unused-import
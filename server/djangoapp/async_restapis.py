@@ -0,0 +1,354 @@
+"""
+Asynchronous counterparts of the functions in `restapis`, for the ASGI entry point.
+
+Every coroutine shares one pooled `httpx.AsyncClient` per event loop, so a single
+worker can keep hundreds of upstream requests in flight. Parsing, the dealership
+catalog and the sentiment cache are shared with the synchronous layer.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import weakref
+import httpx
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from . import restapis
+from .caching import sentiment_cache
+from .instrumentation import track_upstream, upstream_service
+from .models import CarDealer, DealerReview, DealerReviewSummary
+from .resilience import get_breaker, mark_degraded, remaining, upstream_timeout
+from .restapis import (CATALOG_BOOKMARK_PREFIX, SENTIMENT_PENDING, dealer_catalog, get_nlu_client,
+                       id_chunks)
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+_clients = weakref.WeakKeyDictionary()
+
+# Strong references to the analyses still running after their batch gave up on them
+_late_analyses = set()
+
+
+def get_async_client():
+    """
+    Return the AsyncClient bound to the running event loop, creating it on first use.
+
+    Connection failures are retried by the transport; httpx never retries once a
+    request has been sent.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        limits = httpx.Limits(max_connections=settings.ASYNC_UPSTREAM_MAX_CONNECTIONS,
+                              max_keepalive_connections=settings.UPSTREAM_POOL_SIZE)
+        timeout = httpx.Timeout(settings.UPSTREAM_READ_TIMEOUT,
+                                connect=settings.UPSTREAM_CONNECT_TIMEOUT)
+        transport = httpx.AsyncHTTPTransport(retries=settings.UPSTREAM_RETRIES, limits=limits)
+        client = httpx.AsyncClient(transport=transport, timeout=timeout,
+                                   headers={'Content-Type': 'application/json'})
+        _clients[loop] = client
+    return client
+
+
+def _parse_json(response):
+    logger.debug("With status %s", response.status_code)
+    try:
+        return response.json()
+    except ValueError:
+        logger.warning("Invalid JSON from %s (status %s)", response.url, response.status_code)
+        return None
+
+
+async def _send(method, url, service=None, **kwargs):
+    """
+    Send one request to an upstream service through its circuit breaker; see `restapis._send`.
+    """
+    service = service or upstream_service(url)
+    breaker = get_breaker(service)
+    timeout = upstream_timeout(settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_READ_TIMEOUT)
+    if timeout is None or not breaker.allow():
+        logger.warning("Skipping %s %s: %s", method, url,
+                       "request deadline exceeded" if timeout is None else "circuit open")
+        mark_degraded(service)
+        return None
+    connect, read = timeout
+    try:
+        with track_upstream(service):
+            response = await get_async_client().request(
+                method, url, timeout=httpx.Timeout(read, connect=connect), **kwargs)
+    except httpx.HTTPError as err:
+        logger.error("Network exception occurred on %s %s: %s", method, url, err)
+        breaker.record_failure()
+        mark_degraded(service)
+        return None
+    if response.status_code >= 500:
+        breaker.record_failure()
+        mark_degraded(service)
+    else:
+        breaker.record_success()
+    return response
+
+
+async def _get(url, params):
+    logger.debug("GET from %s %s", url, params)
+    return await _send('GET', url, params=params)
+
+
+async def get_request(url, **kwargs):
+    """
+    GET `url` with `kwargs` as query parameters and return the decoded JSON body, or None.
+    """
+    response = await _get(url, kwargs)
+    return None if response is None else _parse_json(response)
+
+
+async def get_page(url, **kwargs):
+    """
+    GET one page of a paginated listing; returns the JSON body and the next page's bookmark.
+    """
+    response = await _get(url, kwargs)
+    if response is None or not restapis.check_page_response(response, kwargs.get('bookmark')):
+        return None, None
+    return _parse_json(response), response.headers.get('X-Bookmark')
+
+
+async def post_request(json_payload, **kwargs):
+    url = settings.REVIEWS_SERVICE_URL + "/api/post_review"
+    response = await _send('POST', url, service='reviews', params=kwargs, json=json_payload)
+    if response is None:
+        return None
+    return _parse_json(response)
+
+
+async def get_dealers_from_cf(**kwargs):
+    """
+    Return CarDealer objects, optionally filtered by `dealer_id` or `state`.
+    """
+    if settings.DEALER_CATALOG_ENABLED and await sync_to_async(dealer_catalog.is_loaded,
+                                                               thread_sensitive=False)():
+        if 'dealer_id' in kwargs:
+            dealer = dealer_catalog.get(kwargs['dealer_id'])
+            return [dealer] if dealer else []
+        if 'state' in kwargs:
+            return dealer_catalog.by_state(kwargs['state'])
+        return dealer_catalog.all()
+
+    params = {'limit': settings.MAX_PAGE_SIZE}
+    if 'dealer_id' in kwargs:
+        params['id'] = kwargs['dealer_id']
+    elif 'state' in kwargs:
+        params['state'] = kwargs['state']
+    dealers = []
+    while True:
+        page, bookmark = await get_page(settings.DEALERSHIPS_SERVICE_URL + "/dealerships/get", **params)
+        dealers.extend(CarDealer.from_json_list(page or []))
+        if not page or not bookmark:
+            return dealers
+        params['bookmark'] = bookmark
+
+
+async def get_dealers_page_from_cf(state=None, page_size=None, bookmark=None):
+    """
+    Return one page of dealerships, optionally in `state`, and the next page's bookmark.
+    """
+    catalog_bookmark = not bookmark or bookmark.startswith(CATALOG_BOOKMARK_PREFIX)
+    if settings.DEALER_CATALOG_ENABLED and catalog_bookmark:
+        if await sync_to_async(dealer_catalog.is_loaded, thread_sensitive=False)():
+            # The catalog is in memory, so paging it needs no network round trip
+            return restapis.catalog_page(state, page_size or settings.DEALERS_PAGE_SIZE, bookmark)
+
+    params = {'limit': page_size or settings.DEALERS_PAGE_SIZE}
+    if state:
+        params['state'] = state
+    if bookmark and not bookmark.startswith(CATALOG_BOOKMARK_PREFIX):
+        params['bookmark'] = bookmark
+    page, next_bookmark = await get_page(settings.DEALERSHIPS_SERVICE_URL + "/dealerships/get", **params)
+    return CarDealer.from_json_list(page or []), next_bookmark
+
+
+async def get_dealer_by_id_from_cf(dealer_id):
+    dealers = await get_dealers_from_cf(dealer_id=dealer_id)
+    return dealers[0] if dealers else None
+
+
+async def get_dealers_by_ids_from_cf(dealer_ids):
+    """
+    Asynchronous variant of `restapis.get_dealers_by_ids_from_cf`; chunks of ids are fetched concurrently.
+    """
+    if settings.DEALER_CATALOG_ENABLED and await sync_to_async(dealer_catalog.is_loaded,
+                                                               thread_sensitive=False)():
+        return restapis.catalog_dealers_by_ids(dealer_ids)
+    url = settings.DEALERSHIPS_SERVICE_URL + "/dealerships/get"
+    json_results = await asyncio.gather(*(get_request(url, ids=",".join(map(str, chunk)))
+                                          for chunk in id_chunks(dealer_ids, settings.MAX_PAGE_SIZE)))
+    return {dealer.id: dealer for json_result in json_results if isinstance(json_result, dict)
+            for dealer in CarDealer.from_json_list(json_result.values())}
+
+
+async def get_dealers_near(lat, lon, count, radius_km=None):
+    """
+    Asynchronous variant of `restapis.get_dealers_near`.
+    """
+    if settings.DEALER_CATALOG_ENABLED and await sync_to_async(dealer_catalog.is_loaded,
+                                                               thread_sensitive=False)():
+        return dealer_catalog.nearest(lat, lon, count, radius_km)
+    params = {'lat': lat, 'long': lon, 'limit': count}
+    if radius_km is not None:
+        params['radius'] = radius_km
+    json_result = await get_request(settings.DEALERSHIPS_SERVICE_URL + "/dealerships/near", **params)
+    if not isinstance(json_result, list):
+        return []
+    return [(CarDealer.from_json(document), document['distance']) for document in json_result]
+
+
+async def analyze_review_sentiments(text, client=None):
+    """
+    Return the sentiment label of `text` from the NLU REST API, or None on failure.
+
+    The bearer token comes from the process-wide NLU client, whose authenticator
+    caches it; only a token exchange runs on a thread.
+    """
+    client = client or await sync_to_async(get_nlu_client, thread_sensitive=False)()
+    if client is None:
+        return None
+    breaker = get_breaker('nlu')
+    try:
+        token = await sync_to_async(client.authenticator.token_manager.get_token,
+                                    thread_sensitive=False)()
+        with track_upstream('nlu'):
+            response = await get_async_client().post(
+                os.environ['NLU_URL'].rstrip('/') + '/v1/analyze',
+                params={'version': settings.NLU_VERSION},
+                headers={'Authorization': 'Bearer ' + token},
+                json={'text': text, 'language': 'en',
+                      'features': {'sentiment': {'targets': [text]}}})
+        response.raise_for_status()
+        label = response.json()['sentiment']['document']['label']
+    except (httpx.HTTPError, ValueError, KeyError) as err:
+        logger.error("Sentiment analysis failed: %s", err)
+        breaker.record_failure()
+        return None
+    breaker.record_success()
+    return label
+
+
+async def _cache_late_label(text, task):
+    label = await task
+    if label is not None:
+        await sync_to_async(sentiment_cache.set, thread_sensitive=False)(text, label)
+
+
+def _finish_in_background(text, task):
+    finishing = asyncio.ensure_future(_cache_late_label(text, task))
+    _late_analyses.add(finishing)
+    finishing.add_done_callback(_late_analyses.discard)
+
+
+async def analyze_review_sentiments_batch(texts, timeout=None):
+    """
+    Analyze review texts concurrently and return their labels in the same order.
+
+    At most `settings.NLU_MAX_WORKERS` NLU requests run at once; labels not ready
+    after `timeout` seconds, capped by the request's deadline, are
+    `SENTIMENT_PENDING` and cached once they arrive. While the NLU circuit is
+    open or the deadline is spent, uncached texts get no label.
+    """
+    if not texts:
+        return []
+    labels = await sync_to_async(sentiment_cache.get_many, thread_sensitive=False)(texts)
+    missing = set(texts) - set(labels)
+    client = await sync_to_async(get_nlu_client, thread_sensitive=False)()
+    if missing and client is not None:
+        if timeout is None:
+            timeout = settings.NLU_BATCH_TIMEOUT
+        left = remaining()
+        if left is not None:
+            timeout = min(timeout, left)
+        if timeout <= 0 or not get_breaker('nlu').allow():
+            mark_degraded('nlu')
+            return [labels.get(text) for text in texts]
+        semaphore = asyncio.Semaphore(settings.NLU_MAX_WORKERS)
+
+        async def analyze(text):
+            async with semaphore:
+                return await analyze_review_sentiments(text, client)
+
+        tasks = {text: asyncio.ensure_future(analyze(text)) for text in missing}
+        await asyncio.wait(tasks.values(), timeout=timeout)
+        computed = {}
+        for text, task in tasks.items():
+            if task.done():
+                labels[text] = computed[text] = task.result()
+            else:
+                # Let a late answer still warm the cache for the next visit
+                _finish_in_background(text, task)
+                labels[text] = SENTIMENT_PENDING
+        await sync_to_async(sentiment_cache.set_many, thread_sensitive=False)(
+            {text: label for text, label in computed.items() if label is not None})
+    return [labels.get(text) for text in texts]
+
+
+async def get_dealer_reviews_page_from_cf(dealer_id, page_size=None, bookmark=None):
+    """
+    Return one page of a dealer's reviews, labelled with sentiment, and the next page's bookmark.
+    """
+    params = {'id': dealer_id, 'limit': page_size or settings.REVIEWS_PAGE_SIZE}
+    if bookmark:
+        params['bookmark'] = bookmark
+    json_result, next_bookmark = await get_page(settings.REVIEWS_SERVICE_URL + "/api/get_reviews",
+                                                **params)
+    return await _label_sentiments(DealerReview.from_json_list(json_result or [])), next_bookmark
+
+
+async def _label_sentiments(results):
+    unlabelled = [index for index, review_obj in enumerate(results) if review_obj.sentiment is None]
+    labels = await analyze_review_sentiments_batch([results[index].review for index in unlabelled])
+    for index, label in zip(unlabelled, labels):
+        results[index] = results[index]._replace(sentiment=label)
+    return results
+
+
+async def get_dealer_reviews_from_cf(dealer_id, page_size=None, bookmark=None):
+    return (await get_dealer_reviews_page_from_cf(dealer_id, page_size, bookmark))[0]
+
+
+async def get_dealer_reviews_batch_from_cf(dealer_ids, page_size=None):
+    """
+    Asynchronous variant of `restapis.get_dealer_reviews_batch_from_cf`; chunks of ids are fetched concurrently.
+    """
+    url = settings.REVIEWS_SERVICE_URL + "/api/get_reviews"
+    limit = page_size or settings.REVIEWS_PAGE_SIZE
+    json_results = await asyncio.gather(*(get_request(url, ids=",".join(map(str, chunk)), limit=limit)
+                                          for chunk in id_chunks(dealer_ids, settings.MAX_PAGE_SIZE)))
+    grouped = {int(dealer_id): reviews for json_result in json_results if isinstance(json_result, dict)
+               for dealer_id, reviews in json_result.items()}
+    results = iter(await _label_sentiments(DealerReview.from_json_list(
+        [review for reviews in grouped.values() for review in reviews])))
+    return {dealer_id: list(itertools.islice(results, len(reviews))) for dealer_id, reviews in grouped.items()}
+
+
+async def search_reviews(query, dealer_id=None, limit=None):
+    """
+    Asynchronous variant of `restapis.search_reviews`.
+    """
+    params = {'q': query, 'limit': limit or settings.REVIEWS_PAGE_SIZE}
+    if dealer_id is not None:
+        params['id'] = dealer_id
+    json_result = await get_request(settings.REVIEWS_SERVICE_URL + "/api/search_reviews", **params)
+    if not isinstance(json_result, list):
+        return []
+    return DealerReview.from_json_list(json_result)
+
+
+async def get_review_summaries(dealer_ids):
+    """
+    Asynchronous variant of `restapis.get_review_summaries`.
+    """
+    if not dealer_ids:
+        return {}
+    json_result = await get_request(settings.REVIEWS_SERVICE_URL + "/api/review_summaries",
+                                    ids=",".join(map(str, dealer_ids)))
+    if not isinstance(json_result, list):
+        return {}
+    return {summary.dealership: summary for summary in DealerReviewSummary.from_json_list(json_result)}
@@ -0,0 +1,270 @@
+"""
+In-process caches shared by the views and the upstream client layer.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import caches
+from .models import CarModel
+
+
+class LRUCache:
+    """
+    A thread-safe, size-bounded mapping that evicts the least recently used entry.
+
+    Attributes:
+        maxsize (int): The number of entries kept before evicting.
+        hits (int): The number of successful lookups.
+        misses (int): The number of failed lookups.
+    """
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SentimentCache:
+    """
+    Two-tier cache of sentiment labels keyed by a hash of the review text and NLU model version.
+
+    Lookups hit the per-process LRU first and fall back to the persistent Django
+    cache named by `settings.SENTIMENT_CACHE_ALIAS`, promoting what they find.
+    """
+
+    def __init__(self, maxsize, alias, version):
+        self.memory = LRUCache(maxsize)
+        self.alias = alias
+        self.version = version
+        self.store_hits = 0
+        self.misses = 0
+
+    @property
+    def store(self):
+        return caches[self.alias]
+
+    def key(self, text):
+        digest = hashlib.sha256('{}\0{}'.format(self.version, text).encode('utf-8')).hexdigest()
+        return 'sentiment:' + digest
+
+    def get_many(self, texts):
+        """
+        Return a dict mapping each cached text in `texts` to its label.
+        """
+        found = {}
+        missing = {}
+        for text in set(texts):
+            key = self.key(text)
+            label = self.memory.get(key)
+            if label is None:
+                missing[key] = text
+            else:
+                found[text] = label
+        if missing:
+            stored = self.store.get_many(list(missing))
+            for key, label in stored.items():
+                self.memory.set(key, label)
+                found[missing[key]] = label
+            self.store_hits += len(stored)
+            self.misses += len(missing) - len(stored)
+        return found
+
+    def get(self, text):
+        return self.get_many([text]).get(text)
+
+    def set_many(self, labels):
+        """
+        Cache the `text -> label` pairs in `labels`.
+        """
+        entries = {self.key(text): label for text, label in labels.items()}
+        for key, label in entries.items():
+            self.memory.set(key, label)
+        if entries:
+            self.store.set_many(entries)
+
+    def set(self, text, label):
+        self.set_many({text: label})
+
+    def stats(self):
+        return {
+            'memory_hits': self.memory.hits,
+            'store_hits': self.store_hits,
+            'misses': self.misses,
+            'memory_size': len(self.memory),
+        }
+
+
+sentiment_cache = SentimentCache(maxsize=settings.SENTIMENT_LRU_SIZE,
+                                 alias=settings.SENTIMENT_CACHE_ALIAS,
+                                 version=settings.NLU_VERSION)
+
+
+class PageCache:
+    """
+    Rendered page fragments grouped into invalidation scopes.
+
+    A scope such as `"index:all"` or `"dealer:15"` carries a generation counter
+    that is part of every key stored under it, so `invalidate(scope)` retires all
+    of the scope's fragments at once. The counter of the scope's family (`"index"`,
+    `"dealer"`) is part of the key too, so invalidating a family retires every
+    scope in it. Each entry records an ETag and modification time for
+    conditional GETs.
+    """
+
+    def __init__(self, alias, timeout, enabled):
+        self.alias = alias
+        self.timeout = timeout
+        self.enabled = enabled
+
+    @property
+    def store(self):
+        return caches[self.alias]
+
+    def generations(self, scopes):
+        """
+        Return the generation counters of `scopes`, starting any missing one at 1.
+        """
+        keys = ['pagegen:' + scope for scope in scopes]
+        found = self.store.get_many(keys)
+        for generation_key in keys:
+            if generation_key not in found:
+                self.store.add(generation_key, 1, timeout=None)
+                found[generation_key] = self.store.get(generation_key, 1)
+        return [found[generation_key] for generation_key in keys]
+
+    def key(self, scope, parts):
+        digest = hashlib.md5(repr(parts).encode('utf-8')).hexdigest()
+        family = scope.split(':', 1)[0]
+        generations = self.generations([family, scope] if family != scope else [scope])
+        return 'page:{}:{}:{}'.format(scope, '.'.join(map(str, generations)), digest)
+
+    def get(self, scope, parts):
+        if not self.enabled:
+            return None
+        return self.store.get(self.key(scope, parts))
+
+    def set(self, scope, parts, content, cacheable=True):
+        """
+        Build the entry for freshly rendered `content` and cache it when `cacheable`.
+        """
+        entry = {
+            'content': str(content),
+            'etag': hashlib.md5(content.encode('utf-8')).hexdigest(),
+            'modified': time.time(),
+        }
+        if self.enabled and cacheable:
+            self.store.set(self.key(scope, parts), entry, timeout=self.timeout)
+        return entry
+
+    def invalidate(self, scope):
+        try:
+            self.store.incr('pagegen:' + scope)
+        except ValueError:
+            # No generation yet means nothing was cached under this scope
+            pass
+
+
+page_cache = PageCache(alias=settings.PAGE_CACHE_ALIAS,
+                       timeout=settings.PAGE_CACHE_TIMEOUT,
+                       enabled=settings.PAGE_CACHE_ENABLED)
+
+
+def invalidate_dealer_pages(dealer_id):
+    page_cache.invalidate('dealer:{}'.format(dealer_id))
+
+
+def invalidate_all_dealer_pages():
+    page_cache.invalidate('dealer')
+
+
+def index_scope(state=None):
+    """
+    Return the page cache scope of the dealership index, listing every state or only `state`.
+    """
+    return 'index:state:' + state.casefold() if state else 'index:all'
+
+
+def invalidate_index_pages():
+    page_cache.invalidate('index')
+
+
+def invalidate_state_pages(states):
+    """
+    Retire the index pages that can list a dealer of `states`: those of each state and the full listing.
+    """
+    page_cache.invalidate(index_scope())
+    for state in set(states):
+        page_cache.invalidate(index_scope(state))
+
+
+def dealerships_generation():
+    """
+    Return the shared counter that `invalidate_dealerships()` increments, for the dealer catalogs to watch.
+
+    Returns None without reading the cache while the page cache is disabled; the
+    catalogs then only reload when their TTL expires.
+    """
+    if not page_cache.enabled:
+        return None
+    return page_cache.generations(['dealerships'])[0]
+
+
+def invalidate_dealerships():
+    page_cache.invalidate('dealerships')
+
+
+def _inventory_key(dealer_id):
+    return 'inventory:{}'.format(int(dealer_id))
+
+
+def get_dealer_inventory(dealer_id):
+    """
+    Return the car models a dealer sells, with their makes, for the add-review form.
+
+    The models come from the inventory cache when present; otherwise one query
+    over the indexed dealerId column joins in the makes and fills the cache.
+    """
+    store = caches[settings.INVENTORY_CACHE_ALIAS]
+    cars = store.get(_inventory_key(dealer_id))
+    if cars is None:
+        cars = list(CarModel.objects.filter(dealerId=dealer_id).select_related('make'))
+        store.set(_inventory_key(dealer_id), cars, timeout=settings.INVENTORY_CACHE_TIMEOUT)
+    return cars
+
+
+def invalidate_dealer_inventory(dealer_ids):
+    caches[settings.INVENTORY_CACHE_ALIAS].delete_many(
+        [_inventory_key(dealer_id) for dealer_id in set(dealer_ids)])
@@ -0,0 +1,141 @@
+"""
+Per-worker catalog of dealerships, indexed for O(1) lookups.
+"""
+import logging
+import threading
+import time
+from .geo import GeoGrid
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class DealershipCatalog:
+    """
+    Holds every dealership in memory with prebuilt indexes by id and by state,
+    and a spatial grid for nearest-dealer and radius queries.
+
+    The catalog loads on first use through `loader`, a callable returning the
+    dealership JSON documents (or None on failure). Once `ttl` seconds have passed
+    the stale data keeps being served while a background thread refreshes it.
+    `invalidate()` drops the data so the next lookup reloads synchronously.
+    A refresh only moves the dealers that changed in the spatial grid.
+
+    `generation`, when given, is a callable returning a counter shared between
+    processes that is bumped whenever the dealerships change. It is checked at
+    most every `sync_interval` seconds, and a new value invalidates the catalog.
+    """
+
+    def __init__(self, loader, build, ttl, generation=None, sync_interval=1.0):
+        self.loader = loader
+        self.build = build
+        self.ttl = ttl
+        self.generation = generation
+        self.sync_interval = sync_interval
+        self.loaded_at = None
+        self._loaded_generation = None
+        self._synced_at = None
+        self._dealers = []
+        self._by_id = {}
+        self._by_state = {}
+        self._state_keys = {}
+        self._geo = GeoGrid()
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._refreshing = False
+
+    def _index(self, documents):
+        dealers = []
+        by_id = {}
+        by_state = {}
+        state_keys = {}
+        for document in documents:
+            dealer = self.build(document)
+            dealers.append(dealer)
+            by_id[dealer.id] = dealer
+            # Index both the full state name and its abbreviation ("Texas" and "TX")
+            keys = {key.casefold() for key in (document.get("state"), document.get("st")) if key}
+            state_keys[dealer.id] = keys
+            for key in keys:
+                by_state.setdefault(key, []).append(dealer)
+        return dealers, by_id, by_state, state_keys
+
+    def refresh(self):
+        """
+        Reload the catalog now; returns False and keeps the current data if loading fails.
+        """
+        try:
+            # Read before loading, so a change made during the load triggers another one
+            generation = self.generation() if self.generation else None
+            documents = self.loader()
+            if documents is None:
+                return False
+            dealers, by_id, by_state, state_keys = self._index(documents)
+        finally:
+            self._refreshing = False
+        with self._lock:
+            self._loaded_generation = generation
+            self._synced_at = time.monotonic()
+            previous = self._by_id
+            self._geo.update(added=[dealer for dealer_id, dealer in by_id.items()
+                                    if previous.get(dealer_id) != dealer],
+                             removed=[dealer for dealer_id, dealer in previous.items()
+                                      if dealer_id not in by_id])
+            self._dealers, self._by_id = dealers, by_id
+            self._by_state, self._state_keys = by_state, state_keys
+            self.loaded_at = time.monotonic()
+        logger.info("Dealership catalog loaded with %d dealers", len(dealers))
+        return True
+
+    def _refresh_in_background(self):
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self.refresh, name='dealer-catalog', daemon=True).start()
+
+    def is_loaded(self):
+        """
+        Make sure the catalog is usable, loading or scheduling a refresh as needed.
+        """
+        if self.generation and self.loaded_at is not None \
+                and time.monotonic() - self._synced_at >= self.sync_interval:
+            self._synced_at = time.monotonic()
+            if self.generation() != self._loaded_generation:
+                logger.info("Dealerships changed; reloading the dealership catalog")
+                self.invalidate()
+        if self.loaded_at is None:
+            with self._load_lock:
+                return self.loaded_at is not None or self.refresh()
+        if time.monotonic() - self.loaded_at > self.ttl:
+            self._refresh_in_background()
+        return True
+
+    def invalidate(self):
+        with self._lock:
+            self.loaded_at = None
+
+    def all(self):
+        return list(self._dealers)
+
+    def get(self, dealer_id):
+        return self._by_id.get(int(dealer_id))
+
+    def by_state(self, state):
+        return list(self._by_state.get(state.casefold(), []))
+
+    def states_of(self, dealer_id):
+        """
+        Return the state keys a dealer is listed under, e.g. `{"texas", "tx"}`.
+        """
+        return set(self._state_keys.get(int(dealer_id), ()))
+
+    def nearest(self, lat, lon, count, radius_km=None):
+        """
+        Return the `count` dealers nearest to a point, optionally within `radius_km`,
+        as `(dealer, distance_km)` pairs, closest first.
+        """
+        return self._geo.nearest(lat, lon, count, radius_km)
+
+    def within(self, lat, lon, radius_km):
+        return self._geo.within(lat, lon, radius_km)
@@ -0,0 +1,259 @@
+"""
+Cache invalidation driven by the `_changes` feeds of the dealerships and reviews databases.
+
+The microservices write straight to Cloudant, and so can any other writer, so
+the Django tier cannot rely on its own writes to learn that cached data went
+stale. `ChangesFollower` reads one database's `_changes` feed and turns each
+batch of changes into the narrowest invalidations covering them:
+
+- a dealership retires its detail pages, the index pages of its state (under
+  both name and abbreviation, before and after the change) and of all
+  states, and every process's dealer catalog;
+- a review retires its dealer's pages and the index pages listing that
+  dealer, which show its review summary.
+
+A change whose affected dealer or states cannot be told, such as a deletion,
+retires the whole family of pages instead. The feed's sequence is
+checkpointed after every batch, so a restarted follower resumes where it
+stopped and at worst applies a batch twice, which is harmless.
+"""
+import json
+import logging
+import os
+import requests
+from django.conf import settings
+from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
+from .caching import (invalidate_all_dealer_pages, invalidate_dealer_pages, invalidate_dealerships,
+                      invalidate_index_pages, invalidate_state_pages)
+from .clients import registry as clients
+from .restapis import dealer_catalog, get_session
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+def _build_couch_authenticator():
+    api_key = os.environ.get('IAM_API_KEY')
+    if not api_key:
+        return None
+    authenticator = IAMAuthenticator(api_key, url=os.environ.get('COUCH_IAM_URL'))
+    clients.track_token_exchanges(authenticator.token_manager)
+    return authenticator
+
+
+clients.register('couch_authenticator', _build_couch_authenticator)
+
+
+class Invalidations:
+    """
+    The cache scopes to retire for a batch of changes, so that each is retired once.
+    """
+
+    def __init__(self):
+        self.dealer_ids = set()
+        self.states = set()
+        self.all_dealers = False
+        self.all_states = False
+        self.dealerships = False
+
+    def dealer(self, dealer_id, states):
+        """
+        Retire a dealer's pages and the index pages of `states`, or of every state when None.
+        """
+        self.dealer_ids.add(dealer_id)
+        if states is None:
+            self.all_states = True
+        else:
+            self.states.update(states)
+
+    def everything(self):
+        self.all_dealers = self.all_states = True
+
+    def apply(self):
+        if self.dealerships:
+            invalidate_dealerships()
+        if self.all_dealers:
+            invalidate_all_dealer_pages()
+        else:
+            for dealer_id in self.dealer_ids:
+                invalidate_dealer_pages(dealer_id)
+        if self.all_states:
+            invalidate_index_pages()
+        elif self.dealer_ids or self.states:
+            invalidate_state_pages(self.states)
+
+
+def known_states(dealer_id):
+    """
+    Return the state keys a dealer was listed under, or None when the dealer catalog cannot tell.
+    """
+    if not (settings.DEALER_CATALOG_ENABLED and dealer_catalog.is_loaded()):
+        return None
+    return dealer_catalog.states_of(dealer_id)
+
+
+def dealership_changed(change, invalidations):
+    invalidations.dealerships = True
+    doc = change.get('doc')
+    if change.get('deleted') or not doc or doc.get('id') is None:
+        # A deleted document keeps only its _id, which is not the dealer id
+        invalidations.everything()
+        return
+    dealer_id = int(doc['id'])
+    states = {key.casefold() for key in (doc.get('state'), doc.get('st')) if key}
+    previous = known_states(dealer_id)
+    if previous is None and not doc.get('_rev', '').startswith('1-'):
+        # An update may have moved the dealer out of a state we cannot name
+        invalidations.dealer(dealer_id, None)
+    else:
+        invalidations.dealer(dealer_id, states | (previous or set()))
+
+
+def review_changed(change, invalidations):
+    doc = change.get('doc')
+    if change.get('deleted') or not doc or doc.get('dealership') is None:
+        invalidations.everything()
+        return
+    dealer_id = int(doc['dealership'])
+    invalidations.dealer(dealer_id, known_states(dealer_id))
+
+
+HANDLERS = {'dealerships': dealership_changed, 'reviews': review_changed}
+
+
+def valid_answer(answer):
+    """
+    Tell whether a `_changes` answer has a `last_seq` and a list of changes that each name their document.
+    """
+    return (isinstance(answer, dict) and 'last_seq' in answer and isinstance(answer.get('results'), list)
+            and all(isinstance(change, dict) and isinstance(change.get('id'), str)
+                    for change in answer['results']))
+
+
+class ChangesFollower:
+    """
+    Follows the `_changes` feed of one database, applying `HANDLERS[database]` to each change.
+
+    Attributes:
+        since (str): The sequence after which the next poll starts.
+    """
+
+    def __init__(self, database, since=None, checkpoint_dir=None):
+        self.database = database
+        self.url = '{}/{}'.format(settings.COUCH_URL.rstrip('/'), database)
+        self.handler = HANDLERS[database]
+        self.checkpoint_path = os.path.join(checkpoint_dir or settings.CHANGES_CHECKPOINT_DIR,
+                                            database + '.json')
+        self.since = since if since is not None else self.load_checkpoint()
+
+    def load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, encoding='utf-8') as checkpoint:
+                state = json.load(checkpoint)
+        except FileNotFoundError:
+            # Nothing to catch up on: whatever is cached now was built from the current data
+            return 'now'
+        if state.get('url') != self.url:
+            logger.warning("Checkpoint %s belongs to %s; starting from now", self.checkpoint_path,
+                           state.get('url'))
+            return 'now'
+        return state['since']
+
+    def save_checkpoint(self):
+        # Write then rename, so a crash never leaves a truncated checkpoint behind
+        os.makedirs(os.path.dirname(self.checkpoint_path), exist_ok=True)
+        temporary = self.checkpoint_path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as checkpoint:
+            json.dump({'url': self.url, 'since': self.since}, checkpoint)
+        os.replace(temporary, self.checkpoint_path)
+
+    def poll(self, feed='longpoll'):
+        """
+        Read the next batch of changes; return the feed's answer, or None on failure.
+
+        A longpoll waits up to `settings.CHANGES_POLL_TIMEOUT` seconds for a change.
+        """
+        params = {'since': self.since, 'include_docs': 'true', 'limit': settings.CHANGES_BATCH_SIZE,
+                  'feed': feed, 'timeout': int(settings.CHANGES_POLL_TIMEOUT * 1000)}
+        headers = {}
+        authenticator = clients.get('couch_authenticator')
+        if authenticator is not None:
+            authenticator.authenticate({'headers': headers})
+        # The read timeout leaves the feed its full wait on top of the usual allowance
+        timeout = (settings.UPSTREAM_CONNECT_TIMEOUT,
+                   settings.CHANGES_POLL_TIMEOUT + settings.UPSTREAM_READ_TIMEOUT)
+        try:
+            response = get_session().get(self.url + '/_changes', params=params, headers=headers,
+                                         timeout=timeout)
+        except requests.exceptions.RequestException as err:
+            logger.error("Reading the changes of %s failed: %s", self.database, err)
+            return None
+        if response.status_code != 200:
+            logger.error("Reading the changes of %s failed with status %s", self.database,
+                         response.status_code)
+            return None
+        try:
+            answer = response.json()
+        except ValueError:
+            logger.error("The changes of %s are not JSON", self.database)
+            return None
+        if not valid_answer(answer):
+            logger.error("Unexpected changes answer from %s: %.200r", self.database, answer)
+            return None
+        return answer
+
+    def process(self, feed='longpoll'):
+        """
+        Apply one batch of changes and checkpoint it; return the number of changes, or None on failure.
+        """
+        answer = self.poll(feed)
+        if answer is None:
+            return None
+        invalidations = Invalidations()
+        for change in answer['results']:
+            if change['id'].startswith('_design/'):
+                continue
+            try:
+                self.handler(change, invalidations)
+            except (TypeError, ValueError):
+                logger.warning("Unexpected document %s in %s", change['id'], self.database)
+                invalidations.everything()
+        invalidations.apply()
+        self.since = answer['last_seq']
+        self.save_checkpoint()
+        if answer['results']:
+            logger.info("Applied %d changes of %s", len(answer['results']), self.database)
+        return len(answer['results'])
+
+    def catch_up(self):
+        """
+        Apply every change made so far, then return the number applied.
+        """
+        applied = 0
+        while True:
+            count = self.process(feed='normal')
+            if count is None:
+                raise RuntimeError('Could not read the changes of ' + self.database)
+            if not count:
+                return applied
+            applied += count
+
+    def follow(self, stop):
+        """
+        Apply changes as they are made until the `stop` event is set, backing off after failures.
+
+        A failure to invalidate, such as an unreachable cache, counts as a failed
+        poll: the batch is not checkpointed, so it is applied again on the next try.
+        """
+        delay = 1
+        while not stop.is_set():
+            try:
+                applied = self.process()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Applying the changes of %s failed", self.database)
+                applied = None
+            if applied is None:
+                stop.wait(delay)
+                delay = min(delay * 2, 60)
+            else:
+                delay = 1
@@ -0,0 +1,113 @@
+"""
+Process-wide registry of the clients used to reach upstream services.
+
+Each client is built lazily by its registered factory the first time it is
+asked for and then reused by every request the process serves, so object
+construction and credential exchange stay off the request path. The registry
+is emptied in a forked child (a gunicorn worker, say), which then builds its
+own clients instead of sharing sockets, locks or threads with its parent.
+"""
+import logging
+import os
+import threading
+from collections import Counter
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class ClientRegistry:
+    """
+    Lazily built, shared clients keyed by name.
+
+    Attributes:
+        token_exchanges (int): The number of IAM token requests made by tracked
+            token managers since the process started.
+    """
+
+    def __init__(self):
+        self._factories = {}
+        self._clients = {}
+        self._constructions = Counter()
+        self._lookups = Counter()
+        self._lock = threading.Lock()
+        self.token_exchanges = 0
+
+    def register(self, name, factory):
+        """
+        Register the zero-argument callable building the client called `name`.
+        """
+        self._factories[name] = factory
+
+    def get(self, name):
+        """
+        Return the client called `name`, building it on first use.
+
+        A factory may return None, for instance when credentials are missing;
+        that answer is kept too, so the factory runs once per process.
+        """
+        self._lookups[name] += 1
+        client = self._clients.get(name, _MISSING)
+        if client is _MISSING:
+            with self._lock:
+                client = self._clients.get(name, _MISSING)
+                if client is _MISSING:
+                    client = self._factories[name]()
+                    self._constructions[name] += 1
+                    self._clients[name] = client
+                    logger.info("Built %s client in process %s", name, os.getpid())
+        return client
+
+    def track_token_exchanges(self, token_manager):
+        """
+        Count the token requests of an ibm_cloud_sdk_core token manager.
+
+        The token manager caches its bearer token and only requests a new one
+        when the cached token is expired or close to expiry.
+        """
+        request_token = token_manager.request_token
+
+        def counted_request_token(*args, **kwargs):
+            self.token_exchanges += 1
+            logger.info("Exchanging an IAM API key for a bearer token")
+            return request_token(*args, **kwargs)
+
+        token_manager.request_token = counted_request_token
+        return token_manager
+
+    def warm_up(self):
+        """
+        Build every registered client now rather than on the first request.
+        """
+        for name in list(self._factories):
+            self.get(name)
+
+    def reset(self):
+        """
+        Forget every client, so that each one is built again on next use.
+
+        Runs in the child after a fork: the inherited clients' connections and
+        worker threads belong to the parent process.
+        """
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._constructions = Counter()
+        self._lookups = Counter()
+        self.token_exchanges = 0
+
+    def stats(self):
+        return {
+            'pid': os.getpid(),
+            'clients': {name: {'constructions': self._constructions[name],
+                               'lookups': self._lookups[name]}
+                        for name in self._factories},
+            'token_exchanges': self.token_exchanges,
+        }
+
+
+registry = ClientRegistry()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=registry.reset)
@@ -0,0 +1,223 @@
+"""
+In-memory spatial index of dealerships for nearest-dealer and radius queries.
+"""
+import heapq
+import itertools
+import math
+import threading
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """
+    Return the great-circle distance in kilometres between two points given in degrees.
+    """
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    return _distance_km(math.sin((lat2 - lat1) / 2) ** 2
+                        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2)
+
+
+def coordinates(dealer):
+    """
+    Return a dealer's `(lat, long)` as floats, or None when it has no valid coordinates.
+    """
+    try:
+        lat, lon = float(dealer.lat), float(dealer.long)
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return None
+    return lat, lon
+
+
+class GeoGrid:
+    """
+    Dealers bucketed into cells of `cell_degrees` of latitude by `cell_degrees` of longitude.
+
+    Radius queries only visit the cells overlapping the bounding box of their
+    circle; nearest-dealer queries visit cells closest first and stop as soon as
+    no unvisited cell can hold a closer dealer, or rank the populated cells
+    directly once walking would visit more cells than there are populated ones.
+    Either way the cost follows the number of dealers near the point rather
+    than the total, and stays within a pass over the populated cells.
+    `update()` applies the dealers that changed without rebuilding the grid.
+    Cells hold tuples that are replaced, never modified, so queries run without
+    a lock while an update is in progress.
+
+    Distances are compared as haversines (the `a` of the haversine formula),
+    which order like distances and spare a square root and arcsine per dealer.
+    """
+
+    def __init__(self, cell_degrees=0.5):
+        self.cell_degrees = cell_degrees
+        self._cell_radians = math.radians(cell_degrees)
+        self._rows = math.ceil(180 / cell_degrees)
+        self._columns = math.ceil(360 / cell_degrees)
+        self._cells = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._positions)
+
+    def _row(self, lat):
+        return min(int((lat + 90) // self.cell_degrees), self._rows - 1)
+
+    def _column(self, lon):
+        return int((lon + 180) // self.cell_degrees) % self._columns
+
+    def update(self, added=(), removed=()):
+        """
+        Remove the dealers in `removed` and add those in `added`, replacing any with the same id.
+        """
+        with self._lock:
+            changed = {}
+
+            def entries_of(cell):
+                if cell not in changed:
+                    changed[cell] = list(self._cells.get(cell, ()))
+                return changed[cell]
+
+            def discard(dealer_id):
+                position = self._positions.pop(dealer_id, None)
+                if position is not None:
+                    cell, entry = position
+                    entries = entries_of(cell)
+                    del entries[next(index for index, other in enumerate(entries) if other is entry)]
+
+            for dealer in removed:
+                discard(dealer.id)
+            for dealer in added:
+                discard(dealer.id)
+                point = coordinates(dealer)
+                if point is None:
+                    continue
+                cell = (self._row(point[0]), self._column(point[1]))
+                phi = math.radians(point[0])
+                entry = (phi, math.radians(point[1]), math.cos(phi), dealer)
+                entries_of(cell).append(entry)
+                self._positions[dealer.id] = (cell, entry)
+            for cell, entries in changed.items():
+                if entries:
+                    self._cells[cell] = tuple(entries)
+                else:
+                    self._cells.pop(cell, None)
+
+    def _bounding_cells(self, lat, lon, angle):
+        # The bounding box of a circle on the sphere; see J. P. Matuschek, "Finding Points
+        # Within a Distance of a Latitude/Longitude Using Bounding Coordinates"
+        south, north = lat - math.degrees(angle), lat + math.degrees(angle)
+        rows = range(self._row(max(south, -90)), self._row(min(north, 90)) + 1)
+        if south <= -90 or north >= 90 or math.sin(angle) >= math.cos(math.radians(lat)):
+            # The circle covers a pole: every longitude is in range
+            columns = range(self._columns)
+        else:
+            spread = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+            first = int((lon - spread + 180) // self.cell_degrees)
+            last = int((lon + spread + 180) // self.cell_degrees)
+            last = min(last, first + self._columns - 1)
+            columns = [column % self._columns for column in range(first, last + 1)]
+        return [(row, column) for row in rows for column in columns]
+
+    def _cell_bound(self, phi, lam, cos_phi, cell):
+        # The haversine from the point to the closest point of `cell`
+        row, column = cell
+        south = row * self._cell_radians - math.pi / 2
+        north = min(south + self._cell_radians, math.pi / 2)
+        east_of_west_edge = (lam - (column * self._cell_radians - math.pi)) % (2 * math.pi)
+        if east_of_west_edge <= self._cell_radians:
+            # Within the cell's longitudes: the closest point is due north or south
+            gap = south - phi if phi < south else phi - north if phi > north else 0.0
+            return math.sin(gap / 2) ** 2
+        # Otherwise it lies on the nearer edge meridian, where the great circle
+        # through the point perpendicular to that meridian crosses it
+        dlon = min(east_of_west_edge - self._cell_radians, 2 * math.pi - east_of_west_edge)
+        if dlon < math.pi / 2:
+            target = math.atan(math.tan(phi) / math.cos(dlon))
+        else:
+            target = math.pi / 2 if phi >= 0 else -math.pi / 2
+        target = min(max(target, south), north)
+        return math.sin((target - phi) / 2) ** 2 + cos_phi * math.cos(target) * math.sin(dlon / 2) ** 2
+
+    def _neighbours(self, cell):
+        row, column = cell
+        for next_row in (row - 1, row, row + 1):
+            if 0 <= next_row < self._rows:
+                for next_column in (column - 1, column, column + 1):
+                    yield next_row, next_column % self._columns
+
+    def within(self, lat, lon, radius_km):
+        """
+        Return `(dealer, distance_km)` pairs for the dealers within `radius_km` of a point, closest first.
+        """
+        angle = min(radius_km / EARTH_RADIUS_KM, math.pi)
+        limit = math.sin(angle / 2) ** 2
+        phi, lam = math.radians(lat), math.radians(lon)
+        cos_phi = math.cos(phi)
+        sin, cells = math.sin, self._cells
+        found = []
+        for cell in self._bounding_cells(lat, lon, angle):
+            for dealer_phi, dealer_lam, dealer_cos, dealer in cells.get(cell, ()):
+                a = sin((dealer_phi - phi) / 2) ** 2 + cos_phi * dealer_cos * sin((dealer_lam - lam) / 2) ** 2
+                if a <= limit:
+                    found.append((a, dealer))
+        found.sort(key=lambda pair: pair[0])
+        return [(dealer, _distance_km(a)) for a, dealer in found]
+
+    def nearest(self, lat, lon, count, radius_km=None):
+        """
+        Return `(dealer, distance_km)` pairs for the `count` dealers nearest to a point,
+        optionally within `radius_km`, closest first.
+        """
+        limit = math.sin(min(radius_km / EARTH_RADIUS_KM, math.pi) / 2) ** 2 if radius_km is not None else 1.0
+        count = min(count, len(self))
+        if count < 1:
+            return []
+        phi, lam = math.radians(lat), math.radians(lon)
+        cos_phi = math.cos(phi)
+        sin, cells = math.sin, self._cells
+        best = []  # the closest dealers so far, as a max-heap of (-a, tie-breaker, dealer)
+        tie = itertools.count()
+
+        def done(bound):
+            return bound > limit or (len(best) == count and bound > -best[0][0])
+
+        def visit(cell):
+            for dealer_phi, dealer_lam, dealer_cos, dealer in cells.get(cell, ()):
+                a = sin((dealer_phi - phi) / 2) ** 2 + cos_phi * dealer_cos * sin((dealer_lam - lam) / 2) ** 2
+                if a > limit:
+                    continue
+                if len(best) < count:
+                    heapq.heappush(best, (-a, next(tie), dealer))
+                elif a < -best[0][0]:
+                    heapq.heapreplace(best, (-a, next(tie), dealer))
+
+        start = (self._row(lat), self._column(lon))
+        frontier = [(0.0, start)]
+        seen = {start}
+        visited = set()
+        while frontier:
+            bound, cell = heapq.heappop(frontier)
+            if done(bound):
+                break
+            visit(cell)
+            visited.add(cell)
+            if len(visited) > len(cells):
+                # Sparse dealers: ranking the populated cells beats walking the empty ones between them
+                rest = sorted((self._cell_bound(phi, lam, cos_phi, other), other)
+                              for other in list(cells) if other not in visited)
+                for bound, other in rest:
+                    if done(bound):
+                        break
+                    visit(other)
+                break
+            for neighbour in self._neighbours(cell):
+                if neighbour not in seen:
+                    seen.add(neighbour)
+                    heapq.heappush(frontier, (self._cell_bound(phi, lam, cos_phi, neighbour), neighbour))
+        return [(dealer, _distance_km(-negative_a)) for negative_a, _, dealer in sorted(best, reverse=True)]
+
+
+def _distance_km(a):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
@@ -0,0 +1,174 @@
+"""
+Shared machinery of the bulk import management commands.
+
+Records are streamed from JSON or CSV files, written in batches and
+checkpointed after every batch, so an interrupted import resumes where it
+stopped instead of starting over.
+"""
+import csv
+import json
+import os
+import re
+import time
+from django.core.management.base import BaseCommand, CommandError
+from .restapis import iter_json_array
+
+CHUNK_SIZE = 64 * 1024
+
+
+def iter_json_records(path, key):
+    """
+    Yield the objects of a JSON array one at a time, without loading the whole file.
+
+    The array is either the document itself or the value of `key` in a top-level
+    object, as in the `cloudant/data/*.json` dumps: `{"reviews": [...]}`.
+    """
+    with open(path, encoding='utf-8') as source:
+        chunks = iter(lambda: source.read(CHUNK_SIZE), '')
+        start = re.compile(r'\s*(?=\[)|\s*\{.*?"%s"\s*:\s*(?=\[)' % re.escape(key), re.DOTALL)
+        buffer = ''
+        for chunk in chunks:
+            buffer += chunk
+            match = start.match(buffer)
+            if match:
+                # Hand the array, from its opening bracket, to the incremental decoder
+                buffer = buffer[match.end():]
+                break
+        else:
+            raise CommandError('No "{}" array found in {}'.format(key, path))
+        yield from iter_json_array(_prepend(buffer, chunks))
+
+
+def _prepend(first, chunks):
+    yield first
+    yield from chunks
+
+
+def iter_csv_records(path):
+    with open(path, encoding='utf-8', newline='') as source:
+        yield from csv.DictReader(source)
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
+
+
+def parse_int(value):
+    return None if value in (None, '') else int(value)
+
+
+class Checkpoint:
+    """
+    The number of records of `source` already imported, kept in a small JSON file.
+    """
+
+    def __init__(self, path, source):
+        self.path = path
+        self.source = os.path.abspath(source)
+
+    def load(self):
+        try:
+            with open(self.path, encoding='utf-8') as checkpoint:
+                state = json.load(checkpoint)
+        except FileNotFoundError:
+            return 0
+        if state.get('source') != self.source:
+            raise CommandError('Checkpoint {} belongs to {}; pass --restart to ignore it'.format(
+                self.path, state.get('source')))
+        return state['done']
+
+    def save(self, done):
+        # Write then rename, so a crash never leaves a truncated checkpoint behind
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w', encoding='utf-8') as checkpoint:
+            json.dump({'source': self.source, 'done': done}, checkpoint)
+        os.replace(temporary, self.path)
+
+    def clear(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ImportCommand(BaseCommand):
+    """
+    Base class of the import commands.
+
+    Subclasses set `json_key` and `default_batch_size`, turn each raw record into
+    what they store with `parse()`, and write a list of parsed records with
+    `write_batch()`, which returns how many were stored.
+    """
+    json_key = None
+    default_batch_size = 1000
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="JSON or CSV file to import")
+        parser.add_argument('--batch-size', type=int, default=self.default_batch_size,
+                            help="Records written per batch")
+        parser.add_argument('--checkpoint',
+                            help="Checkpoint file (default: the input path with .checkpoint appended)")
+        parser.add_argument('--restart', action='store_true',
+                            help="Ignore any checkpoint and import from the first record")
+
+    def parse(self, record):
+        raise NotImplementedError
+
+    def write_batch(self, batch):
+        raise NotImplementedError
+
+    def finish(self):
+        """
+        Called once the import stops, whether it completed or failed.
+        """
+
+    def records(self, path):
+        if path.lower().endswith('.csv'):
+            return iter_csv_records(path)
+        return iter_json_records(path, self.json_key)
+
+    def handle(self, *args, **options):
+        path = options['path']
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+        checkpoint = Checkpoint(options['checkpoint'] or path + '.checkpoint', path)
+        if options['restart']:
+            checkpoint.clear()
+        skip = checkpoint.load()
+        if skip:
+            self.stdout.write("Resuming after {} records already imported".format(skip))
+
+        done = skip
+        stored = 0
+        start = time.perf_counter()
+        batch = []
+        try:
+            for number, record in enumerate(self.records(path)):
+                if number < skip:
+                    continue
+                try:
+                    batch.append(self.parse(record))
+                except (KeyError, TypeError, ValueError) as err:
+                    raise CommandError('Record {} is invalid: {!r}'.format(number + 1, err))
+                if len(batch) == batch_size:
+                    stored += self.write_batch(batch)
+                    done += len(batch)
+                    checkpoint.save(done)
+                    batch = []
+                    self._progress(done - skip, stored, start)
+            if batch:
+                stored += self.write_batch(batch)
+                done += len(batch)
+            checkpoint.clear()
+        finally:
+            self.finish()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            "Imported {} records ({} stored) in {:.1f} s, {:.0f} records/s".format(
+                done - skip, stored, elapsed, (done - skip) / elapsed if elapsed else 0)))
+
+    def _progress(self, done, stored, start):
+        elapsed = time.perf_counter() - start
+        self.stdout.write("{} records ({} stored), {:.0f} records/s".format(
+            done, stored, done / elapsed if elapsed else 0))
@@ -0,0 +1,302 @@
+"""
+Per-request performance instrumentation.
+
+`PerformanceMiddleware` opens a `RequestMetrics` record for a sampled share
+of requests (`settings.PERF_SAMPLE_RATE`). While it is open, the upstream
+clients, the ORM and the template engine add their timings to it through the
+hooks below. The record is reported in the response's Server-Timing header
+and aggregated into latency histograms exposed at /metrics in the Prometheus
+text format. Requests that are not sampled pay for one context variable lookup
+per hook.
+"""
+import asyncio
+import contextvars
+import hmac
+import random
+import threading
+import time
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.template.backends.django import DjangoTemplates, Template
+from .clients import registry as clients
+from .models import ReviewOutbox
+from .resilience import breakers
+
+_current = contextvars.ContextVar('request_metrics', default=None)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+class RequestMetrics:
+    """
+    Time spent by one request in upstream services, database queries and templates.
+
+    Upstream calls may run on worker threads, so updates take a lock.
+    """
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.upstream = {}
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.template_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add_upstream(self, service, seconds):
+        with self._lock:
+            calls, total = self.upstream.get(service, (0, 0.0))
+            self.upstream[service] = (calls + 1, total + seconds)
+
+    def add_query(self, seconds):
+        with self._lock:
+            self.queries += 1
+            self.query_seconds += seconds
+
+    def add_template(self, seconds):
+        with self._lock:
+            self.template_seconds += seconds
+
+    def server_timing(self, total):
+        entries = ['total;dur={:.1f}'.format(total * 1000),
+                   'db;dur={:.1f};desc="{} queries"'.format(self.query_seconds * 1000, self.queries),
+                   'template;dur={:.1f}'.format(self.template_seconds * 1000)]
+        for service, (calls, seconds) in sorted(self.upstream.items()):
+            entries.append('upstream-{};dur={:.1f};desc="{} calls"'.format(service, seconds * 1000, calls))
+        return ', '.join(entries)
+
+
+class Histogram:
+    """
+    A Prometheus-style cumulative histogram with one series per label value.
+    """
+
+    def __init__(self, name, help_text, label, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, label_value, value):
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [[0] * len(self.buckets), 0, 0.0]
+            counts = series[0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            series[1] += 1
+            series[2] += value
+
+    def exposition(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help_text),
+                 '# TYPE {} histogram'.format(self.name)]
+        with self._lock:
+            series = {key: (list(counts), count, total)
+                      for key, (counts, count, total) in self._series.items()}
+        for label_value, (counts, count, total) in sorted(series.items()):
+            label = '{}="{}"'.format(self.label, label_value)
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(self.name, label, bound, bucket_count))
+            lines.append('{}_bucket{{{},le="+Inf"}} {}'.format(self.name, label, count))
+            lines.append('{}_sum{{{}}} {}'.format(self.name, label, total))
+            lines.append('{}_count{{{}}} {}'.format(self.name, label, count))
+        return lines
+
+
+request_duration = Histogram('djangoapp_request_duration_seconds',
+                             'Time to produce a response, by view.', 'view', LATENCY_BUCKETS)
+upstream_duration = Histogram('djangoapp_upstream_request_duration_seconds',
+                              'Time of each upstream call, by service.', 'service', LATENCY_BUCKETS)
+query_count = Histogram('djangoapp_db_queries_per_request',
+                        'ORM queries run by a request, by view.', 'view', COUNT_BUCKETS)
+template_duration = Histogram('djangoapp_template_render_seconds',
+                              'Template render time of a request, by view.', 'view', LATENCY_BUCKETS)
+HISTOGRAMS = (request_duration, upstream_duration, query_count, template_duration)
+
+
+def record_upstream(service, seconds):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.add_upstream(service, seconds)
+        upstream_duration.observe(service, seconds)
+
+
+class track_upstream:  # pylint: disable=invalid-name
+    """
+    Context manager timing one call to the upstream `service` for the current request.
+    """
+
+    __slots__ = ('service', 'start')
+
+    def __init__(self, service):
+        self.service = service
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        record_upstream(self.service, time.perf_counter() - self.start)
+
+
+def upstream_service(url):
+    """
+    Name the upstream service `url` belongs to, for the per-service breakdown.
+    """
+    if url.startswith(settings.DEALERSHIPS_SERVICE_URL):
+        return 'dealerships'
+    if url.startswith(settings.REVIEWS_SERVICE_URL):
+        return 'reviews'
+    return 'other'
+
+
+def submit_in_context(executor, fn, *args):
+    """
+    Submit `fn(*args)` to `executor`, running it with the caller's context variables
+    so that its upstream calls count towards the caller's request.
+    """
+    return executor.submit(contextvars.copy_context().run, fn, *args)
+
+
+def time_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper counting the current request's queries; see `signals`.
+    """
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(time.perf_counter() - start)
+
+
+class TimedTemplate(Template):
+    def render(self, context=None, request=None):
+        metrics = _current.get()
+        if metrics is None:
+            return super().render(context, request)
+        start = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            metrics.add_template(time.perf_counter() - start)
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """
+    The Django template backend, with render times added to the request's metrics.
+    """
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name).template, self)
+
+
+class PerformanceMiddleware:
+    """
+    Measures sampled requests and reports them in Server-Timing and the /metrics histograms.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.sample_rate = settings.PERF_SAMPLE_RATE
+        if asyncio.iscoroutinefunction(self.get_response):
+            # Mark the instance as a coroutine function, as Django's MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine  # pylint: disable=protected-access
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        if not self._sampled():
+            return self.get_response(request)
+        token = _current.set(RequestMetrics())
+        try:
+            response = self.get_response(request)
+            return self._report(request, response)
+        finally:
+            _current.reset(token)
+
+    async def __acall__(self, request):
+        if not self._sampled():
+            return await self.get_response(request)
+        token = _current.set(RequestMetrics())
+        try:
+            response = await self.get_response(request)
+            return self._report(request, response)
+        finally:
+            _current.reset(token)
+
+    def _sampled(self):
+        return self.sample_rate >= 1 or (self.sample_rate > 0 and random.random() < self.sample_rate)
+
+    @staticmethod
+    def _report(request, response):
+        metrics = _current.get()
+        total = time.perf_counter() - metrics.start
+        match = getattr(request, 'resolver_match', None)
+        view = match.view_name if match else 'unmatched'
+        request_duration.observe(view, total)
+        query_count.observe(view, metrics.queries)
+        template_duration.observe(view, metrics.template_seconds)
+        timing = metrics.server_timing(total)
+        existing = response.get('Server-Timing')
+        response['Server-Timing'] = existing + ', ' + timing if existing else timing
+        return response
+
+
+def metrics_allowed(request):
+    """
+    Return whether `request` may read /metrics: staff users, and scrapers presenting `settings.METRICS_TOKEN`.
+    """
+    if settings.METRICS_TOKEN:
+        expected = 'Bearer ' + settings.METRICS_TOKEN
+        if hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                               expected.encode('utf-8')):
+            return True
+    return request.user.is_staff
+
+
+def metrics_view(request):
+    """
+    Expose the request histograms, upstream client counters and circuit states of this process.
+
+    Each worker process keeps its own figures, so scrape every worker, or
+    run a single worker per container.
+    """
+    if not metrics_allowed(request):
+        return HttpResponseForbidden()
+    lines = []
+    for histogram in HISTOGRAMS:
+        lines.extend(histogram.exposition())
+    stats = clients.stats()
+    lines.append('# HELP djangoapp_client_constructions_total Upstream clients built by this process.')
+    lines.append('# TYPE djangoapp_client_constructions_total counter')
+    for name, counts in sorted(stats['clients'].items()):
+        lines.append('djangoapp_client_constructions_total{{client="{}"}} {}'.format(
+            name, counts['constructions']))
+    lines.append('# HELP djangoapp_iam_token_exchanges_total IAM token requests made by this process.')
+    lines.append('# TYPE djangoapp_iam_token_exchanges_total counter')
+    lines.append('djangoapp_iam_token_exchanges_total {}'.format(stats['token_exchanges']))
+    lines.append('# HELP djangoapp_circuit_open Whether the circuit breaker of an upstream is open.')
+    lines.append('# TYPE djangoapp_circuit_open gauge')
+    for service, breaker in sorted(breakers().items()):
+        lines.append('djangoapp_circuit_open{{service="{}"}} {}'.format(
+            service, int(breaker.state != 'closed')))
+    lines.append('# HELP djangoapp_review_outbox_entries Reviews waiting in the outbox; "failed" ones are no '
+                 'longer retried.')
+    lines.append('# TYPE djangoapp_review_outbox_entries gauge')
+    failed = ReviewOutbox.objects.filter(attempts__gte=settings.REVIEW_OUTBOX_MAX_ATTEMPTS).count()
+    lines.append('djangoapp_review_outbox_entries{{state="pending"}} {}'.format(
+        ReviewOutbox.objects.count() - failed))
+    lines.append('djangoapp_review_outbox_entries{{state="failed"}} {}'.format(failed))
+    return HttpResponse('\n'.join(lines) + '\n', content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,97 @@
+"""
+Benchmarks the dealer spatial grid against a brute-force scan.
+"""
+import heapq
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from djangoapp.geo import GeoGrid, haversine_km
+from djangoapp.models import CarDealer
+from devtools.stubs import load_seed, scale_dealers
+
+
+def brute_force_nearest(points, lat, lon, count):
+    return heapq.nsmallest(count, ((haversine_km(lat, lon, dealer_lat, dealer_lon), dealer.id)
+                                   for dealer_lat, dealer_lon, dealer in points))
+
+
+def brute_force_within(points, lat, lon, radius_km):
+    return sorted((distance, dealer.id) for distance, dealer in
+                  ((haversine_km(lat, lon, dealer_lat, dealer_lon), dealer)
+                   for dealer_lat, dealer_lon, dealer in points) if distance <= radius_km)
+
+
+class Command(BaseCommand):
+    """
+    Scatters `--dealers` dealers around the seed dealerships' cities, then runs
+    the same k-nearest and radius queries through `GeoGrid` and a scan over
+    every dealer, checks that both agree, and prints the time per query. Also
+    times a full grid build against an incremental update of 1% of the dealers.
+    """
+    help = "Compare GeoGrid nearest-dealer and radius queries with a brute-force scan"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dealers', type=int, default=50000, help="Dealers in the index")
+        parser.add_argument('--queries', type=int, default=200, help="Queries per kind")
+        parser.add_argument('--count', type=int, default=10, help="Dealers per k-nearest query")
+        parser.add_argument('--radius', type=float, default=50.0, help="Radius of the radius queries, in km")
+        parser.add_argument('--seed', type=int, default=1)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        dealers = self._dealers(options['dealers'], rng)
+        points = [(float(dealer.lat), float(dealer.long), dealer) for dealer in dealers]
+        queries = [(float(dealer.lat) + rng.gauss(0, 2), float(dealer.long) + rng.gauss(0, 2))
+                   for dealer in rng.sample(dealers, min(options['queries'], len(dealers)))]
+
+        start = time.perf_counter()
+        grid = GeoGrid()
+        grid.update(added=dealers)
+        build_ms = (time.perf_counter() - start) * 1000
+        moved = [dealer._replace(lat=float(dealer.lat) + 0.01)
+                 for dealer in rng.sample(dealers, len(dealers) // 100)]
+        start = time.perf_counter()
+        grid.update(added=moved)
+        update_ms = (time.perf_counter() - start) * 1000
+        grid.update(added=[dealers[dealer.id - 1] for dealer in moved])
+        self.stdout.write("{:,} dealers: full build {:.1f} ms, incremental update of {:,} dealers "
+                          "{:.1f} ms".format(len(dealers), build_ms, len(moved), update_ms))
+
+        count, radius = options['count'], options['radius']
+        for label, indexed, scan in (
+                ("{}-nearest".format(count),
+                 lambda lat, lon: [(distance, dealer.id) for dealer, distance in grid.nearest(lat, lon, count)],
+                 lambda lat, lon: brute_force_nearest(points, lat, lon, count)),
+                ("within {:g} km".format(radius),
+                 lambda lat, lon: [(distance, dealer.id) for dealer, distance in grid.within(lat, lon, radius)],
+                 lambda lat, lon: brute_force_within(points, lat, lon, radius))):
+            mismatches = sum(indexed(lat, lon) != scan(lat, lon) for lat, lon in queries)
+            grid_us = self._measure(indexed, queries)
+            scan_us = self._measure(scan, queries)
+            grid_p50, scan_p50 = statistics.median(grid_us), statistics.median(scan_us)
+            self.stdout.write("{:<15} grid p50 {:9.1f} us  p99 {:9.1f} us | scan p50 {:10.1f} us | "
+                              "speed-up {:7.1f}x | mismatches {}".format(
+                                  label, grid_p50, self._percentile(grid_us, 99), scan_p50,
+                                  scan_p50 / grid_p50, mismatches))
+
+    @staticmethod
+    def _dealers(count, rng):
+        # Cluster the dealers around real cities, as real dealerships are
+        return [dealer._replace(lat=min(max(float(dealer.lat) + rng.gauss(0, 0.5), -90), 90),
+                                long=float(dealer.long) + rng.gauss(0, 0.5))
+                for dealer in CarDealer.from_json_list(scale_dealers(load_seed('dealerships'), count))]
+
+    @staticmethod
+    def _measure(query, queries):
+        timings = []
+        for lat, lon in queries:
+            start = time.perf_counter()
+            query(lat, lon)
+            timings.append((time.perf_counter() - start) * 1000000)
+        return timings
+
+    @staticmethod
+    def _percentile(timings, percent):
+        timings = sorted(timings)
+        return timings[min(len(timings) - 1, int(len(timings) * percent / 100))]
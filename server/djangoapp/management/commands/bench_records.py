@@ -0,0 +1,110 @@
+"""
+Benchmarks the dealer and review record types against plain per-instance-dict classes.
+"""
+import gc
+import json
+import time
+import tracemalloc
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from djangoapp.models import CarDealer, DealerReview
+
+
+class PlainDealerReview:
+    """
+    DealerReview as it was before: a plain class with a per-instance __dict__.
+    """
+    def __init__(self, dealership, username, name, purchase, review, review_date, purchase_date, car_make,
+                 car_model, car_year, sentiment):
+        self.dealership = dealership
+        self.username = username
+        self.name = name
+        self.purchase = purchase
+        self.review = review
+        self.review_date = review_date
+        self.purchase_date = purchase_date
+        self.car_make = car_make
+        self.car_model = car_model
+        self.car_year = car_year
+        self.sentiment = sentiment
+
+
+class PlainCarDealer:
+    """
+    CarDealer as it was before: a plain class with a per-instance __dict__.
+    """
+    def __init__(self, address, city, full_name, id, lat, long, short_name, state, zip):
+        self.address = address
+        self.city = city
+        self.full_name = full_name
+        self.id = id
+        self.lat = lat
+        self.long = long
+        self.short_name = short_name
+        self.state = state
+        self.zip = zip
+
+
+def plain_dealers(documents):
+    return [PlainCarDealer(address=dealer["address"], city=dealer["city"], full_name=dealer["full_name"],
+                           id=dealer["id"], lat=dealer["lat"], long=dealer["long"],
+                           short_name=dealer["short_name"], state=dealer["state"], zip=dealer["zip"])
+            for dealer in documents]
+
+
+def plain_reviews(documents):
+    return [PlainDealerReview(dealership=review["dealership"], username=review.get("username", ""),
+                              name=review["name"], purchase=review["purchase"], review=review["review"],
+                              review_date=review.get("review_date", ""),
+                              purchase_date=review.get("purchase_date", ""),
+                              car_make=review.get("car_make", ""), car_model=review.get("car_model", ""),
+                              car_year=review.get("car_year", ""), sentiment=review.get("sentiment"))
+            for review in documents]
+
+
+class Command(BaseCommand):
+    """
+    Builds `--count` dealers and reviews from the seed documents with the plain
+    classes the app used to have and with the record types in `models`, then
+    prints the memory held per 100k objects and the construction throughput.
+    """
+    help = "Compare memory and construction speed of CarDealer/DealerReview with plain classes"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100000, help="Objects built per run")
+
+    def handle(self, *args, **options):
+        count = options['count']
+        data_dir = settings.BASE_DIR.parent / 'cloudant' / 'data'
+        for label, seed, key, plain, compact in (
+                ("dealers", 'dealerships.json', 'dealerships', plain_dealers, CarDealer.from_json_list),
+                ("reviews", 'reviews-full.json', 'reviews', plain_reviews, DealerReview.from_json_list)):
+            with open(data_dir / seed, encoding='utf-8') as seed_file:
+                documents = json.load(seed_file)[key]
+            # Repeat the seed documents; the field values are shared, so only the objects are measured
+            documents = (documents * (count // len(documents) + 1))[:count]
+            for kind, build in (("plain class", plain), ("record type", compact)):
+                memory = self._memory(build, documents)
+                rate = self._throughput(build, documents)
+                self.stdout.write("{:<8} {:<12} {:8.2f} MiB per 100k  {:10,.0f} objects/s".format(
+                    label, kind, memory * 100000 / count / 2 ** 20, rate))
+
+    @staticmethod
+    def _memory(build, documents):
+        gc.collect()
+        tracemalloc.start()
+        objects = build(documents)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del objects
+        return size
+
+    @staticmethod
+    def _throughput(build, documents, repeat=5):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            build(documents)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return len(documents) / best
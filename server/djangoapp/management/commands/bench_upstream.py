@@ -0,0 +1,50 @@
+"""
+Benchmarks pooled upstream calls against one-connection-per-call requests.
+"""
+import statistics
+import time
+import requests
+from django.core.management.base import BaseCommand
+from djangoapp import restapis
+from devtools.stubs import StubUpstream, dealerships_routes
+
+
+class Command(BaseCommand):
+    """
+    Calls a local dealership stub with bare `requests.get` and with the pooled
+    session used by `restapis.get_request`, then prints latency for both.
+    """
+    help = "Compare bare requests.get with the pooled restapis session against a local stub"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500,
+                            help="Number of sequential GETs per client")
+        parser.add_argument('--latency', type=float, default=0.0,
+                            help="Seconds of latency injected by the stub per response")
+
+    def handle(self, *args, **options):
+        count = options['requests']
+        with StubUpstream(dealerships_routes(), latency=options['latency']) as stub:
+            url = stub.url + '/dealerships/get'
+            bare = self._measure(lambda: requests.get(url, params={'id': 1}).json(), count)
+            pooled = self._measure(lambda: restapis.get_request(url, id=1), count)
+        self._report("requests.get", bare)
+        self._report("pooled session", pooled)
+        gain = statistics.median(bare) / statistics.median(pooled)
+        self.stdout.write("p50 speed-up: {:.2f}x".format(gain))
+
+    @staticmethod
+    def _measure(call, count):
+        call()
+        timings = []
+        for _ in range(count):
+            start = time.perf_counter()
+            call()
+            timings.append((time.perf_counter() - start) * 1000)
+        return timings
+
+    def _report(self, label, timings):
+        timings = sorted(timings)
+        self.stdout.write("{:<16} p50 {:.3f} ms  p95 {:.3f} ms  mean {:.3f} ms".format(
+            label, statistics.median(timings), timings[int(len(timings) * 0.95) - 1],
+            statistics.mean(timings)))
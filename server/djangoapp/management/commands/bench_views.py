@@ -0,0 +1,85 @@
+"""
+Compares the synchronous (WSGI) and asynchronous (ASGI) dealer views under load.
+"""
+import asyncio
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth.models import AnonymousUser
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+from djangoapp import views
+from djangoapp.clients import registry as clients
+from devtools.stubs import StubUpstream, dealerships_routes, reviews_routes
+
+
+class Command(BaseCommand):
+    """
+    Serves the dealership and reviews services from local stubs with injected latency
+    and drives `get_dealer_details` both ways: through a fixed number of blocking
+    workers, as gunicorn's sync workers do, and through one event loop running the
+    async view with many requests in flight.
+    """
+    help = "Load-test the WSGI and ASGI dealer detail views against local upstream stubs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Requests per mode")
+        parser.add_argument('--workers', type=int, default=3,
+                            help="Blocking workers in WSGI mode (gunicorn --workers)")
+        parser.add_argument('--concurrency', type=int, default=100,
+                            help="In-flight requests in ASGI mode")
+        parser.add_argument('--latency', type=float, default=0.2,
+                            help="Seconds of latency injected by each upstream stub")
+
+    def handle(self, *args, **options):
+        latency = options['latency']
+        with StubUpstream(dealerships_routes(), latency) as dealerships, \
+                StubUpstream(reviews_routes(), latency) as reviews, \
+                override_settings(DEALERSHIPS_SERVICE_URL=dealerships.url,
+                                  REVIEWS_SERVICE_URL=reviews.url,
+                                  DEALER_CATALOG_ENABLED=False):
+            views.page_cache.enabled = False
+            dealer_ids = [(n % 50) + 1 for n in range(options['requests'])]
+            self._report("WSGI", *self._run_wsgi(dealer_ids, options['workers']))
+            self._report("ASGI", *asyncio.run(self._run_asgi(dealer_ids, options['concurrency'])))
+        stats = clients.stats()
+        for name, counts in stats['clients'].items():
+            self.stdout.write("{} client: built {constructions}x for {lookups} lookups".format(
+                name, **counts))
+        self.stdout.write("IAM token exchanges: {}".format(stats['token_exchanges']))
+
+    @staticmethod
+    def _request(dealer_id):
+        request = RequestFactory().get('/djangoapp/dealer/{}'.format(dealer_id))
+        request.user = AnonymousUser()
+        return request
+
+    def _run_wsgi(self, dealer_ids, workers):
+        def call(dealer_id):
+            start = time.perf_counter()
+            views.get_dealer_details(self._request(dealer_id), dealer_id)
+            return (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            timings = list(executor.map(call, dealer_ids))
+        return timings, time.perf_counter() - start
+
+    async def _run_asgi(self, dealer_ids, concurrency):
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call(dealer_id):
+            async with semaphore:
+                start = time.perf_counter()
+                await views.get_dealer_details_async(self._request(dealer_id), dealer_id)
+                return (time.perf_counter() - start) * 1000
+
+        start = time.perf_counter()
+        timings = await asyncio.gather(*(call(dealer_id) for dealer_id in dealer_ids))
+        return timings, time.perf_counter() - start
+
+    def _report(self, label, timings, elapsed):
+        timings = sorted(timings)
+        self.stdout.write("{}: {:.1f} req/s  p50 {:.1f} ms  p95 {:.1f} ms".format(
+            label, len(timings) / elapsed, statistics.median(timings),
+            timings[int(len(timings) * 0.95) - 1]))
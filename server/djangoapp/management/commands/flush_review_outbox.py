@@ -0,0 +1,37 @@
+"""
+Sends the reviews waiting in the review outbox to the reviews service.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils.timezone import now
+from djangoapp.models import ReviewOutbox
+from djangoapp.outbox import flush
+
+
+class Command(BaseCommand):
+    """
+    Flushes the outbox once, batch by batch, ignoring the retry backoff of the
+    queued reviews. The web processes flush the outbox in the background; run
+    this to send the waiting reviews now, or with `--retry-failed` to give the
+    reviews that used up their REVIEW_OUTBOX_MAX_ATTEMPTS another round of
+    attempts.
+    """
+    help = "Send the reviews waiting in the review outbox to the reviews service"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, help="Reviews per request to the bulk endpoint")
+        parser.add_argument('--retry-failed', action='store_true',
+                            help="Also send the reviews that are no longer retried")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size'] or settings.REVIEW_OUTBOX_BATCH_SIZE
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+        if options['retry_failed']:
+            ReviewOutbox.objects.filter(attempts__gte=settings.REVIEW_OUTBOX_MAX_ATTEMPTS).update(attempts=0)
+        ReviewOutbox.objects.update(next_attempt=now())
+        sent, failed = flush(batch_size)
+        remaining = ReviewOutbox.objects.count()
+        self.stdout.write("Sent {} reviews, {} failed; {} left in the outbox".format(sent, failed, remaining))
+        if failed:
+            raise CommandError('The reviews service did not accept every review; rerun to retry them')
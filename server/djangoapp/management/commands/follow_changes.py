@@ -0,0 +1,56 @@
+"""
+Invalidates cached pages and dealer catalogs as the dealerships and reviews databases change.
+"""
+import threading
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from djangoapp.changes import ChangesFollower
+
+
+class Command(BaseCommand):
+    """
+    Follows the `_changes` feed of each database in `settings.CHANGES_DATABASES`
+    on its own thread and retires the cache scopes every change touches (see
+    `djangoapp.changes`). Each feed resumes from its checkpoint; the first run
+    starts from the current sequence. With `--once`, applies what is pending
+    and exits, e.g. from cron.
+
+    The invalidations only reach the web processes through a shared page cache
+    backend (PAGE_CACHE_BACKEND), such as the default cache table, memcached or
+    redis, and only while PAGE_CACHE_ENABLED is set.
+    """
+    help = "Follow the databases' _changes feeds and invalidate the caches they affect"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--databases', nargs='+', choices=settings.CHANGES_DATABASES,
+                            default=list(settings.CHANGES_DATABASES))
+        parser.add_argument('--once', action='store_true', help="Apply the pending changes and exit")
+        parser.add_argument('--since', help="Start from this sequence instead of the checkpoint ('0' for "
+                                            "the beginning, 'now' to skip what is pending)")
+
+    def handle(self, *args, **options):
+        followers = [ChangesFollower(database, since=options['since']) for database in options['databases']]
+        if options['once']:
+            for follower in followers:
+                try:
+                    applied = follower.catch_up()
+                except RuntimeError as err:
+                    raise CommandError(str(err)) from err
+                self.stdout.write("{}: applied {} changes, now at {}".format(
+                    follower.database, applied, follower.since))
+            return
+
+        stop = threading.Event()
+        threads = [threading.Thread(target=follower.follow, args=(stop,), name='changes-' + follower.database,
+                                    daemon=True) for follower in followers]
+        for thread in threads:
+            thread.start()
+        self.stdout.write("Following the changes of {}".format(', '.join(options['databases'])))
+        try:
+            while any(thread.is_alive() for thread in threads):
+                for thread in threads:
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            stop.set()
+            return
+        raise CommandError('Stopped following the changes: a follower thread died')
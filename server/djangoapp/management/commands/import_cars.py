@@ -0,0 +1,79 @@
+"""
+Bulk-imports car makes and models from a JSON or CSV inventory.
+"""
+from django.db import transaction
+from djangoapp.caching import invalidate_dealer_inventory
+from djangoapp.importing import ImportCommand
+from djangoapp.models import CarMake, CarModel
+
+
+class Command(ImportCommand):
+    """
+    Imports car models, creating their makes as needed.
+
+    Each record names the `make`, the model `name` (or `model`), its `type`
+    (sedan, suv or wagon), `year` and `dealer_id` (or `dealerId`), with an
+    optional `make_description`. JSON files hold `{"cars": [...]}` or a bare
+    array; CSV files have a header row with the same names.
+    A model already stored with the same make, name, type, year and dealer is
+    not created again, so a batch written again after an interruption between
+    its commit and its checkpoint is not stored twice.
+    """
+    help = "Import car makes and models in batches, resuming from a checkpoint"
+    json_key = 'cars'
+
+    def handle(self, *args, **options):
+        self.makes = {}
+        self.dealer_ids = set()
+        super().handle(*args, **options)
+
+    def parse(self, record):
+        car_type = (record.get('type') or CarModel.SEDAN).lower()
+        if car_type not in dict(CarModel.TYPE_CHOICES):
+            raise ValueError('unknown type {!r}'.format(car_type))
+        dealer_id = record['dealer_id'] if 'dealer_id' in record else record['dealerId']
+        return {
+            'make': record['make'],
+            'make_description': record.get('make_description') or '',
+            'name': record.get('name') or record['model'],
+            'type': car_type,
+            'year': int(record['year']),
+            'dealerId': int(dealer_id),
+        }
+
+    def _resolve_makes(self, batch):
+        missing = {car['make']: car['make_description'] for car in batch
+                   if car['make'] not in self.makes}
+        if missing:
+            for make in CarMake.objects.filter(name__in=missing):
+                self.makes.setdefault(make.name, make)
+            new = [CarMake(name=name, description=description)
+                   for name, description in missing.items() if name not in self.makes]
+            if new:
+                CarMake.objects.bulk_create(new)
+                # Not every database returns the new keys from bulk_create, so read them back
+                for make in CarMake.objects.filter(name__in=[make.name for make in new]):
+                    self.makes.setdefault(make.name, make)
+
+    def write_batch(self, batch):
+        with transaction.atomic():
+            self._resolve_makes(batch)
+            # Models are identified by make, name, type, year and dealer
+            existing = set(CarModel.objects.filter(
+                dealerId__in={car['dealerId'] for car in batch}, name__in={car['name'] for car in batch},
+            ).values_list('make_id', 'name', 'type', 'year', 'dealerId'))
+            new = []
+            for car in batch:
+                make = self.makes[car['make']]
+                key = (make.pk, car['name'], car['type'], car['year'], car['dealerId'])
+                if key not in existing:
+                    existing.add(key)
+                    new.append(CarModel(dealerId=car['dealerId'], name=car['name'], type=car['type'],
+                                        year=car['year'], make=make))
+            CarModel.objects.bulk_create(new, batch_size=len(batch))
+        self.dealer_ids.update(car['dealerId'] for car in batch)
+        return len(new)
+
+    def finish(self):
+        # bulk_create sends no post_save signals, so drop the cached inventories here
+        invalidate_dealer_inventory(self.dealer_ids)
@@ -0,0 +1,76 @@
+"""
+Bulk-imports reviews into the reviews service from a JSON or CSV dump.
+"""
+import hashlib
+import os
+from django.core.management.base import CommandError
+from djangoapp.caching import invalidate_dealer_pages, invalidate_index_pages
+from djangoapp.importing import ImportCommand, parse_bool, parse_int
+from djangoapp.restapis import post_reviews
+
+
+class Command(ImportCommand):
+    """
+    Sends reviews to the reviews service's bulk endpoint, one batch per request.
+
+    Records follow the `cloudant/data/reviews-full.json` format: `dealership`,
+    `name`, `review` and `purchase`, plus the optional `id`, `username`,
+    `review_date`, `purchase_date`, `car_make`, `car_model` and `car_year`.
+    Every review is sent with a deterministic `_id`: the record's own, else one
+    derived from its `id`, else from the source path and the record's position.
+    A batch sent again after an interruption is therefore not stored twice.
+    """
+    help = "Import reviews through the reviews service in batches, resuming from a checkpoint"
+    json_key = 'reviews'
+    default_batch_size = 500
+
+    OPTIONAL_FIELDS = ('_id', 'username', 'review_date', 'purchase_date', 'car_make', 'car_model')
+
+    def handle(self, *args, **options):
+        self.dealer_ids = set()
+        super().handle(*args, **options)
+
+    def records(self, path):
+        source = os.path.abspath(path)
+        for number, record in enumerate(super().records(path)):
+            if record.get('_id') in (None, ''):
+                record = dict(record, _id=self.review_id(record, source, number))
+            yield record
+
+    @staticmethod
+    def review_id(record, source, number):
+        if record.get('id') not in (None, ''):
+            return 'review-{}'.format(str(record['id']).strip())
+        return hashlib.sha1('{}\0{}'.format(source, number).encode('utf-8')).hexdigest()
+
+    def parse(self, record):
+        review = {
+            'dealership': int(record['dealership']),
+            'name': record['name'],
+            'review': record['review'],
+            'purchase': parse_bool(record['purchase']),
+        }
+        for field in self.OPTIONAL_FIELDS:
+            if record.get(field) not in (None, ''):
+                review[field] = record[field]
+        for field in ('id', 'car_year'):
+            if record.get(field) not in (None, ''):
+                review[field] = parse_int(record[field])
+        return review
+
+    def write_batch(self, batch):
+        result = post_reviews(batch)
+        if result is None:
+            raise CommandError('The reviews service rejected a batch; rerun to resume from the checkpoint')
+        failed = sum(status == 'failed' for status in result['results'].values())
+        if failed:
+            raise CommandError('The reviews service could not store {} reviews of a batch; rerun to resume '
+                               'from the checkpoint'.format(failed))
+        self.dealer_ids.update(review['dealership'] for review in batch)
+        return result['created']
+
+    def finish(self):
+        for dealer_id in self.dealer_ids:
+            invalidate_dealer_pages(dealer_id)
+        if self.dealer_ids:
+            invalidate_index_pages()
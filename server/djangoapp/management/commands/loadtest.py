@@ -0,0 +1,209 @@
+"""
+End-to-end load test of the dealer views against local stand-ins for every upstream.
+"""
+import asyncio
+import json
+import os
+import queue
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client, override_settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import setup_test_environment, teardown_test_environment
+from djangoapp.caching import page_cache, sentiment_cache
+from djangoapp.clients import registry as clients
+from djangoapp.models import CarMake, CarModel
+from djangoapp.outbox import flush as flush_review_outbox
+from djangoapp.restapis import dealer_catalog
+from devtools.stubs import StubUpstream, dealerships_routes, load_seed, nlu_routes, reviews_routes
+
+SCENARIOS = ('dealerships', 'dealer_details', 'add_review')
+
+
+class Command(BaseCommand):
+    """
+    Starts stub dealership, reviews and NLU services with injected latency and a
+    dataset of any size, then drives `get_dealerships`, `get_dealer_details` and
+    `add_review` through the full middleware stack, scenario by scenario, at a
+    fixed concurrency. Reports req/s and p50/p95/p99 latency per scenario.
+
+    The views run against a throwaway test database and in-memory caches, so a
+    run needs no network access and leaves no state behind. The URLconf decides
+    which views are driven: the async ones, on an event loop, when ASYNC_VIEWS
+    is set; otherwise the sync ones, on a pool of threads.
+    """
+    help = "Load-test the dealer views end to end against local upstream stubs"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help="Requests per scenario")
+        parser.add_argument('--concurrency', type=int, default=10, help="Requests in flight")
+        parser.add_argument('--latency', type=float, default=0.05,
+                            help="Seconds of latency injected by the dealership and reviews stubs")
+        parser.add_argument('--nlu-latency', type=float, default=0.05,
+                            help="Seconds of latency injected by the NLU stub")
+        parser.add_argument('--dealers', type=int, default=50, help="Dealers served by the stub")
+        parser.add_argument('--reviews-per-dealer', type=int, default=20,
+                            help="Reviews served for each dealer")
+        parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+        parser.add_argument('--page-cache', action='store_true',
+                            help="Enable the rendered page cache during the run")
+        parser.add_argument('--no-catalog', action='store_true',
+                            help="Disable the in-process dealership catalog")
+        parser.add_argument('--output', help="Also write the results as JSON to this file")
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1 or options['concurrency'] < 1 or options['dealers'] < 1:
+            raise CommandError('--requests, --concurrency and --dealers must be positive')
+        setup_test_environment()
+        runner = DiscoverRunner(verbosity=0)
+        databases = runner.setup_databases()
+        try:
+            with ExitStack() as stack:
+                self._start_upstreams(stack, options)
+                self._seed_database(options['dealers'])
+                results = {name: self._run(name, options) for name in options['scenarios']}
+        finally:
+            runner.teardown_databases(databases)
+            teardown_test_environment()
+
+        for name, result in results.items():
+            self.stdout.write("{:<15} {:8.1f} req/s  p50 {:7.1f} ms  p95 {:7.1f} ms  p99 {:7.1f} ms"
+                              "  errors {}".format(name, result['rps'], result['p50'], result['p95'],
+                                                   result['p99'], result['errors']))
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as output:
+                json.dump({'options': {key: options[key] for key in (
+                    'requests', 'concurrency', 'latency', 'nlu_latency', 'dealers',
+                    'reviews_per_dealer', 'page_cache', 'no_catalog')}, 'results': results},
+                    output, indent=2)
+
+    def _start_upstreams(self, stack, options):
+        dealers, per_dealer = options['dealers'], options['reviews_per_dealer']
+        dealerships = stack.enter_context(StubUpstream(dealerships_routes(dealers), options['latency']))
+        reviews = stack.enter_context(StubUpstream(reviews_routes(dealers, per_dealer), options['latency']))
+        nlu = stack.enter_context(StubUpstream(nlu_routes(), options['nlu_latency']))
+        stack.enter_context(mock.patch.dict(os.environ, {
+            'NLU_API_KEY': 'stub', 'NLU_URL': nlu.url, 'NLU_IAM_URL': nlu.url}))
+        stack.enter_context(override_settings(
+            DEALERSHIPS_SERVICE_URL=dealerships.url, REVIEWS_SERVICE_URL=reviews.url,
+            DEALER_CATALOG_ENABLED=not options['no_catalog']))
+        # Start from cold, in-memory caches and clients built against the stubs
+        stack.enter_context(mock.patch.object(page_cache, 'enabled', options['page_cache']))
+        stack.enter_context(mock.patch.object(page_cache, 'alias', 'default'))
+        stack.enter_context(mock.patch.object(sentiment_cache, 'alias', 'default'))
+        sentiment_cache.memory.clear()
+        dealer_catalog.invalidate()
+        clients.reset()
+        stack.callback(clients.reset)
+        stack.callback(dealer_catalog.invalidate)
+        stack.callback(sentiment_cache.memory.clear)
+        # Send the reviews still in the outbox while the stubs are up
+        stack.callback(flush_review_outbox)
+
+    @staticmethod
+    def _seed_database(dealer_count):
+        makes = {}
+        for review in load_seed('reviews-full'):
+            if review.get('car_make'):
+                makes.setdefault(review['car_make'], set()).add((review['car_model'], review['car_year']))
+        CarMake.objects.bulk_create([CarMake(name=name, description=name) for name in makes])
+        make_ids = dict(CarMake.objects.values_list('name', 'id'))
+        cars = [(make_ids[make], name, year) for make, models in makes.items() for name, year in models]
+        CarModel.objects.bulk_create(
+            [CarModel(dealerId=dealer_id, make_id=make_id, name=name, year=year)
+             for dealer_id in range(1, dealer_count + 1)
+             for make_id, name, year in cars[dealer_id % len(cars):][:5]])
+        User.objects.create_user('loadtest', password='loadtest', first_name='Load', last_name='Test')
+
+    @staticmethod
+    def _requests(name, count, dealer_count):
+        states = sorted({dealer['state'] for dealer in load_seed('dealerships')})
+        for number in range(count):
+            dealer_id = number % dealer_count + 1
+            if name == 'dealerships':
+                yield ('get', '/djangoapp/?state=' + states[number % len(states)]) if number % 2 \
+                    else ('get', '/djangoapp/')
+            elif name == 'dealer_details':
+                yield 'get', '/djangoapp/dealer/{}'.format(dealer_id)
+            elif number % 2:
+                car = CarModel.objects.filter(dealerId=dealer_id).values_list('id', flat=True).first()
+                yield 'post', '/djangoapp/add-dealer-review/{}'.format(dealer_id), {
+                    'purchase': 'on', 'review': 'Load test review', 'purchaseDate': '01/01/2020',
+                    'carOptions': str(car)}
+            else:
+                yield 'get', '/djangoapp/add-dealer-review/{}'.format(dealer_id)
+
+    def _run(self, name, options):
+        requests = list(self._requests(name, options['requests'], options['dealers']))
+        user = User.objects.get(username='loadtest')
+        if settings.ASYNC_VIEWS:
+            timings, errors, elapsed = asyncio.run(self._run_async(requests, options['concurrency'], user))
+        else:
+            timings, errors, elapsed = self._run_sync(requests, options['concurrency'], user)
+        timings.sort()
+        return {
+            'requests': len(timings),
+            'errors': errors,
+            'rps': len(timings) / elapsed,
+            'p50': statistics.median(timings),
+            'p95': self._percentile(timings, 95),
+            'p99': self._percentile(timings, 99),
+        }
+
+    @staticmethod
+    def _percentile(timings, percent):
+        return timings[min(len(timings) - 1, int(len(timings) * percent / 100))]
+
+    @staticmethod
+    def _run_sync(requests, concurrency, user):
+        # Log every client in up front: the in-memory test database does not take
+        # concurrent writes, and serving the views only reads it
+        idle = queue.SimpleQueue()
+        for _ in range(concurrency):
+            client = Client()
+            client.force_login(user)
+            idle.put(client)
+
+        def call(request):
+            method, path, *data = request
+            client = idle.get()
+            try:
+                start = time.perf_counter()
+                response = getattr(client, method)(path, *data)
+                return (time.perf_counter() - start) * 1000, response.status_code >= 400
+            finally:
+                idle.put(client)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            outcomes = list(executor.map(call, requests))
+        elapsed = time.perf_counter() - start
+        return [ms for ms, _ in outcomes], sum(failed for _, failed in outcomes), elapsed
+
+    @staticmethod
+    async def _run_async(requests, concurrency, user):
+        client = AsyncClient()
+        # force_login is synchronous; copy its session cookie into the async client
+        login = Client()
+        await sync_to_async(login.force_login)(user)
+        client.cookies = login.cookies
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def call(request):
+            method, path, *data = request
+            async with semaphore:
+                start = time.perf_counter()
+                response = await getattr(client, method)(path, *data)
+                return (time.perf_counter() - start) * 1000, response.status_code >= 400
+
+        start = time.perf_counter()
+        outcomes = await asyncio.gather(*(call(request) for request in requests))
+        elapsed = time.perf_counter() - start
+        return [ms for ms, _ in outcomes], sum(failed for _, failed in outcomes), elapsed
@@ -1,6 +1,7 @@
 """
 Defines the models for the djangoapp app.
 """
+from typing import Any, NamedTuple, Optional
 from django.db import models
 from django.utils.timezone import now
 
@@ -38,7 +39,7 @@ class CarModel(models.Model):
     """
 
     id = models.AutoField(primary_key=True)
-    dealerId = models.IntegerField(null=False)
+    dealerId = models.IntegerField(null=False, db_index=True)
     name = models.CharField(null=False, max_length=30, default='None')
     SEDAN = 'sedan'
     SUV = 'suv'
@@ -62,39 +63,137 @@ class CarModel(models.Model):
                "Type: " + self.type + "," + \
                "Year: " + str(self.year)
 
-class DealerReview:
+
+class ReviewOutbox(models.Model):
+    """
+    A review submitted through the add-review form, waiting to be sent to the reviews service.
+
+    Attributes:
+        key (CharField): The idempotency key, sent as the review document's `_id`.
+        dealer_id (IntegerField): The ID of the reviewed dealer.
+        payload (JSONField): The review document.
+        created (DateTimeField): When the review was submitted.
+        attempts (PositiveIntegerField): The failed attempts to send the review so far.
+        next_attempt (DateTimeField): When the review is due to be sent (again).
+    """
+
+    key = models.CharField(max_length=32, unique=True)
+    dealer_id = models.IntegerField()
+    payload = models.JSONField()
+    created = models.DateTimeField(default=now)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt = models.DateTimeField(default=now, db_index=True)
+
+    def __str__(self):
+        return "Review " + self.key + " for dealer " + str(self.dealer_id)
+
+def _json_loader(record_type):
+    # Fields missing from a document take the field's default, or None for required ones
+    fields = record_type._fields
+    defaults = tuple(record_type._field_defaults.get(field) for field in fields)
+    new = tuple.__new__
+
+    def from_json(document):
+        return new(record_type, map(document.get, fields, defaults))
+    return from_json
+
+
+class DealerReview(NamedTuple):
     """
     Represents the review of a dealer.
+
+    Reviews are immutable tuples without a per-instance __dict__; use
+    `_replace(sentiment=...)` to label one.
     """
-    def __init__(self, dealership, username, name, purchase, review, review_date, purchase_date, car_make, 
-                 car_model, car_year, sentiment):
-        self.dealership = dealership
-        self.username = username
-        self.name = name
-        self.purchase = purchase
-        self.review = review
-        self.review_date = review_date
-        self.purchase_date = purchase_date
-        self.car_make = car_make
-        self.car_model = car_model
-        self.car_year = car_year
-        self.sentiment = sentiment
-
-class CarDealer:
+    dealership: int
+    name: str
+    purchase: bool
+    review: str
+    username: str = ""
+    review_date: str = ""
+    purchase_date: str = ""
+    car_make: str = ""
+    car_model: str = ""
+    car_year: Any = ""
+    sentiment: Optional[str] = None
+
+    @classmethod
+    def from_json(cls, document):
+        """
+        Build a review from a reviews service document; seeded reviews have no
+        username and reviews without a purchase have no car details.
+        """
+        return _review_from_json(document)
+
+    @classmethod
+    def from_json_list(cls, documents):
+        return list(map(_review_from_json, documents))
+
+    def to_json(self):
+        return self._asdict()
+
+
+class CarDealer(NamedTuple):
     """
     Represents a car dealer.
+
+    Dealers are immutable tuples without a per-instance __dict__, so the
+    in-memory dealer catalog stays small.
     """
+    address: str
+    city: str
+    full_name: str
+    id: int
+    lat: Any
+    long: Any
+    short_name: str
+    state: str
+    zip: str
+
+    @classmethod
+    def from_json(cls, document):
+        """
+        Build a dealer from a dealership service document.
+        """
+        return _dealer_from_json(document)
 
-    def __init__(self, address, city, full_name, id, lat, long, short_name, state, zip):
-        self.address = address
-        self.city = city
-        self.full_name = full_name
-        self.id = id
-        self.lat = lat
-        self.long = long
-        self.short_name = short_name
-        self.state = state
-        self.zip = zip
+    @classmethod
+    def from_json_list(cls, documents):
+        return list(map(_dealer_from_json, documents))
+
+    def to_json(self):
+        return self._asdict()
 
     def __str__(self):
         return "Dealer name: " + self.full_name
+
+
+class DealerReviewSummary(NamedTuple):
+    """
+    Aggregates of a dealer's reviews, maintained by the reviews service as reviews are posted.
+
+    `sentiment` maps each label to its number of reviews; `top_makes` lists the
+    most reviewed car makes as `{"make": ..., "reviews": ...}` objects.
+    """
+    dealership: int
+    reviews: int = 0
+    purchases: int = 0
+    purchase_ratio: Optional[float] = None
+    sentiment: Optional[dict] = None
+    top_makes: Optional[list] = None
+
+    @classmethod
+    def from_json(cls, document):
+        return _summary_from_json(document)
+
+    @classmethod
+    def from_json_list(cls, documents):
+        return list(map(_summary_from_json, documents))
+
+    def to_json(self):
+        return self._asdict()
+
+
+_review_from_json = _json_loader(DealerReview)
+_dealer_from_json = _json_loader(CarDealer)
+_summary_from_json = _json_loader(DealerReviewSummary)
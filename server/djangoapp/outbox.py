@@ -0,0 +1,134 @@
+"""
+Durable write-behind outbox for reviews submitted through the add-review form.
+
+`enqueue_review()` stores a review in the ReviewOutbox table and returns at
+once, so submitting a review costs one local insert whatever the state of the
+reviews service. A background thread in each process sends the due reviews to
+the service's bulk endpoint, `settings.REVIEW_OUTBOX_BATCH_SIZE` at a time,
+and deletes each one the service reports as stored.
+
+Each review travels with its outbox key as the document `_id`, and the
+service skips an `_id` it already holds. A batch retried after a lost
+response, or sent by two processes at once, is therefore stored only once.
+A review that failed, alone or with its whole batch, is retried with
+exponential backoff, at most `settings.REVIEW_OUTBOX_MAX_ATTEMPTS` times;
+`manage.py flush_review_outbox` sends what is left at once.
+"""
+import logging
+import threading
+import uuid
+from datetime import timedelta
+from django.conf import settings
+from django.db import close_old_connections
+from django.utils.timezone import now
+from .caching import invalidate_dealer_pages, invalidate_index_pages
+from .models import ReviewOutbox
+from .restapis import post_reviews
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+def enqueue_review(review):
+    """
+    Queue `review` for the reviews service and return its outbox entry.
+    """
+    entry = ReviewOutbox.objects.create(key=uuid.uuid4().hex, dealer_id=review['dealership'],
+                                        payload=review)
+    outbox_worker.wake()
+    return entry
+
+
+def retry_delay(attempts):
+    """
+    Return the seconds to wait before the next attempt after `attempts` failed ones.
+    """
+    return min(settings.REVIEW_OUTBOX_RETRY_DELAY * 2 ** (attempts - 1),
+               settings.REVIEW_OUTBOX_RETRY_MAX_DELAY)
+
+
+def due_entries():
+    return ReviewOutbox.objects.filter(next_attempt__lte=now(),
+                                       attempts__lt=settings.REVIEW_OUTBOX_MAX_ATTEMPTS)
+
+
+def flush_batch(batch_size=None):
+    """
+    Send one batch of due reviews; return the number of reviews sent and the number that failed.
+
+    Only the reviews the service reports as stored, or as stored before, leave
+    the outbox; the others are retried.
+    """
+    entries = list(due_entries().order_by('next_attempt', 'id')[:batch_size or settings.REVIEW_OUTBOX_BATCH_SIZE])
+    if not entries:
+        return 0, 0
+    answer = post_reviews([dict(entry.payload, _id=entry.key) for entry in entries])
+    statuses = (answer or {}).get('results') or {}
+    sent = [entry for entry in entries if statuses.get(entry.key) in ('stored', 'conflict')]
+    failed = [entry for entry in entries if statuses.get(entry.key) not in ('stored', 'conflict')]
+
+    if failed:
+        for entry in failed:
+            entry.attempts += 1
+            entry.next_attempt = now() + timedelta(seconds=retry_delay(entry.attempts))
+            if entry.attempts == settings.REVIEW_OUTBOX_MAX_ATTEMPTS:
+                logger.error("Giving up on review %s after %d attempts", entry.key, entry.attempts)
+        ReviewOutbox.objects.bulk_update(failed, ['attempts', 'next_attempt'])
+        logger.warning("Could not send %d queued reviews; retrying later", len(failed))
+    if sent:
+        ReviewOutbox.objects.filter(pk__in=[entry.pk for entry in sent]).delete()
+        for dealer_id in {entry.dealer_id for entry in sent}:
+            invalidate_dealer_pages(dealer_id)
+        # The index shows every dealer's review summary
+        invalidate_index_pages()
+    return len(sent), len(failed)
+
+
+def flush(batch_size=None):
+    """
+    Send due reviews batch by batch until none are left or a batch fails; return the totals sent and failed.
+    """
+    sent = failed = 0
+    while True:
+        batch_sent, batch_failed = flush_batch(batch_size)
+        sent, failed = sent + batch_sent, failed + batch_failed
+        if not batch_sent:
+            return sent, failed
+
+
+class OutboxWorker:
+    """
+    Background thread flushing the outbox when a review is queued, and every
+    `settings.REVIEW_OUTBOX_FLUSH_INTERVAL` seconds for the retries.
+
+    The thread starts with the worker process (see gunicorn.conf.py), so the
+    reviews left by a previous process are sent, or else with the first review
+    queued. Reviews queued while a batch is in flight go out together in the
+    next one.
+    """
+
+    def __init__(self):
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def wake(self):
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='review-outbox', daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(settings.REVIEW_OUTBOX_FLUSH_INTERVAL)
+            self._wakeup.clear()
+            try:
+                flush()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception("Flushing the review outbox failed")
+            finally:
+                close_old_connections()
+
+
+outbox_worker = OutboxWorker()
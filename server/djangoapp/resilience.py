@@ -0,0 +1,192 @@
+"""
+Circuit breakers and per-request deadlines for upstream calls.
+
+Every upstream service has a `CircuitBreaker`. After
+`settings.CIRCUIT_FAILURE_THRESHOLD` consecutive failures the breaker opens,
+and calls to that service fail at once instead of tying up a worker. Once
+`settings.CIRCUIT_RESET_TIMEOUT` seconds have passed, one trial call is let
+through to probe the service.
+
+`DeadlineMiddleware` gives each request a time budget of
+`settings.REQUEST_DEADLINE` seconds. Upstream calls never wait longer than
+what is left of it, and once the budget is spent further calls are skipped.
+Skipped or failed calls mark their service as degraded for the request, so
+views can render what they have and leave such pages out of the cache.
+"""
+import asyncio
+import contextvars
+import logging
+import threading
+import time
+from django.conf import settings
+from django.http import HttpResponse
+
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+_budget = contextvars.ContextVar('request_budget', default=None)
+
+
+class UpstreamUnavailable(Exception):
+    """
+    Raised by a view that cannot render anything useful without a degraded service.
+    """
+
+
+class CircuitBreaker:
+    """
+    Consecutive-failure circuit breaker for one upstream service.
+
+    Attributes:
+        state (str): "closed" (calls flow), "open" (calls fail fast) or
+            "half-open" (one trial call is in flight).
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """
+        Return whether a call may go ahead now.
+        """
+        if self.state == 'closed':
+            return True
+        with self._lock:
+            # A trial call that never reported back is replaced by a new one
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = 'half-open'
+                self.opened_at = time.monotonic()
+                logger.info("Circuit for %s is half-open; sending a trial call", self.name)
+                return True
+            return False
+
+    def record_success(self):
+        if self.state != 'closed' or self.failures:
+            with self._lock:
+                if self.state != 'closed':
+                    logger.info("Circuit for %s closed", self.name)
+                self.state = 'closed'
+                self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == 'half-open' or self.failures >= self.failure_threshold:
+                if self.state != 'open':
+                    logger.warning("Circuit for %s opened after %d failures", self.name, self.failures)
+                self.state = 'open'
+                self.opened_at = time.monotonic()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(service):
+    """
+    Return the circuit breaker of `service`, creating it on first use.
+    """
+    breaker = _breakers.get(service)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.setdefault(service, CircuitBreaker(
+                service, settings.CIRCUIT_FAILURE_THRESHOLD, settings.CIRCUIT_RESET_TIMEOUT))
+    return breaker
+
+
+def breakers():
+    return dict(_breakers)
+
+
+class RequestBudget:
+    """
+    The deadline of one request and the services it had to do without.
+    """
+
+    def __init__(self, seconds):
+        self.deadline = time.monotonic() + seconds if seconds else None
+        self.degraded = set()
+
+    def remaining(self):
+        return None if self.deadline is None else self.deadline - time.monotonic()
+
+
+def remaining():
+    """
+    Return the seconds left in the current request's budget, or None without a deadline.
+    """
+    budget = _budget.get()
+    return None if budget is None else budget.remaining()
+
+
+def upstream_timeout(connect, read):
+    """
+    Return the `(connect, read)` timeout for an upstream call, capped by the request's budget.
+
+    Returns None when the budget is already spent and the call should be skipped.
+    """
+    left = remaining()
+    if left is None:
+        return connect, read
+    if left <= 0:
+        return None
+    return min(connect, left), min(read, left)
+
+
+def mark_degraded(service):
+    budget = _budget.get()
+    if budget is not None:
+        budget.degraded.add(service)
+
+
+def degraded_services():
+    """
+    Return the services the current request had to skip or could not reach.
+    """
+    budget = _budget.get()
+    return frozenset() if budget is None else frozenset(budget.degraded)
+
+
+class DeadlineMiddleware:
+    """
+    Opens a `RequestBudget` for every request and turns `UpstreamUnavailable` into a 503.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(self.get_response):
+            # Mark the instance as a coroutine function, as Django's MiddlewareMixin does
+            self._is_coroutine = asyncio.coroutines._is_coroutine  # pylint: disable=protected-access
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        token = _budget.set(RequestBudget(settings.REQUEST_DEADLINE))
+        try:
+            return self.get_response(request)
+        finally:
+            _budget.reset(token)
+
+    async def __acall__(self, request):
+        token = _budget.set(RequestBudget(settings.REQUEST_DEADLINE))
+        try:
+            return await self.get_response(request)
+        finally:
+            _budget.reset(token)
+
+    @staticmethod
+    def process_exception(request, exception):
+        if isinstance(exception, UpstreamUnavailable):
+            response = HttpResponse("This page is temporarily unavailable, please try again shortly.",
+                                    status=503, content_type='text/plain')
+            response['Retry-After'] = str(settings.CIRCUIT_RESET_TIMEOUT)
+            return response
+        return None
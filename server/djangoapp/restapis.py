@@ -1,104 +1,642 @@
 import requests
 import json
-from .models import CarDealer, DealerReview
-from requests.auth import HTTPBasicAuth
+import logging
+import itertools
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import partial
+from django.conf import settings
+from .caching import dealerships_generation, sentiment_cache
+from .clients import registry as clients
+from .instrumentation import submit_in_context, track_upstream, upstream_service
+from .catalog import DealershipCatalog
+from .models import CarDealer, DealerReview, DealerReviewSummary
+from .resilience import get_breaker, mark_degraded, remaining, upstream_timeout
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from ibm_watson import NaturalLanguageUnderstandingV1
 from ibm_cloud_sdk_core.authenticators import IAMAuthenticator
 from ibm_watson.natural_language_understanding_v1 import Features, SentimentOptions
 import os
 
-def get_request(url, **kwargs):
-    print(kwargs)
-    print("GET from {} ".format(url))
+# Get an instance of a logger
+logger = logging.getLogger(__name__)
+
+
+class DeadlineRetry(Retry):
+    """
+    urllib3 retry policy that stops retrying once the current request's deadline has passed.
+    """
+
+    def increment(self, *args, **kwargs):  # pylint: disable=arguments-differ
+        left = remaining()
+        if left is not None and left <= 0:
+            # Exhaust the policy, so urllib3 raises as it would after the last attempt
+            return Retry.increment(self.new(total=0), *args, **kwargs)
+        return super().increment(*args, **kwargs)
+
+
+def _build_session():
+    """
+    Build a keep-alive session whose connection pool is shared by every upstream call.
+
+    Only GETs are retried on read errors and 5xx responses; connection failures are
+    retried for any method because the request never reached the server.
+    """
+    retry = DeadlineRetry(total=settings.UPSTREAM_RETRIES,
+                          backoff_factor=settings.UPSTREAM_BACKOFF_FACTOR,
+                          status_forcelist=(502, 503, 504),
+                          allowed_methods=frozenset(['GET']),
+                          raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=settings.UPSTREAM_POOL_SIZE,
+                          pool_maxsize=settings.UPSTREAM_POOL_SIZE,
+                          max_retries=retry)
+    session = requests.Session()
+    session.headers.update({'Content-Type': 'application/json'})
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+clients.register('upstream_session', _build_session)
+clients.register('upstream_fanout', lambda: ThreadPoolExecutor(
+    max_workers=settings.UPSTREAM_FANOUT_WORKERS, thread_name_prefix='upstream'))
+
+
+def get_session():
+    """
+    Return this worker's pooled session, creating it on first use.
+    """
+    return clients.get('upstream_session')
+
+
+def _send(method, url, service=None, **kwargs):
+    """
+    Send one request to an upstream service through its circuit breaker.
+
+    The timeout is capped by what is left of the current request's deadline.
+    Returns None, and marks the service degraded for the request, when the call
+    is skipped or fails; 5xx responses are returned but count as failures.
+    """
+    service = service or upstream_service(url)
+    breaker = get_breaker(service)
+    timeout = upstream_timeout(settings.UPSTREAM_CONNECT_TIMEOUT, settings.UPSTREAM_READ_TIMEOUT)
+    if timeout is None or not breaker.allow():
+        logger.warning("Skipping %s %s: %s", method, url,
+                       "request deadline exceeded" if timeout is None else "circuit open")
+        mark_degraded(service)
+        return None
     try:
-        # Call get method of requests library with URL and parameters
-        response = requests.get(url, headers={'Content-Type': 'application/json'},
-                                params=kwargs)
-    except:
-        # If any error occurs
-        print("Network exception occurred")
-    status_code = response.status_code
-    print("With status {} ".format(status_code))
-    json_data = json.loads(response.text)
-    return json_data
+        with track_upstream(service):
+            response = get_session().request(method, url, timeout=timeout, **kwargs)
+    except requests.exceptions.RequestException as err:
+        logger.error("Network exception occurred on %s %s: %s", method, url, err)
+        breaker.record_failure()
+        mark_degraded(service)
+        return None
+    if response.status_code >= 500:
+        breaker.record_failure()
+        mark_degraded(service)
+    else:
+        breaker.record_success()
+    return response
+
+
+def _parse_json(response):
+    logger.debug("With status %s", response.status_code)
+    try:
+        return response.json()
+    except ValueError:
+        logger.warning("Invalid JSON from %s (status %s)", response.url, response.status_code)
+        return None
+
+
+def _timed(call):
+    start = time.perf_counter()
+    result = call()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def fetch_concurrently(local_calls=None, **calls):
+    """
+    Run independent upstream calls at the same time instead of one after the other.
+
+    Each keyword maps a name to a zero-argument callable run on the upstream pool.
+    `local_calls` maps names to callables that must stay on the calling thread, such
+    as ORM queries bound to the request's database connection; they run while the
+    pooled calls are in flight. Returns a `(results, timings)` pair of dicts keyed
+    by name, with each call's duration in milliseconds.
+    """
+    executor = clients.get('upstream_fanout')
+    futures = {name: submit_in_context(executor, _timed, call) for name, call in calls.items()}
+    results = {}
+    timings = {}
+    for name, call in (local_calls or {}).items():
+        results[name], timings[name] = _timed(call)
+    for name, future in futures.items():
+        results[name], timings[name] = future.result()
+    logger.info("Upstream timings (ms): %s",
+                ", ".join("{}={:.1f}".format(name, ms) for name, ms in timings.items()))
+    return results, timings
+
+
+def _get(url, params):
+    logger.debug("GET from %s %s", url, params)
+    return _send('GET', url, params=params)
+
+
+def get_request(url, **kwargs):
+    """
+    GET `url` with `kwargs` as query parameters and return the decoded JSON body.
+
+    Returns None when the upstream is unreachable or answers with something that is not JSON.
+    """
+    response = _get(url, kwargs)
+    return None if response is None else _parse_json(response)
+
+
+def iter_json_array(chunks):
+    """
+    Incrementally decode a JSON array arriving as text chunks, yielding each element.
+
+    Raises ValueError when the text is not a JSON array or ends before the array does.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    # An element that could not be decoded yet is tried again once the text from its
+    # start has doubled, so that a large element costs linear time, not quadratic
+    retry_at = 0
+    for chunk in itertools.chain(chunks, [None]):
+        if chunk is not None:
+            buffer += chunk
+            if len(buffer) < retry_at:
+                continue
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position == len(buffer):
+                break
+            if not started:
+                if buffer[position] != '[':
+                    raise ValueError("Expected a JSON array")
+                started = True
+                position += 1
+                continue
+            if buffer[position] == ']':
+                return
+            try:
+                element, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                end = None
+            # A number not yet followed by a delimiter may go on in the next chunk, as "-0." does
+            if end is None or (chunk is not None and isinstance(element, (int, float))
+                               and buffer[end:end + 1] not in (' ', '\t', '\r', '\n', ',', ']')):
+                retry_at = position + 2 * (len(buffer) - position)
+                break
+            position = end
+            yield element
+        buffer = buffer[position:]
+        retry_at -= position
+    raise ValueError("Truncated JSON array")
+
+
+class InvalidBookmark(ValueError):
+    """
+    Raised for a page bookmark that was not issued by the catalog or the microservice.
+    """
+
+
+def check_page_response(response, bookmark):
+    """
+    Raise InvalidBookmark when the microservice rejected `bookmark`; return whether `response` holds a page.
+    """
+    if response.status_code == 400 and bookmark:
+        raise InvalidBookmark(bookmark)
+    if response.status_code != 200:
+        logger.warning("Listing %s failed with status %s", response.url, response.status_code)
+        return False
+    return True
+
+
+def get_page(url, **kwargs):
+    """
+    GET one page of a paginated listing.
+
+    Returns the decoded JSON body and the bookmark of the next page, which the
+    microservices send in the X-Bookmark header unless this page is the last.
+    """
+    response = _get(url, kwargs)
+    if response is None or not check_page_response(response, kwargs.get('bookmark')):
+        return None, None
+    return _parse_json(response), response.headers.get('X-Bookmark')
+
+
+def _fetch_dealers(**kwargs):
+    """
+    Fetch every dealership matching `kwargs`, following the service's page bookmarks.
+    """
+    url = settings.DEALERSHIPS_SERVICE_URL + "/dealerships/get"
+    documents = []
+    params = dict(kwargs, limit=settings.MAX_PAGE_SIZE)
+    while True:
+        page, bookmark = get_page(url, **params)
+        if page is None:
+            return None
+        documents.extend(page)
+        if not bookmark:
+            return documents
+        params['bookmark'] = bookmark
+
+
+dealer_catalog = DealershipCatalog(loader=_fetch_dealers, build=CarDealer.from_json,
+                                   ttl=settings.DEALER_CATALOG_TTL, generation=dealerships_generation,
+                                   sync_interval=settings.DEALER_CATALOG_SYNC_INTERVAL)
+
+CATALOG_BOOKMARK_PREFIX = 'catalog:'
+
 
 def get_dealers_from_cf(**kwargs):
-    url = "http://localhost:3000/dealerships/get"
+    """
+    Return CarDealer objects, optionally filtered by `dealer_id` or `state`.
+
+    Lookups are served from the in-process dealer catalog when it is enabled and
+    loaded; otherwise the dealership service is queried directly.
+    """
+    if settings.DEALER_CATALOG_ENABLED and dealer_catalog.is_loaded():
+        if 'dealer_id' in kwargs:
+            dealer = dealer_catalog.get(kwargs['dealer_id'])
+            return [dealer] if dealer else []
+        if 'state' in kwargs:
+            return dealer_catalog.by_state(kwargs['state'])
+        return dealer_catalog.all()
+
     results = []
     # Check if dealer_id is in kwargs
     if 'dealer_id' in kwargs:
         dealer_id = kwargs['dealer_id']
         # Call get_request with a URL parameter
-        json_result = get_request(url, id=dealer_id)
+        json_result = _fetch_dealers(id=dealer_id)
     elif 'state' in kwargs:
         state = kwargs['state']
-        print("state: {}".format(state))
-        json_result = get_request(url, state=state)
+        json_result = _fetch_dealers(state=state)
     else:
-        json_result = get_request(url)
+        json_result = _fetch_dealers()
 
     if json_result:
-        dealers = json_result
-        for dealer in dealers:
-            dealer_obj = CarDealer(address=dealer["address"], city=dealer["city"], full_name=dealer["full_name"],
-                                   id=dealer["id"], lat=dealer["lat"], long=dealer["long"],
-                                   short_name=dealer["short_name"],
-                                   state=dealer["state"], zip=dealer["zip"])
-            results.append(dealer_obj)
+        results = CarDealer.from_json_list(json_result)
 
     return results
 
-def analyze_review_sentiments(text):
+
+def _catalog_offset(bookmark):
+    if not bookmark:
+        return 0
+    offset = bookmark[len(CATALOG_BOOKMARK_PREFIX):]
+    if not (offset.isascii() and offset.isdigit()):
+        raise InvalidBookmark(bookmark)
+    return int(offset)
+
+
+def catalog_page(state, page_size, bookmark):
+    """
+    Return one page of the loaded dealer catalog, optionally in `state`, and the next page's bookmark.
+    """
+    dealers = dealer_catalog.by_state(state) if state else dealer_catalog.all()
+    offset = _catalog_offset(bookmark)
+    end = offset + page_size
+    next_bookmark = CATALOG_BOOKMARK_PREFIX + str(end) if end < len(dealers) else None
+    return dealers[offset:end], next_bookmark
+
+
+def catalog_dealers_by_ids(dealer_ids):
+    """
+    Return the dealers of the loaded dealer catalog with `dealer_ids`, keyed by dealer id.
+    """
+    return {dealer.id: dealer for dealer in map(dealer_catalog.get, dealer_ids) if dealer}
+
+
+def get_dealers_page_from_cf(state=None, page_size=None, bookmark=None):
+    """
+    Return one page of dealerships, optionally in `state`, and the next page's bookmark.
+
+    Pages come from the dealer catalog when it is loaded, using offset bookmarks;
+    otherwise from the dealership service, using its own bookmarks. The next
+    bookmark is None on the last page.
+    """
+    page_size = page_size or settings.DEALERS_PAGE_SIZE
+    if (settings.DEALER_CATALOG_ENABLED
+            and (not bookmark or bookmark.startswith(CATALOG_BOOKMARK_PREFIX))
+            and dealer_catalog.is_loaded()):
+        return catalog_page(state, page_size, bookmark)
+
+    params = {'limit': page_size}
+    if state:
+        params['state'] = state
+    if bookmark and not bookmark.startswith(CATALOG_BOOKMARK_PREFIX):
+        params['bookmark'] = bookmark
+    page, next_bookmark = get_page(settings.DEALERSHIPS_SERVICE_URL + "/dealerships/get", **params)
+    return CarDealer.from_json_list(page or []), next_bookmark
+
+
+def get_dealer_by_id_from_cf(dealer_id):
+    """
+    Return the CarDealer with `dealer_id`, or None when the service does not know it.
+    """
+    dealers = get_dealers_from_cf(dealer_id=dealer_id)
+    return dealers[0] if dealers else None
+
+
+def id_chunks(ids, size):
+    ids = list(dict.fromkeys(ids))
+    return [ids[start:start + size] for start in range(0, len(ids), size)]
+
+
+def get_dealers_by_ids_from_cf(dealer_ids):
+    """
+    Return the CarDealer objects with `dealer_ids`, keyed by dealer id.
+
+    Served from the dealer catalog when it is loaded; otherwise the dealership
+    service looks up every id with a single `$in` query per MAX_PAGE_SIZE ids,
+    instead of one request per dealer. Unknown ids are missing from the result.
+    """
+    if settings.DEALER_CATALOG_ENABLED and dealer_catalog.is_loaded():
+        return catalog_dealers_by_ids(dealer_ids)
+    dealers = {}
+    for chunk in id_chunks(dealer_ids, settings.MAX_PAGE_SIZE):
+        json_result = get_request(settings.DEALERSHIPS_SERVICE_URL + "/dealerships/get",
+                                  ids=",".join(map(str, chunk)))
+        if isinstance(json_result, dict):
+            dealers.update((dealer.id, dealer) for dealer in CarDealer.from_json_list(json_result.values()))
+    return dealers
+
+
+def get_dealers_near(lat, lon, count, radius_km=None):
+    """
+    Return the `count` dealers nearest to (`lat`, `lon`), optionally within `radius_km`,
+    as (CarDealer, distance in km) pairs, closest first.
+
+    The dealer catalog answers from its spatial grid when it is loaded; otherwise
+    the dealership service runs the query.
+    """
+    if settings.DEALER_CATALOG_ENABLED and dealer_catalog.is_loaded():
+        return dealer_catalog.nearest(lat, lon, count, radius_km)
+    params = {'lat': lat, 'long': lon, 'limit': count}
+    if radius_km is not None:
+        params['radius'] = radius_km
+    json_result = get_request(settings.DEALERSHIPS_SERVICE_URL + "/dealerships/near", **params)
+    if not isinstance(json_result, list):
+        return []
+    return [(CarDealer.from_json(document), document['distance']) for document in json_result]
+
+
+SENTIMENT_PENDING = 'pending'
+
+
+def _build_nlu_client():
     nlu_api_key = os.environ.get('NLU_API_KEY')
     url = os.environ.get('NLU_URL')
     if not nlu_api_key or not url:
-        print('No NLU service credentials')
+        logger.warning('No NLU service credentials')
         return None
-    authenticator = IAMAuthenticator(nlu_api_key)
-    natural_language_understanding = NaturalLanguageUnderstandingV1(
-        version='2022-04-07',
+    # NLU_IAM_URL overrides the IAM token endpoint, e.g. to use a local stand-in
+    authenticator = IAMAuthenticator(nlu_api_key, url=os.environ.get('NLU_IAM_URL'))
+    clients.track_token_exchanges(authenticator.token_manager)
+    client = NaturalLanguageUnderstandingV1(
+        version=settings.NLU_VERSION,
         authenticator=authenticator
     )
-    natural_language_understanding.set_service_url(url)
-    response = natural_language_understanding.analyze(text=text, 
-        features=Features(sentiment=SentimentOptions(targets=[text])),
-        language='en').get_result()
-    label = json.dumps(response, indent=2)
+    client.set_service_url(url)
+    client.set_http_config({'timeout': (settings.UPSTREAM_CONNECT_TIMEOUT, settings.NLU_BATCH_TIMEOUT)})
+    return client
+
+
+clients.register('nlu', _build_nlu_client)
+clients.register('nlu_executor', lambda: ThreadPoolExecutor(
+    max_workers=settings.NLU_MAX_WORKERS, thread_name_prefix='nlu'))
+
+
+def get_nlu_client():
+    """
+    Return this worker's Natural Language Understanding client, or None without credentials.
+
+    The client is built once per process; its IAMAuthenticator caches the bearer
+    token and only exchanges the API key again when the token is about to expire.
+    """
+    return clients.get('nlu')
+
+
+def warm_up_clients():
+    """
+    Build the upstream clients and fetch the NLU bearer token ahead of the first request.
+    """
+    clients.warm_up()
+    natural_language_understanding = get_nlu_client()
+    if natural_language_understanding is not None:
+        try:
+            natural_language_understanding.authenticator.token_manager.get_token()
+        except Exception as err:  # pylint: disable=broad-except
+            logger.error("Unable to fetch an NLU token: %s", err)
+
+
+def _analyze_with_nlu(text):
+    natural_language_understanding = get_nlu_client()
+    if natural_language_understanding is None:
+        return None
+    breaker = get_breaker('nlu')
+    try:
+        with track_upstream('nlu'):
+            response = natural_language_understanding.analyze(text=text,
+                features=Features(sentiment=SentimentOptions(targets=[text])),
+                language='en').get_result()
+    except Exception:
+        breaker.record_failure()
+        raise
+    breaker.record_success()
     label = response['sentiment']['document']['label']
     return label
 
 
-def get_dealer_reviews_from_cf(dealer_id):
+def analyze_review_sentiments(text):
+    """
+    Return the sentiment label of `text`, asking NLU only when it is not cached.
+    """
+    label = sentiment_cache.get(text)
+    if label is None:
+        label = _analyze_with_nlu(text)
+        if label is not None:
+            sentiment_cache.set(text, label)
+    return label
+
+
+def _safe_analyze(text):
+    try:
+        return _analyze_with_nlu(text)
+    except Exception as err:  # pylint: disable=broad-except
+        logger.error("Sentiment analysis failed: %s", err)
+        return None
+
+
+def _cache_late_label(text, future):
+    label = future.result()
+    if label is not None:
+        sentiment_cache.set(text, label)
+
+
+def analyze_review_sentiments_batch(texts, timeout=None):
+    """
+    Analyze many review texts concurrently and return their labels in the same order.
+
+    Cached labels are returned without calling NLU and identical texts are
+    analyzed once. Texts still in flight when `timeout`
+    seconds (default `settings.NLU_BATCH_TIMEOUT`, capped by the request's
+    deadline) have elapsed are labelled `SENTIMENT_PENDING`, so the caller's
+    latency is bounded whatever the batch size. While the NLU circuit is open or
+    the deadline is spent, uncached texts get no label.
+    """
+    if not texts:
+        return []
+    labels = sentiment_cache.get_many(texts)
+    missing = set(texts) - set(labels)
+    if missing and get_nlu_client() is None:
+        return [labels.get(text) for text in texts]
+    if missing:
+        if timeout is None:
+            timeout = settings.NLU_BATCH_TIMEOUT
+        left = remaining()
+        if left is not None:
+            timeout = min(timeout, left)
+        if timeout <= 0 or not get_breaker('nlu').allow():
+            mark_degraded('nlu')
+            return [labels.get(text) for text in texts]
+        executor = clients.get('nlu_executor')
+        futures = {text: submit_in_context(executor, _safe_analyze, text) for text in missing}
+        wait(futures.values(), timeout=timeout)
+        computed = {}
+        for text, future in futures.items():
+            if future.done():
+                labels[text] = computed[text] = future.result()
+            else:
+                # Let a late answer still warm the cache for the next visit
+                if not future.cancel():
+                    future.add_done_callback(partial(_cache_late_label, text))
+                labels[text] = SENTIMENT_PENDING
+        sentiment_cache.set_many({text: label for text, label in computed.items()
+                                  if label is not None})
+    return [labels[text] for text in texts]
+
+
+def get_dealer_reviews_page_from_cf(dealer_id, page_size=None, bookmark=None):
+    """
+    Return one page of a dealer's reviews, labelled with sentiment, and the next page's bookmark.
+    """
     results = []
     # Call get_request with a URL parameter
-    url = "http://localhost:5000/api/get_reviews"
-    json_result = get_request(url, id=dealer_id)
+    url = settings.REVIEWS_SERVICE_URL + "/api/get_reviews"
+    params = {'id': dealer_id, 'limit': page_size or settings.REVIEWS_PAGE_SIZE}
+    if bookmark:
+        params['bookmark'] = bookmark
+    json_result, next_bookmark = get_page(url, **params)
     if json_result:
-        reviews = json_result
-        for review in reviews:
-            # Create a CarDealer object with values in `doc` object
-            review_obj = DealerReview(dealership=review["dealership"], username=review["username"], name=review["name"], purchase=review["purchase"],
-                                   review=review["review"], review_date=review.get("review_date", ""),purchase_date=review["purchase_date"], car_make=review["car_make"],
-                                   car_model=review["car_model"],
-                                   car_year=review["car_year"], sentiment="None")
-
-            review_obj.sentiment = analyze_review_sentiments(review_obj.review)
-            results.append(review_obj)
+        results = _label_sentiments(DealerReview.from_json_list(json_result))
+    return results, next_bookmark
+
+
+def _label_sentiments(results):
+    # Reviews labelled by post_review carry their sentiment; only older documents need NLU
+    unlabelled = [index for index, review_obj in enumerate(results) if review_obj.sentiment is None]
+    labels = analyze_review_sentiments_batch([results[index].review for index in unlabelled])
+    for index, label in zip(unlabelled, labels):
+        results[index] = results[index]._replace(sentiment=label)
     return results
 
+
+def get_dealer_reviews_from_cf(dealer_id, page_size=None, bookmark=None):
+    """
+    Return one page (the first unless `bookmark` is given) of a dealer's reviews.
+    """
+    return get_dealer_reviews_page_from_cf(dealer_id, page_size, bookmark)[0]
+
+def get_dealer_reviews_batch_from_cf(dealer_ids, page_size=None):
+    """
+    Return the first page of reviews of each of `dealer_ids`, labelled with sentiment, keyed by dealer id.
+
+    One request to the reviews service covers MAX_PAGE_SIZE dealers, and the
+    unlabelled reviews of all the dealers go to NLU as one batch. Dealers are missing from the result when the service
+    could not be reached.
+    """
+    url = settings.REVIEWS_SERVICE_URL + "/api/get_reviews"
+    grouped = {}
+    for chunk in id_chunks(dealer_ids, settings.MAX_PAGE_SIZE):
+        json_result = get_request(url, ids=",".join(map(str, chunk)),
+                                  limit=page_size or settings.REVIEWS_PAGE_SIZE)
+        if isinstance(json_result, dict):
+            grouped.update((int(dealer_id), reviews) for dealer_id, reviews in json_result.items())
+    results = iter(_label_sentiments(DealerReview.from_json_list(
+        [review for reviews in grouped.values() for review in reviews])))
+    return {dealer_id: list(itertools.islice(results, len(reviews))) for dealer_id, reviews in grouped.items()}
+
+
+def search_reviews(query, dealer_id=None, limit=None):
+    """
+    Return the reviews matching every word of `query`, best match first, as DealerReview objects.
+
+    The reviews service searches the review text, car make and model through a
+    full-text index; a word ending in `*` matches as a prefix. Pass `dealer_id`
+    to search one dealer's reviews only.
+    """
+    params = {'q': query, 'limit': limit or settings.REVIEWS_PAGE_SIZE}
+    if dealer_id is not None:
+        params['id'] = dealer_id
+    json_result = get_request(settings.REVIEWS_SERVICE_URL + "/api/search_reviews", **params)
+    if not isinstance(json_result, list):
+        return []
+    return DealerReview.from_json_list(json_result)
+
+
+def get_review_summaries(dealer_ids):
+    """
+    Return the review summaries of `dealer_ids` as DealerReviewSummary objects keyed by dealer id.
+
+    One request covers every dealer, and the reviews service answers from
+    aggregates it keeps up to date, without reading any review. Dealers are
+    missing from the result when the service could not be reached.
+    """
+    if not dealer_ids:
+        return {}
+    json_result = get_request(settings.REVIEWS_SERVICE_URL + "/api/review_summaries",
+                              ids=",".join(map(str, dealer_ids)))
+    if not isinstance(json_result, list):
+        return {}
+    return {summary.dealership: summary for summary in DealerReviewSummary.from_json_list(json_result)}
+
+
 # Create a `post_request` to make HTTP POST requests
 # e.g., response = requests.post(url, params=kwargs, json=payload)
 def post_request(json_payload, **kwargs):
     #microservice enpoint to post review
-    url = "http://localhost:5000/api/post_review"
-    try:
-        # Call get method of requests library with URL and parameters
-        response = requests.post(url, headers={'Content-Type': 'application/json'},
-                                params=kwargs, json=json_payload)
-    except:
-        # If any error occurs
-        print("Network exception occurred")
-    status_code = response.status_code
-    print("With status {} ".format(status_code))
-    json_data = json.loads(response.text)
-    return json_data
+    url = settings.REVIEWS_SERVICE_URL + "/api/post_review"
+    response = _send('POST', url, service='reviews', params=kwargs, json=json_payload)
+    if response is None:
+        return None
+    return _parse_json(response)
+
+
+def post_reviews(reviews):
+    """
+    Store a batch of review documents through the reviews service's bulk endpoint.
+
+    Returns the service's answer, or None on failure. The answer holds the number
+    of reviews `created` and, in `results`, the outcome of each `_id`: "stored",
+    "conflict" (stored before) or "failed". The service answers 207 when some
+    reviews failed.
+    """
+    url = settings.REVIEWS_SERVICE_URL + "/api/post_reviews"
+    response = _send('POST', url, service='reviews', json=reviews)
+    if response is None:
+        return None
+    if response.status_code not in (201, 207):
+        logger.error("Bulk review POST failed with status %s", response.status_code)
+        return None
+    return _parse_json(response)
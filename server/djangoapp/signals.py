@@ -0,0 +1,42 @@
+"""
+Keeps the dealer inventory cache in step with admin edits to car makes and models,
+and hooks the request instrumentation into every database connection.
+"""
+from django.db.backends.signals import connection_created
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import receiver
+from .caching import invalidate_dealer_inventory
+from .instrumentation import time_query
+from .models import CarMake, CarModel
+
+
+@receiver(pre_save, sender=CarModel)
+def remember_previous_dealer(sender, instance, **kwargs):
+    # A model moved to another dealer leaves the previous dealer's inventory too
+    instance._previous_dealer_id = (sender.objects.filter(pk=instance.pk)
+                                    .values_list('dealerId', flat=True).first()
+                                    if instance.pk else None)
+
+
+@receiver(post_save, sender=CarModel)
+@receiver(post_delete, sender=CarModel)
+def invalidate_car_model(sender, instance, **kwargs):
+    dealer_ids = [instance.dealerId]
+    if getattr(instance, '_previous_dealer_id', None) is not None:
+        dealer_ids.append(instance._previous_dealer_id)
+    invalidate_dealer_inventory(dealer_ids)
+
+
+@receiver(post_save, sender=CarMake)
+@receiver(post_delete, sender=CarMake)
+def invalidate_car_make(sender, instance, **kwargs):
+    # Deleting a make cascades to its models, whose own signals cover their dealers
+    invalidate_dealer_inventory(CarModel.objects.filter(make_id=instance.pk)
+                                .values_list('dealerId', flat=True))
+
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # The signal fires on every reconnect of the same connection object
+    if time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(time_query)
@@ -1,6 +1,897 @@
 """
 This module contains the unit tests for the Django app.
 """
-from django.test import TestCase
+import asyncio
+import heapq
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import unittest
+from io import StringIO
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import AsyncRequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils.timezone import now
+from devtools.stubs import ChangesFeed, StubUpstream, dealerships_routes, reviews_routes
+from . import async_restapis, views
+from .caching import (LRUCache, PageCache, SentimentCache, dealerships_generation, invalidate_all_dealer_pages,
+                      invalidate_dealer_pages, invalidate_index_pages, page_cache, sentiment_cache)
+from .catalog import DealershipCatalog
+from .changes import ChangesFollower
+from .clients import ClientRegistry, registry as clients
+from .geo import GeoGrid, haversine_km
+from .importing import Checkpoint
+from .models import CarDealer, CarModel, DealerReview, DealerReviewSummary, ReviewOutbox
+from .outbox import enqueue_review, flush_batch
+from .resilience import CircuitBreaker, get_breaker
+from .restapis import (CATALOG_BOOKMARK_PREFIX, InvalidBookmark, analyze_review_sentiments_batch, dealer_catalog,
+                       get_dealer_reviews_page_from_cf, get_dealers_page_from_cf, iter_json_array)
 
-# Create your tests here.
+
+def make_dealer(dealer_id, lat, lon, state='Texas'):
+    return CarDealer(address='', city='', full_name='Dealer {}'.format(dealer_id), id=dealer_id,
+                     lat=lat, long=lon, short_name='', state=state, zip='')
+
+
+class GeoGridTests(SimpleTestCase):
+    """
+    GeoGrid answers the same as a scan over every dealer.
+    """
+
+    def setUp(self):
+        rng = random.Random(7)
+        # A dense cluster and a few dealers scattered over the globe, some near the poles and antimeridian
+        self.dealers = [make_dealer(number, 30 + rng.gauss(0, 1), -97 + rng.gauss(0, 1))
+                        for number in range(1, 201)]
+        self.dealers += [make_dealer(number, rng.uniform(-89, 89), rng.uniform(-180, 180))
+                         for number in range(201, 231)]
+        self.dealers.append(make_dealer(231, 10, 179.9))
+        self.grid = GeoGrid()
+        self.grid.update(added=self.dealers)
+        self.queries = [(30, -97), (31.5, -95), (0, 0), (10, -179.9), (88, 20), (-60, 120)]
+
+    def brute_force(self, lat, lon, count, radius_km=None):
+        distances = ((haversine_km(lat, lon, dealer.lat, dealer.long), dealer.id) for dealer in self.dealers)
+        return heapq.nsmallest(count, ((distance, dealer_id) for distance, dealer_id in distances
+                                       if radius_km is None or distance <= radius_km))
+
+    def assert_same(self, found, expected):
+        self.assertEqual([dealer.id for dealer, _ in found], [dealer_id for _, dealer_id in expected])
+        for (_, distance), (expected_distance, _) in zip(found, expected):
+            self.assertAlmostEqual(distance, expected_distance, places=6)
+
+    def test_nearest_matches_brute_force(self):
+        for lat, lon in self.queries:
+            for count in (1, 10, 50, len(self.dealers), 1000):
+                with self.subTest(lat=lat, lon=lon, count=count):
+                    self.assert_same(self.grid.nearest(lat, lon, count), self.brute_force(lat, lon, count))
+
+    def test_nearest_within_radius_matches_brute_force(self):
+        for lat, lon in self.queries:
+            for radius_km in (10, 150, 3000):
+                with self.subTest(lat=lat, lon=lon, radius_km=radius_km):
+                    self.assert_same(self.grid.nearest(lat, lon, 1000, radius_km),
+                                     self.brute_force(lat, lon, 1000, radius_km))
+
+    def test_within_matches_brute_force(self):
+        for lat, lon in self.queries:
+            with self.subTest(lat=lat, lon=lon):
+                self.assert_same(self.grid.within(lat, lon, 500),
+                                 self.brute_force(lat, lon, len(self.dealers), 500))
+
+    def test_update_moves_and_removes_dealers(self):
+        moved = make_dealer(1, -33.9, 151.2)
+        self.grid.update(added=[moved], removed=[self.dealers[1]])
+        self.dealers = [moved] + self.dealers[2:]
+        self.assertEqual(len(self.grid), len(self.dealers))
+        self.assert_same(self.grid.nearest(-33.9, 151.2, 5), self.brute_force(-33.9, 151.2, 5))
+
+    def test_empty_grid(self):
+        self.assertEqual(GeoGrid().nearest(30, -97, 10), [])
+
+
+@mock.patch('djangoapp.outbox.outbox_worker.wake')
+class OutboxTests(TestCase):
+    """
+    Only the reviews the service reports as stored leave the outbox.
+    """
+
+    def enqueue(self, count):
+        return [enqueue_review({'dealership': 15, 'name': 'Reviewer', 'review': 'Review {}'.format(number),
+                                'purchase': False}) for number in range(count)]
+
+    def test_partial_failure_keeps_failed_reviews(self, wake):
+        stored, conflict, failed = self.enqueue(3)
+        answer = {'created': 1, 'results': {stored.key: 'stored', conflict.key: 'conflict',
+                                            failed.key: 'failed'}}
+        with mock.patch('djangoapp.outbox.post_reviews', return_value=answer) as post_reviews:
+            self.assertEqual(flush_batch(), (2, 1))
+        sent_ids = [review['_id'] for review in post_reviews.call_args[0][0]]
+        self.assertEqual(sent_ids, [stored.key, conflict.key, failed.key])
+        remaining = ReviewOutbox.objects.get()
+        self.assertEqual(remaining.key, failed.key)
+        self.assertEqual(remaining.attempts, 1)
+        self.assertGreater(remaining.next_attempt, now())
+        self.assertTrue(wake.called)
+
+    def test_unreachable_service_keeps_every_review(self, wake):
+        self.enqueue(2)
+        with mock.patch('djangoapp.outbox.post_reviews', return_value=None):
+            self.assertEqual(flush_batch(), (0, 2))
+        self.assertEqual(list(ReviewOutbox.objects.values_list('attempts', flat=True)), [1, 1])
+
+    def test_review_missing_from_answer_is_retried(self, wake):
+        first, second = self.enqueue(2)
+        with mock.patch('djangoapp.outbox.post_reviews', return_value={'results': {first.key: 'stored'}}):
+            self.assertEqual(flush_batch(), (1, 1))
+        self.assertEqual(ReviewOutbox.objects.get().key, second.key)
+
+
+def dealer_document(dealer_id, state, st, lat=32.7, lon=-96.8):
+    return {'id': dealer_id, 'full_name': 'Dealer {}'.format(dealer_id), 'city': '', 'address': '',
+            'zip': '', 'short_name': '', 'state': state, 'st': st, 'lat': lat, 'long': lon}
+
+
+class DealershipCatalogTests(SimpleTestCase):
+    """
+    The catalog indexes dealers by id and state, and reloads when told the dealerships changed.
+    """
+
+    def setUp(self):
+        self.documents = [dealer_document(1, 'Texas', 'TX'), dealer_document(2, 'Texas', 'TX'),
+                          dealer_document(3, 'Kansas', 'KS', 39.1, -94.6)]
+        self.generation = 1
+        self.catalog = DealershipCatalog(loader=lambda: self.documents, build=CarDealer.from_json, ttl=300,
+                                         generation=lambda: self.generation, sync_interval=0)
+
+    def test_lookups(self):
+        self.assertTrue(self.catalog.is_loaded())
+        self.assertEqual(self.catalog.get('2').id, 2)
+        self.assertIsNone(self.catalog.get(4))
+        self.assertEqual([dealer.id for dealer in self.catalog.by_state('texas')], [1, 2])
+        self.assertEqual([dealer.id for dealer in self.catalog.by_state('KS')], [3])
+        self.assertEqual(self.catalog.states_of(3), {'kansas', 'ks'})
+        self.assertEqual(self.catalog.states_of(4), set())
+        self.assertEqual([dealer.id for dealer, _ in self.catalog.nearest(39, -94, 1)], [3])
+
+    def test_reloads_when_the_generation_moves(self):
+        self.catalog.is_loaded()
+        self.documents = [dealer_document(1, 'Oklahoma', 'OK', 35.5, -97.5), dealer_document(3, 'Kansas', 'KS')]
+        # Unchanged generation: the loaded data stays
+        self.catalog.is_loaded()
+        self.assertEqual(self.catalog.states_of(1), {'texas', 'tx'})
+        self.generation = 2
+        self.assertTrue(self.catalog.is_loaded())
+        self.assertEqual(self.catalog.states_of(1), {'oklahoma', 'ok'})
+        self.assertIsNone(self.catalog.get(2))
+        self.assertEqual(self.catalog.by_state('tx'), [])
+        self.assertEqual([dealer.id for dealer, _ in self.catalog.nearest(35.5, -97.5, 1)], [1])
+
+    def test_failed_refresh_keeps_the_data(self):
+        self.catalog.is_loaded()
+        self.documents = None
+        self.assertFalse(self.catalog.refresh())
+        self.assertEqual(len(self.catalog.all()), 3)
+
+
+@mock.patch('djangoapp.resilience.time.monotonic')
+class CircuitBreakerTests(SimpleTestCase):
+    """
+    A breaker opens after consecutive failures and lets one trial call through after the reset timeout.
+    """
+
+    def setUp(self):
+        self.breaker = CircuitBreaker('test', failure_threshold=3, reset_timeout=30)
+
+    def open(self, monotonic):
+        monotonic.return_value = 100.0
+        for _ in range(3):
+            self.assertTrue(self.breaker.allow())
+            self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+
+    def test_opens_after_consecutive_failures(self, monotonic):
+        monotonic.return_value = 100.0
+        for _ in range(2):
+            self.breaker.record_failure()
+        # A success in between starts the count over
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.record_success()
+        self.open(monotonic)
+        monotonic.return_value = 129.0
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open_trial_success_closes(self, monotonic):
+        self.open(monotonic)
+        monotonic.return_value = 130.0
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, 'half-open')
+        # Only the trial call goes through
+        self.assertFalse(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+    def test_half_open_trial_failure_reopens(self, monotonic):
+        self.open(monotonic)
+        monotonic.return_value = 130.0
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        monotonic.return_value = 159.0
+        self.assertFalse(self.breaker.allow())
+        monotonic.return_value = 160.0
+        self.assertTrue(self.breaker.allow())
+
+
+class PaginationTests(TestCase):
+    """
+    Listings page through the catalog and the reviews service with bookmarks, and reject bookmarks
+    they did not issue with a 400 that leaves the circuit breakers alone.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.reviews_routes = reviews_routes(dealer_count=5, per_dealer=23)
+        cls.dealerships = StubUpstream(dealerships_routes(40)).start()
+        cls.reviews = StubUpstream(cls.reviews_routes).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dealerships.stop()
+        cls.reviews.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        upstreams = override_settings(DEALERSHIPS_SERVICE_URL=self.dealerships.url,
+                                      REVIEWS_SERVICE_URL=self.reviews.url)
+        upstreams.enable()
+        self.addCleanup(upstreams.disable)
+        # Without NLU credentials reviews are listed unlabelled; the test database's cache table is locked
+        # by the test's transaction for the threads fetching upstreams, so counters stay in memory
+        for patch in (mock.patch.dict(os.environ, {'NLU_API_KEY': ''}),
+                      mock.patch.object(page_cache, 'alias', 'default')):
+            patch.start()
+            self.addCleanup(patch.stop)
+        clients.reset()
+        dealer_catalog.invalidate()
+        self.addCleanup(clients.reset)
+        self.addCleanup(dealer_catalog.invalidate)
+
+    def test_catalog_pages(self):
+        dealer_ids, bookmark = [], None
+        while True:
+            page, bookmark = get_dealers_page_from_cf(page_size=15, bookmark=bookmark)
+            dealer_ids.extend(dealer.id for dealer in page)
+            if bookmark is None:
+                break
+            self.assertTrue(bookmark.startswith(CATALOG_BOOKMARK_PREFIX))
+        self.assertEqual(dealer_ids, [dealer.id for dealer in dealer_catalog.all()])
+        self.assertEqual(len(dealer_ids), 40)
+
+    @override_settings(DEALER_CATALOG_ENABLED=False)
+    def test_service_pages(self):
+        texts, bookmark, pages = [], None, 0
+        while True:
+            page, bookmark = get_dealer_reviews_page_from_cf(2, page_size=10, bookmark=bookmark)
+            texts.extend(review.review for review in page)
+            pages += 1
+            if bookmark is None:
+                break
+        expected = [review['review'] for review in self.reviews_routes['/api/get_reviews']({'id': '2'})[1]]
+        self.assertEqual(texts, expected)
+        self.assertEqual(pages, 3)
+
+    def test_rejected_bookmarks(self):
+        with self.assertRaises(InvalidBookmark):
+            get_dealers_page_from_cf(bookmark=CATALOG_BOOKMARK_PREFIX + 'zz')
+        with self.assertRaises(InvalidBookmark):
+            get_dealer_reviews_page_from_cf(2, bookmark='zz')
+
+    def test_views_answer_400_to_invalid_bookmarks(self):
+        for url in ('/djangoapp/dealer/2?bookmark=zz', '/djangoapp/dealer/2?bookmark=a%20b',
+                    '/djangoapp/?bookmark=catalog:zz', '/djangoapp/?bookmark=catalog:-5',
+                    '/djangoapp/?bookmark=zz', '/djangoapp/?bookmark=-5'):
+            for _ in range(get_breaker('reviews').failure_threshold + 1):
+                with self.subTest(url=url):
+                    self.assertEqual(self.client.get(url).status_code, 400)
+        self.assertEqual(get_breaker('reviews').state, 'closed')
+        self.assertEqual(get_breaker('dealerships').state, 'closed')
+        self.assertEqual(self.client.get('/djangoapp/dealer/2?bookmark=10').status_code, 200)
+        self.assertEqual(self.client.get('/djangoapp/?bookmark=10').status_code, 200)
+
+
+@override_settings(CHANGES_POLL_TIMEOUT=0.1, DEALER_CATALOG_ENABLED=False)
+class ChangesFollowerTests(SimpleTestCase):
+    """
+    The changes follower turns a fake `_changes` feed into invalidations and checkpoints its position.
+    """
+
+    def setUp(self):
+        self.feed = ChangesFeed(['dealerships', 'reviews'])
+        self.couch = StubUpstream(self.feed.routes()).start()
+        self.addCleanup(self.couch.stop)
+        checkpoints = tempfile.TemporaryDirectory()
+        self.addCleanup(checkpoints.cleanup)
+        self.checkpoint_dir = checkpoints.name
+        couch = override_settings(COUCH_URL=self.couch.url, CHANGES_CHECKPOINT_DIR=self.checkpoint_dir)
+        couch.enable()
+        self.addCleanup(couch.disable)
+        patches = (mock.patch.dict(os.environ, {'IAM_API_KEY': ''}),
+                   mock.patch.multiple('djangoapp.changes', invalidate_all_dealer_pages=mock.DEFAULT,
+                                       invalidate_dealer_pages=mock.DEFAULT, invalidate_dealerships=mock.DEFAULT,
+                                       invalidate_index_pages=mock.DEFAULT, invalidate_state_pages=mock.DEFAULT))
+        self.invalidate = [patch.start() for patch in patches][1]
+        for patch in patches:
+            self.addCleanup(patch.stop)
+        clients.reset()
+        self.addCleanup(clients.reset)
+
+    def record_review(self, review_id, dealer_id, deleted=False):
+        return self.feed.record('reviews', {'_id': review_id, 'dealership': dealer_id, 'review': 'Fine'}, deleted)
+
+    def invalidated(self):
+        return {name for name, invalidate in self.invalidate.items() if invalidate.called}
+
+    def test_first_start_skips_what_is_pending(self):
+        self.record_review('r1', 7)
+        follower = ChangesFollower('reviews')
+        self.assertEqual(follower.since, 'now')
+        self.assertEqual(follower.process(feed='normal'), 0)
+        self.assertEqual(self.invalidated(), set())
+        change = self.record_review('r2', 8)
+        self.assertEqual(follower.process(feed='normal'), 1)
+        self.assertEqual(follower.since, change['seq'])
+        self.invalidate['invalidate_dealer_pages'].assert_called_once_with(8)
+
+    def test_resumes_from_the_checkpoint(self):
+        follower = ChangesFollower('reviews')
+        follower.process(feed='normal')
+        change = self.record_review('r1', 7)
+        resumed = ChangesFollower('reviews')
+        self.assertEqual(resumed.since, follower.since)
+        self.assertEqual(resumed.catch_up(), 1)
+        self.assertEqual(ChangesFollower('reviews').since, change['seq'])
+        self.invalidate['invalidate_dealer_pages'].assert_called_once_with(7)
+
+    def test_checkpoint_of_another_database_url_is_ignored(self):
+        with open(os.path.join(self.checkpoint_dir, 'reviews.json'), 'w', encoding='utf-8') as checkpoint:
+            json.dump({'url': 'http://elsewhere:5984/reviews', 'since': '40-stub'}, checkpoint)
+        with self.assertLogs('djangoapp.changes', 'WARNING'):
+            self.assertEqual(ChangesFollower('reviews').since, 'now')
+
+    def test_review_retires_its_dealer_and_the_index_pages_listing_it(self):
+        follower = ChangesFollower('reviews', since='0')
+        self.record_review('r1', 7)
+        with mock.patch('djangoapp.changes.known_states', return_value={'texas', 'tx'}):
+            self.assertEqual(follower.process(feed='normal'), 1)
+        self.invalidate['invalidate_dealer_pages'].assert_called_once_with(7)
+        self.invalidate['invalidate_state_pages'].assert_called_once_with({'texas', 'tx'})
+        self.assertEqual(self.invalidated(), {'invalidate_dealer_pages', 'invalidate_state_pages'})
+
+        # Without the catalog the dealer's states are unknown, so every index page goes
+        self.record_review('r2', 9)
+        follower.process(feed='normal')
+        self.invalidate['invalidate_dealer_pages'].assert_called_with(9)
+        self.assertTrue(self.invalidate['invalidate_index_pages'].called)
+
+    def test_new_dealership_retires_its_states(self):
+        follower = ChangesFollower('dealerships', since='0')
+        self.feed.record('dealerships', dict(dealer_document(7, 'Texas', 'TX'), _id='d7'))
+        self.assertEqual(follower.process(feed='normal'), 1)
+        self.invalidate['invalidate_dealerships'].assert_called_once_with()
+        self.invalidate['invalidate_dealer_pages'].assert_called_once_with(7)
+        self.invalidate['invalidate_state_pages'].assert_called_once_with({'texas', 'tx'})
+        self.assertFalse(self.invalidate['invalidate_index_pages'].called)
+
+    def test_deletions_retire_everything(self):
+        for database, doc in (('reviews', {'_id': 'r1', 'dealership': 7}),
+                              ('dealerships', dict(dealer_document(7, 'Texas', 'TX'), _id='d7'))):
+            with self.subTest(database=database):
+                for invalidate in self.invalidate.values():
+                    invalidate.reset_mock()
+                follower = ChangesFollower(database, since='0')
+                self.feed.record(database, doc, deleted=True)
+                self.assertEqual(follower.process(feed='normal'), 1)
+                self.invalidate['invalidate_all_dealer_pages'].assert_called_once_with()
+                self.invalidate['invalidate_index_pages'].assert_called_once_with()
+                self.assertFalse(self.invalidate['invalidate_dealer_pages'].called)
+
+    def test_unusable_answers_are_not_checkpointed(self):
+        follower = ChangesFollower('reviews', since='0')
+        for payload in (b'<html>Bad gateway</html>', {'results': 'none'}, {'results': [{'seq': '1'}]},
+                        {'results': []}):
+            with self.subTest(payload=payload), self.assertLogs('djangoapp.changes', 'ERROR'):
+                self.couch.routes['/reviews/_changes'] = lambda query, payload=payload: (200, payload)
+                self.assertIsNone(follower.process(feed='normal'))
+                self.assertEqual(follower.since, '0')
+
+    def test_follow_survives_failures_to_invalidate(self):
+        change = self.record_review('r1', 7)
+        self.invalidate['invalidate_dealer_pages'].side_effect = [DatabaseError('database is locked'), None]
+        follower = ChangesFollower('reviews', since='0')
+        stop = threading.Event()
+        thread = threading.Thread(target=follower.follow, args=(stop,), daemon=True)
+        self.addCleanup(thread.join)
+        self.addCleanup(stop.set)
+        with self.assertLogs('djangoapp.changes', 'ERROR') as logs:
+            thread.start()
+            deadline = time.monotonic() + 10
+            while follower.since != change['seq'] and time.monotonic() < deadline:
+                time.sleep(0.05)
+        self.assertIn('Applying the changes of reviews failed', logs.output[0])
+        self.assertTrue(thread.is_alive())
+        self.assertEqual(follower.since, change['seq'])
+        self.assertEqual(self.invalidate['invalidate_dealer_pages'].call_count, 2)
+
+
+def split_every(text, size):
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+class IterJsonArrayTests(SimpleTestCase):
+    """
+    The incremental decoder yields the same elements as json.loads, however the text is cut into chunks.
+    """
+    ARRAY = ' [ {"id": 1, "review": "Great, \\"fast\\" [service]"} ,\n{"id": 2, "tags": [1, 2]}, 12345, ' \
+            '"text", true, null, -0.5e3 ]  '
+
+    def test_any_split_point(self):
+        expected = json.loads(self.ARRAY)
+        for cut in range(len(self.ARRAY) + 1):
+            with self.subTest(cut=cut):
+                chunks = [self.ARRAY[:cut], self.ARRAY[cut:]]
+                self.assertEqual(list(iter_json_array(chunks)), expected)
+
+    def test_small_chunks(self):
+        for size in (1, 2, 3, 7):
+            with self.subTest(size=size):
+                self.assertEqual(list(iter_json_array(split_every(self.ARRAY, size))), json.loads(self.ARRAY))
+
+    def test_whitespace_and_commas_at_chunk_edges(self):
+        chunks = ['[', ' \n', '{"id": 1}', ' ,', ' ', '{"id": 2}', '\t', ', {"id"', ': 3}', '  ', ']']
+        self.assertEqual(list(iter_json_array(chunks)), [{'id': 1}, {'id': 2}, {'id': 3}])
+        self.assertEqual(list(iter_json_array(['[', ']'])), [])
+
+    def test_large_element(self):
+        element = {'review': 'x' * 100000, 'id': 7}
+        text = json.dumps([element, element])
+        self.assertEqual(list(iter_json_array(split_every(text, 10))), [element, element])
+
+    def test_truncated_array(self):
+        for text in ('', '[', '[{"id": 1}, {"id"', '[{"id": 1}, 12', '[{"id": 1}'):
+            with self.subTest(text=text), self.assertRaisesMessage(ValueError, 'Truncated JSON array'):
+                list(iter_json_array(split_every(text, 4)))
+        # The elements received before the cut are still yielded
+        elements = iter_json_array(['[{"id": 1}, {"id": 2}, {"id"'])
+        self.assertEqual([next(elements), next(elements)], [{'id': 1}, {'id': 2}])
+        with self.assertRaises(ValueError):
+            next(elements)
+
+    def test_not_an_array(self):
+        for text in ('{"reviews": []}', '"text"', '12'):
+            with self.subTest(text=text), self.assertRaisesMessage(ValueError, 'Expected a JSON array'):
+                list(iter_json_array([text]))
+
+
+class PageCacheTests(TestCase):
+    """
+    Dealer pages are rendered from a cached fragment inside a per-user page, with per-user ETags.
+    """
+
+    def setUp(self):
+        # An in-memory store keeps the counters out of the test transaction's cache table
+        for patch in (mock.patch.object(page_cache, 'enabled', True),
+                      mock.patch.object(page_cache, 'alias', 'default'),
+                      mock.patch('djangoapp.views.get_dealer_by_id_from_cf',
+                                 return_value=make_dealer(2, 32.7, -96.8))):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.reviews = [DealerReview(dealership=2, name='Berkly Shepley', purchase=False,
+                                     review='Total grid-enabled service-desk', sentiment='positive')]
+        loader = mock.patch('djangoapp.views.get_dealer_reviews_page_from_cf',
+                            side_effect=lambda *args: (self.reviews, None))
+        self.load_reviews = loader.start()
+        self.addCleanup(loader.stop)
+        caches['default'].clear()
+        self.addCleanup(caches['default'].clear)
+        users = get_user_model().objects
+        self.alice = users.create_user('alice', first_name='Alice', password='unused-password')
+        self.bob = users.create_user('bob', first_name='Bob', password='unused-password')
+
+    def get(self, user=None, **headers):
+        if user is None:
+            self.client.logout()
+        else:
+            self.client.force_login(user)
+        return self.client.get('/djangoapp/dealer/2', **headers)
+
+    def test_hit_skips_the_upstreams(self):
+        first, second = self.get(), self.get()
+        self.assertEqual(self.load_reviews.call_count, 1)
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertContains(second, 'Total grid-enabled service-desk')
+
+    def test_invalidation_retires_the_scope_and_its_family(self):
+        self.get()
+        invalidate_index_pages()
+        self.get()
+        self.assertEqual(self.load_reviews.call_count, 1)
+        invalidate_dealer_pages(2)
+        self.get()
+        self.assertEqual(self.load_reviews.call_count, 2)
+        invalidate_all_dealer_pages()
+        self.get()
+        self.assertEqual(self.load_reviews.call_count, 3)
+
+    def test_pending_sentiment_is_not_cached(self):
+        self.reviews = [self.reviews[0]._replace(sentiment='pending')]
+        self.get()
+        self.get()
+        self.assertEqual(self.load_reviews.call_count, 2)
+
+    def test_etag_is_per_user(self):
+        alice_etag = self.get(self.alice)['ETag']
+        self.assertEqual(self.get(self.alice, HTTP_IF_NONE_MATCH=alice_etag).status_code, 304)
+        bob_page = self.get(self.bob, HTTP_IF_NONE_MATCH=alice_etag)
+        self.assertEqual(bob_page.status_code, 200)
+        self.assertNotEqual(bob_page['ETag'], alice_etag)
+        self.assertIn('Cookie', bob_page['Vary'])
+        self.assertEqual(self.get(None, HTTP_IF_NONE_MATCH=alice_etag).status_code, 200)
+
+    def test_no_user_sees_another_users_page(self):
+        self.assertContains(self.get(self.alice), 'Alice(alice)')
+        bob_page = self.get(self.bob)
+        self.assertContains(bob_page, 'Bob(bob)')
+        self.assertNotContains(bob_page, 'alice')
+        # Signed-in users share the fragment; anonymous visitors get their own, without the review link
+        self.assertEqual(self.load_reviews.call_count, 1)
+        anonymous_page = self.get()
+        self.assertNotContains(anonymous_page, 'Bob(bob)')
+        self.assertNotContains(anonymous_page, 'Add Your Review!')
+        self.assertContains(anonymous_page, 'Login to add a review')
+        self.assertEqual(self.load_reviews.call_count, 2)
+
+    def test_disabled_cache_renders_every_time(self):
+        page_cache.enabled = False
+        etags = {self.get()['ETag'], self.get()['ETag']}
+        self.assertEqual(self.load_reviews.call_count, 2)
+        self.assertEqual(len(etags), 1)
+        # Nor do the dealer catalogs poll the cache for dealership changes
+        with mock.patch.object(PageCache, 'generations') as generations:
+            self.assertIsNone(dealerships_generation())
+        generations.assert_not_called()
+
+
+def in_event_loop():
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+class AsyncViewTests(SimpleTestCase):
+    """
+    The asynchronous views serve the same pages as the synchronous ones without blocking the event loop.
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.dealerships = StubUpstream(dealerships_routes(40)).start()
+        cls.reviews = StubUpstream(reviews_routes(dealer_count=5, per_dealer=23)).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.dealerships.stop()
+        cls.reviews.stop()
+        super().tearDownClass()
+
+    def setUp(self):
+        upstreams = override_settings(DEALERSHIPS_SERVICE_URL=self.dealerships.url,
+                                      REVIEWS_SERVICE_URL=self.reviews.url)
+        upstreams.enable()
+        self.addCleanup(upstreams.disable)
+        # Labels and pages are cached in memory, out of the database this test case may not use
+        self.loaded_in_loop = []
+        is_loaded = dealer_catalog.is_loaded
+        for patch in (mock.patch.dict(os.environ, {'NLU_API_KEY': ''}),
+                      mock.patch.object(page_cache, 'alias', 'default'),
+                      mock.patch.object(sentiment_cache, 'alias', 'default'),
+                      mock.patch.object(dealer_catalog, 'is_loaded',
+                                        lambda: self.loaded_in_loop.append(in_event_loop()) or is_loaded())):
+            patch.start()
+            self.addCleanup(patch.stop)
+        clients.reset()
+        dealer_catalog.invalidate()
+        self.addCleanup(clients.reset)
+        self.addCleanup(dealer_catalog.invalidate)
+        self.factory = AsyncRequestFactory()
+
+    async def get(self, view, path, *args):
+        request = self.factory.get(path)
+        request.user = AnonymousUser()
+        return await view(request, *args)
+
+    async def test_index_pages_the_catalog_off_the_event_loop(self):
+        response = await self.get(views.get_dealerships_async, '/djangoapp/?page_size=15')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '/djangoapp/dealer/15"')
+        self.assertNotContains(response, '/djangoapp/dealer/16"')
+        self.assertContains(response, 'bookmark=catalog%3A15')
+        dealers = await async_restapis.get_dealers_by_ids_from_cf([3, 99, 7])
+        self.assertEqual(sorted(dealers), [3, 7])
+        self.assertTrue(self.loaded_in_loop)
+        self.assertNotIn(True, self.loaded_in_loop)
+
+    async def test_dealer_details_page_through_the_reviews(self):
+        response = await self.get(views.get_dealer_details_async, '/djangoapp/dealer/2?page_size=10', 2)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'bookmark=10')
+        response = await self.get(views.get_dealer_details_async, '/djangoapp/dealer/2?bookmark=20', 2)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotContains(response, 'bookmark=')
+
+    async def test_invalid_bookmarks_get_400(self):
+        for view, path, args in ((views.get_dealerships_async, '/djangoapp/?bookmark=catalog:zz', ()),
+                                 (views.get_dealer_details_async, '/djangoapp/dealer/2?bookmark=zz', (2,))):
+            with self.subTest(path=path):
+                response = await self.get(view, path, *args)
+                self.assertEqual(response.status_code, 400)
+
+    async def test_late_labels_warm_the_sentiment_cache(self):
+        async def analyze(text, client=None):
+            await asyncio.sleep(0.3 if text == 'Slow answer' else 0)
+            return 'positive'
+
+        with mock.patch.object(async_restapis, 'analyze_review_sentiments', analyze), \
+                mock.patch.object(async_restapis, 'get_nlu_client', return_value=object()):
+            labels = await async_restapis.analyze_review_sentiments_batch(['Quick answer', 'Slow answer'],
+                                                                          timeout=0.1)
+            self.assertEqual(labels, ['positive', 'pending'])
+            self.assertIsNone(sentiment_cache.get('Slow answer'))
+            await asyncio.gather(*async_restapis._late_analyses)
+        self.assertEqual(sentiment_cache.get('Slow answer'), 'positive')
+
+
+class SentimentCacheTests(TestCase):
+    """
+    Labels are found in the process's LRU, then in the shared database table, under a versioned key.
+    """
+
+    def setUp(self):
+        caches['sentiment'].clear()
+        self.cache = SentimentCache(maxsize=2, alias='sentiment', version='2022-04-07')
+
+    def test_lru_evicts_the_least_recently_used(self):
+        lru = LRUCache(2)
+        lru.set('a', 1)
+        lru.set('b', 2)
+        self.assertEqual(lru.get('a'), 1)
+        lru.set('c', 3)
+        self.assertIsNone(lru.get('b'))
+        self.assertEqual((lru.get('a'), lru.get('c'), len(lru)), (1, 3, 2))
+        self.assertEqual((lru.hits, lru.misses), (3, 1))
+
+    def test_lookups_fall_back_to_the_table(self):
+        self.cache.set_many({'Great service': 'positive', 'Slow service': 'negative', 'Fine': 'neutral'})
+        self.assertEqual(caches['sentiment'].get(self.cache.key('Great service')), 'positive')
+        # The LRU kept the last two labels; the first is read back from the table and promoted
+        self.assertEqual(self.cache.get_many(['Slow service', 'Fine']),
+                         {'Slow service': 'negative', 'Fine': 'neutral'})
+        self.assertEqual(self.cache.get('Great service'), 'positive')
+        self.assertIsNone(self.cache.get('Never analyzed'))
+        self.assertEqual(self.cache.stats(), {'memory_hits': 2, 'store_hits': 1, 'misses': 1, 'memory_size': 2})
+        self.assertEqual(self.cache.get('Great service'), 'positive')
+        self.assertEqual(self.cache.stats()['memory_hits'], 3)
+
+    def test_keys_change_with_the_model_version(self):
+        self.cache.set('Great service', 'positive')
+        self.assertEqual(SentimentCache(2, 'sentiment', '2022-04-07').get('Great service'), 'positive')
+        newer = SentimentCache(2, 'sentiment', '2023-01-01')
+        self.assertNotEqual(newer.key('Great service'), self.cache.key('Great service'))
+        self.assertIsNone(newer.get('Great service'))
+        self.assertEqual(newer.stats()['misses'], 1)
+
+
+class SentimentBatchTests(SimpleTestCase):
+    """
+    A batch answers within its timeout, labelling slow texts pending, and late answers still warm the cache.
+    """
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.analyzed = []
+
+        def analyze(text):
+            self.analyzed.append(text)
+            if text.startswith('Slow'):
+                self.release.wait(5)
+            return 'positive'
+
+        for patch in (mock.patch.object(sentiment_cache, 'alias', 'default'),
+                      mock.patch('djangoapp.restapis.get_nlu_client', return_value=object()),
+                      mock.patch('djangoapp.restapis._analyze_with_nlu', side_effect=analyze)):
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.addCleanup(self.release.set)
+        caches['default'].clear()
+        sentiment_cache.memory.clear()
+        self.addCleanup(sentiment_cache.memory.clear)
+
+    def test_slow_texts_are_pending_and_cached_when_they_arrive(self):
+        started = time.monotonic()
+        labels = analyze_review_sentiments_batch(['Quick', 'Slow', 'Quick'], timeout=0.2)
+        self.assertLess(time.monotonic() - started, 2)
+        self.assertEqual(labels, ['positive', 'pending', 'positive'])
+        self.assertEqual(sorted(self.analyzed), ['Quick', 'Slow'])
+        self.assertIsNone(sentiment_cache.get('Slow'))
+        self.release.set()
+        deadline = time.monotonic() + 5
+        while sentiment_cache.get('Slow') is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(sentiment_cache.get('Slow'), 'positive')
+        self.assertEqual(analyze_review_sentiments_batch(['Slow', 'Quick'], timeout=0.2), ['positive', 'positive'])
+        self.assertEqual(len(self.analyzed), 2)
+
+    def test_without_nlu_texts_stay_unlabelled(self):
+        with mock.patch('djangoapp.restapis.get_nlu_client', return_value=None):
+            self.assertEqual(analyze_review_sentiments_batch(['Quick']), [None])
+        self.assertEqual(self.analyzed, [])
+
+
+class ClientRegistryTests(SimpleTestCase):
+    """
+    Clients are built once per process, including a None answer, and again in a forked child.
+    """
+
+    def test_clients_are_built_once(self):
+        registry = ClientRegistry()
+        factory = mock.Mock(side_effect=object)
+        registry.register('service', factory)
+        registry.register('missing', lambda: None)
+        self.assertIs(registry.get('service'), registry.get('service'))
+        self.assertIsNone(registry.get('missing'))
+        self.assertIsNone(registry.get('missing'))
+        self.assertEqual(registry.stats()['clients'], {'service': {'constructions': 1, 'lookups': 2},
+                                                       'missing': {'constructions': 1, 'lookups': 2}})
+        registry.reset()
+        registry.get('service')
+        self.assertEqual(factory.call_count, 2)
+
+    @unittest.skipUnless(hasattr(os, 'fork'), "Needs os.fork")
+    def test_forked_child_builds_its_own_clients(self):
+        clients.register('test-service', object)
+        self.addCleanup(clients.reset)
+        self.addCleanup(clients._factories.pop, 'test-service')
+        parent_client = clients.get('test-service')
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # The child reports what its registry holds, then leaves without running the parent's cleanups
+            try:
+                constructions = clients.stats()['clients']['test-service']['constructions']
+                rebuilt = clients.get('test-service') is not parent_client
+                os.write(write_end, json.dumps([constructions, rebuilt]).encode())
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        with os.fdopen(read_end) as report:
+            child = json.loads(report.read())
+        os.waitpid(pid, 0)
+        self.assertEqual(child, [0, True])
+        self.assertIs(clients.get('test-service'), parent_client)
+
+
+class RecordTests(SimpleTestCase):
+    """
+    Records are built from service documents, defaulting missing fields and ignoring unknown ones.
+    """
+
+    def test_review_defaults_missing_fields(self):
+        review = DealerReview.from_json({'_id': 'r1', '_rev': '1-a', 'id': 7, 'dealership': 2,
+                                         'name': 'Berkly Shepley', 'purchase': False, 'review': 'Fine'})
+        self.assertEqual(review, DealerReview(dealership=2, name='Berkly Shepley', purchase=False, review='Fine'))
+        self.assertEqual((review.username, review.car_year, review.sentiment), ('', '', None))
+        self.assertFalse(hasattr(review, '__dict__'))
+        self.assertEqual(DealerReview.from_json(review.to_json()), review)
+        self.assertEqual(review._replace(sentiment='positive').sentiment, 'positive')
+
+    def test_required_fields_default_to_none(self):
+        self.assertEqual(DealerReview.from_json({}), DealerReview(None, None, None, None))
+        self.assertIsNone(CarDealer.from_json({'st': 'TX'}).state)
+
+    def test_dealer_keeps_known_fields(self):
+        document = {'_id': 'd1', 'address': '3 Nova Court', 'city': 'El Paso',
+                    'full_name': 'Holdlamis Car Dealership', 'id': 1, 'lat': 31.69, 'long': -106.3, 'short_name': 'Holdlamis', 'st': 'TX',
+                    'state': 'Texas', 'zip': '88563'}
+        dealer = CarDealer.from_json(document)
+        self.assertEqual(dealer.to_json(), {key: value for key, value in document.items()
+                                            if key not in ('_id', 'st')})
+        self.assertEqual(CarDealer.from_json_list([document, document]), [dealer, dealer])
+
+    def test_summary_defaults(self):
+        summary = DealerReviewSummary.from_json({'dealership': 3, 'reviews': 4, 'extra': True})
+        self.assertEqual(summary, DealerReviewSummary(dealership=3, reviews=4))
+        self.assertEqual((summary.purchases, summary.purchase_ratio, summary.top_makes), (0, None, None))
+
+
+class MetricsAccessTests(TestCase):
+    """
+    /metrics answers staff users and scrapers with the bearer token, and nobody else.
+    """
+
+    def setUp(self):
+        users = get_user_model().objects
+        self.staff = users.create_user('staff', password='unused-password', is_staff=True)
+        self.customer = users.create_user('customer', password='unused-password')
+
+    @override_settings(METRICS_TOKEN='')
+    def test_forbidden_without_staff_or_token(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer ').status_code, 403)
+        self.client.force_login(self.customer)
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+
+    @override_settings(METRICS_TOKEN='scrape-secret')
+    def test_bearer_token_or_staff(self):
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'djangoapp_circuit_open')
+        for header in ('Bearer wrong-secret', 'scrape-secret', 'Basic scrape-secret'):
+            with self.subTest(header=header):
+                self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION=header).status_code, 403)
+        self.client.force_login(self.staff)
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+
+class ImportCarsTests(TestCase):
+    """
+    An interrupted import resumes from its checkpoint without storing any car twice.
+    """
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cars.json')
+        cars = [{'make': make, 'name': name, 'type': 'suv', 'year': 2020, 'dealer_id': 2}
+                for make, name in (('Audi', 'Q5'), ('Audi', 'Q7'), ('BMW', 'X3'), ('BMW', 'X5'), ('Kia', 'Niro'))]
+        with open(self.path, 'w', encoding='utf-8') as source:
+            json.dump({'cars': cars}, source)
+
+    def import_cars(self):
+        output = StringIO()
+        call_command('import_cars', self.path, batch_size=2, stdout=output)
+        return output.getvalue()
+
+    def test_resumes_after_a_crash_between_a_commit_and_its_checkpoint(self):
+        save = Checkpoint.save
+        saves = []
+
+        def crash_on_second_save(checkpoint, done):
+            saves.append(done)
+            if len(saves) == 2:
+                raise RuntimeError('Killed')
+            save(checkpoint, done)
+
+        with mock.patch.object(Checkpoint, 'save', crash_on_second_save), self.assertRaises(RuntimeError):
+            self.import_cars()
+        # The second batch was committed, but the checkpoint still says two records
+        self.assertEqual(CarModel.objects.count(), 4)
+        output = self.import_cars()
+        self.assertIn('Resuming after 2 records already imported', output)
+        self.assertIn('Imported 3 records (1 stored)', output)
+        self.assertEqual(sorted(CarModel.objects.values_list('make__name', 'name')),
+                         [('Audi', 'Q5'), ('Audi', 'Q7'), ('BMW', 'X3'), ('BMW', 'X5'), ('Kia', 'Niro')])
+        self.assertFalse(os.path.exists(self.path + '.checkpoint'))
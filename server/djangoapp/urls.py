@@ -24,12 +24,22 @@ urlpatterns = [
     path(route='logout', view=views.logout_request, name='logout'),
 
     # path for dealerships view
-    path(route='', view=views.get_dealerships, name='get_dealerships'),
+    path(route='', view=views.get_dealerships_async if settings.ASYNC_VIEWS else views.get_dealerships,
+         name='get_dealerships'),
+
+    # path for the dealerships nearest to a point
+    path(route='near',
+         view=views.get_dealers_near_me_async if settings.ASYNC_VIEWS else views.get_dealers_near_me,
+         name='dealers_near'),
 
     # path for dealer reviews view
-    path(route='dealer/<int:dealer_id>', view=views.get_dealer_details, name='dealer_details'),
+    path(route='dealer/<int:dealer_id>',
+         view=views.get_dealer_details_async if settings.ASYNC_VIEWS else views.get_dealer_details,
+         name='dealer_details'),
 
     # path for add a review view
-    path(route='add-dealer-review/<int:dealer_id>', view=views.add_review, name='add_review'),
+    path(route='add-dealer-review/<int:dealer_id>',
+         view=views.add_review_async if settings.ASYNC_VIEWS else views.add_review,
+         name='add_review'),
 
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
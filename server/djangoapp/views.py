@@ -4,37 +4,162 @@ This module provides views for the dealership application.
 It includes views to render the index page, about page, contact page, 
 and handle user authentication including login, logout, and registration.
 """
+import asyncio
 import logging
-import json
-from django.http import HttpResponseNotAllowed, HttpResponse
+import re
+import time
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponseNotAllowed, HttpResponse, HttpResponseBadRequest, Http404
 from django.contrib.auth import get_user_model
 from django.shortcuts import render, redirect
-from .restapis import get_dealers_from_cf, get_dealer_reviews_from_cf, post_request
+from django.template.loader import render_to_string
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.utils.safestring import mark_safe
+from . import async_restapis
+from .caching import page_cache, get_dealer_inventory, index_scope
+from .restapis import (get_dealers_page_from_cf, get_dealer_by_id_from_cf,
+                       get_dealer_reviews_page_from_cf, get_dealers_near, get_review_summaries,
+                       fetch_concurrently, InvalidBookmark, SENTIMENT_PENDING)
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
-from .models import CarDealer, CarMake, CarModel, DealerReview
+from django.contrib.auth.views import redirect_to_login
+from .outbox import enqueue_review
+from .resilience import UpstreamUnavailable, degraded_services
 import datetime
-from datetime import date
 
 # Get an instance of a logger
 logger = logging.getLogger(__name__)
 
+# The catalog's offsets, the services' offsets and Cloudant's base64 bookmarks all fit this
+BOOKMARK_PATTERN = re.compile(r'[\w:=-]{1,2048}', re.ASCII)
+INVALID_BOOKMARK = "Invalid bookmark; use the one linked from the previous page"
+
+
+def add_server_timing(response, timings):
+    """
+    Report per-upstream durations (in milliseconds) in the response's Server-Timing header.
+    """
+    response['Server-Timing'] = ", ".join(
+        "{};dur={:.1f}".format(name, duration) for name, duration in timings.items())
+    return response
+
+
+def render_cached_page(request, template_name, fragment_name, scope, key_parts, load_context):
+    """
+    Render `template_name` around a page fragment that is cached under `scope`.
+
+    `load_context` is only called on a cache miss and returns the fragment's context,
+    the per-upstream timings and whether the result may be cached. The response
+    carries an ETag and Last-Modified so unchanged pages are answered with a 304.
+    """
+    timings = {}
+    entry = page_cache.get(scope, key_parts)
+    if entry is None:
+        try:
+            context, timings, cacheable = load_context()
+        except InvalidBookmark:
+            return HttpResponseBadRequest(INVALID_BOOKMARK)
+        content = render_to_string(fragment_name, context, request)
+        entry = page_cache.set(scope, key_parts, content, cacheable=cacheable)
+    return respond_with_fragment(request, template_name, entry, timings)
+
+
+def respond_with_fragment(request, template_name, entry, timings):
+    """
+    Build the response for a page fragment `entry` produced by `page_cache.set`.
+    """
+    # The navbar around the fragment differs per user, so the ETag does too
+    etag = quote_etag("{}-{}".format(entry["etag"], request.user.pk or 0))
+    last_modified = int(entry["modified"])
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        response = render(request, template_name, {"content": mark_safe(entry["content"])})
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    patch_vary_headers(response, ('Cookie',))
+    return add_server_timing(response, timings)
+
+
+def get_page_params(request, default_page_size):
+    """
+    Read the `page_size` and `bookmark` query parameters of a paginated listing.
+
+    Returns None when the bookmark cannot have come from a previous page.
+    """
+    try:
+        page_size = int(request.GET.get("page_size", default_page_size))
+    except ValueError:
+        page_size = default_page_size
+    page_size = min(max(page_size, 1), settings.MAX_PAGE_SIZE)
+    bookmark = request.GET.get("bookmark") or None
+    if bookmark is not None and not BOOKMARK_PATTERN.fullmatch(bookmark):
+        return None
+    return page_size, bookmark
+
 
 def get_dealerships(request):
     """
     Get the list of dealerships from a remote server and render them in the index.html template.
     """
+    if request.method != "GET":
+        return HttpResponseNotAllowed("GET")
     state = request.GET.get("state", None)
-    context = {}
-    if state:
-        dealerships = get_dealers_from_cf(state=state)
-        context["state"] = state
-    else:
-        dealerships = get_dealers_from_cf()
-    context["dealerships"] = dealerships
-    if request.method == "GET":
-        return render(request, 'djangoapp/index.html', context)
-    return HttpResponseNotAllowed("GET")
+    params = get_page_params(request, settings.DEALERS_PAGE_SIZE)
+    if params is None:
+        return HttpResponseBadRequest(INVALID_BOOKMARK)
+    page_size, bookmark = params
+
+    def load_context():
+        dealerships, next_bookmark = get_dealers_page_from_cf(state, page_size, bookmark)
+        summaries = get_review_summaries([dealer.id for dealer in dealerships])
+        degraded = degraded_services()
+        context = {"state": state, "dealerships": dealerships, "degraded": degraded,
+                   "rows": [(dealer, summaries.get(dealer.id)) for dealer in dealerships],
+                   "page_size": page_size, "next_bookmark": next_bookmark}
+        return context, {}, not degraded
+
+    return render_cached_page(request, 'djangoapp/index.html', 'djangoapp/fragments/dealerships.html',
+                              index_scope(state), (state, page_size, bookmark), load_context)
+
+def get_near_params(request):
+    """
+    Read the `lat`, `long`, `count` and `radius` (km) query parameters of a nearby search.
+
+    Returns None when the coordinates are missing or invalid.
+    """
+    try:
+        lat = float(request.GET["lat"])
+        lon = float(request.GET["long"])
+        count = min(max(int(request.GET.get("count", settings.NEAR_DEALERS_COUNT)), 1),
+                    settings.MAX_PAGE_SIZE)
+        radius_km = float(request.GET["radius"]) if request.GET.get("radius") else None
+    except (KeyError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lon <= 180) or (radius_km is not None and radius_km <= 0):
+        return None
+    return lat, lon, count, radius_km
+
+
+def render_dealers_near(request, params, nearby):
+    context = {"lat": params[0], "long": params[1], "count": params[2], "radius": params[3],
+               "nearby": nearby, "degraded": degraded_services()}
+    content = render_to_string('djangoapp/fragments/dealers_near.html', context, request)
+    return render(request, 'djangoapp/index.html', {"content": mark_safe(content)})
+
+
+def get_dealers_near_me(request):
+    """
+    List the dealerships nearest to the `lat`/`long` query parameters, optionally within `radius` km.
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed("GET")
+    params = get_near_params(request)
+    if params is None:
+        return HttpResponseBadRequest("Expected numeric lat and long, and optionally count and radius")
+    return render_dealers_near(request, params, get_dealers_near(*params))
+
 
 def about(request):
     """
@@ -110,16 +235,54 @@ def registration_request(request):
         return redirect("djangoapp:get_dealerships")
     return HttpResponseNotAllowed(["GET", "POST"])
 
+def check_dealer_found(dealer, degraded):
+    """
+    Raise Http404 for a missing dealer, or UpstreamUnavailable (a 503) when it could not be looked up.
+    """
+    if dealer is None:
+        if "dealerships" in degraded:
+            raise UpstreamUnavailable("The dealerships service is unavailable")
+        raise Http404("Dealer not found")
+
+
 def get_dealer_details(request, dealer_id):
     """
     Get the details of a specific dealer.
     """
-    reviews = get_dealer_reviews_from_cf(dealer_id)
-    dealership = get_dealers_from_cf(dealer_id=dealer_id)[0]
-    context = {"dealership": dealership, "reviews": reviews}
-    if request.method == "GET":
-        return render(request, 'djangoapp/dealer_details.html', context)
-    return HttpResponseNotAllowed("GET")
+    if request.method != "GET":
+        return HttpResponseNotAllowed("GET")
+    params = get_page_params(request, settings.REVIEWS_PAGE_SIZE)
+    if params is None:
+        return HttpResponseBadRequest(INVALID_BOOKMARK)
+    page_size, bookmark = params
+
+    def load_context():
+        # The dealership and its reviews come from different services; fetch both at once
+        results, timings = fetch_concurrently(
+            dealership=lambda: get_dealer_by_id_from_cf(dealer_id),
+            reviews=lambda: get_dealer_reviews_page_from_cf(dealer_id, page_size, bookmark))
+        degraded = degraded_services()
+        check_dealer_found(results["dealership"], degraded)
+        reviews, next_bookmark = results["reviews"]
+        context = {"dealership": results["dealership"], "reviews": reviews, "degraded": degraded,
+                   "page_size": page_size, "next_bookmark": next_bookmark}
+        # Pages still waiting on sentiment or missing a service are rendered but not cached
+        cacheable = not degraded and all(review.sentiment != SENTIMENT_PENDING for review in reviews)
+        return context, timings, cacheable
+
+    return render_cached_page(request, 'djangoapp/dealer_details.html',
+                              'djangoapp/fragments/dealer_details.html', 'dealer:{}'.format(dealer_id),
+                              (request.user.is_authenticated, page_size, bookmark), load_context)
+
+
+def find_car(dealer_id, car_model_id):
+    """
+    Return the dealer's car model with id `car_model_id`, or None if the dealer has no such car.
+    """
+    for car in get_dealer_inventory(dealer_id):
+        if str(car.id) == car_model_id:
+            return car
+    return None
 
 
 @login_required(login_url='/djangoapp/login')
@@ -127,12 +290,16 @@ def add_review(request, dealer_id):
     """
     Add a review for a specific dealer.
     """
-    dealership = get_dealers_from_cf(dealer_id=dealer_id)[0]
-    cars = CarModel.objects.filter(dealerId=dealer_id)
-    context = {"dealership": dealership , "cars": cars}
     if request.method == "GET":
-        return render(request, 'djangoapp/add_review.html', context)
-        
+        # The inventory query runs on this thread's DB connection while the dealer is fetched
+        results, timings = fetch_concurrently(
+            local_calls={"cars": lambda: get_dealer_inventory(dealer_id)},
+            dealership=lambda: get_dealer_by_id_from_cf(dealer_id))
+        check_dealer_found(results["dealership"], degraded_services())
+        context = {"dealership": results["dealership"], "cars": results["cars"]}
+        response = render(request, 'djangoapp/add_review.html', context)
+        return add_server_timing(response, timings)
+
     if request.method == "POST":
         review = {}
         review["purchase"] = request.POST.get("purchase")
@@ -146,12 +313,147 @@ def add_review(request, dealer_id):
             if "purchaseDate" not in request.POST or "carOptions" not in request.POST:
                 return HttpResponse("Missing required fields", status=400)
             review["purchase_date"] = request.POST.get("purchaseDate")
-            car_model_id = request.POST.get("carOptions")
-            car = CarModel.objects.get(id=car_model_id)
+            car = find_car(dealer_id, request.POST.get("carOptions"))
+            if car is None:
+                return HttpResponse("Unknown car model", status=400)
+            review["car_model"] = car.name
+            review["car_make"] = car.make.name
+            review["car_year"] = car.year
+        # Stored locally and sent in the background; the outbox refreshes the cached pages once it lands
+        enqueue_review(review)
+        return redirect('djangoapp:dealer_details', dealer_id=dealer_id)
+    return HttpResponseNotAllowed(["GET", "POST"])
+
+
+# Asynchronous variants of the upstream-bound views, for deployments under djangobackend.asgi.
+# They are routed in place of the synchronous views when settings.ASYNC_VIEWS is set.
+
+async def render_cached_page_async(request, template_name, fragment_name, scope, key_parts,
+                                   load_context):
+    """
+    Like `render_cached_page`, with `load_context` a coroutine function.
+    """
+    timings = {}
+    entry = await sync_to_async(page_cache.get)(scope, key_parts)
+    if entry is None:
+        try:
+            context, timings, cacheable = await load_context()
+        except InvalidBookmark:
+            return HttpResponseBadRequest(INVALID_BOOKMARK)
+        content = await sync_to_async(render_to_string)(fragment_name, context, request)
+        entry = await sync_to_async(page_cache.set)(scope, key_parts, content, cacheable=cacheable)
+    return await sync_to_async(respond_with_fragment)(request, template_name, entry, timings)
+
+
+async def timed(coroutine):
+    start = time.perf_counter()
+    result = await coroutine
+    return result, (time.perf_counter() - start) * 1000
+
+
+async def get_dealerships_async(request):
+    """
+    Asynchronous variant of `get_dealerships`.
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed("GET")
+    state = request.GET.get("state", None)
+    params = get_page_params(request, settings.DEALERS_PAGE_SIZE)
+    if params is None:
+        return HttpResponseBadRequest(INVALID_BOOKMARK)
+    page_size, bookmark = params
+
+    async def load_context():
+        dealerships, next_bookmark = await async_restapis.get_dealers_page_from_cf(
+            state, page_size, bookmark)
+        summaries = await async_restapis.get_review_summaries([dealer.id for dealer in dealerships])
+        degraded = degraded_services()
+        context = {"state": state, "dealerships": dealerships, "degraded": degraded,
+                   "rows": [(dealer, summaries.get(dealer.id)) for dealer in dealerships],
+                   "page_size": page_size, "next_bookmark": next_bookmark}
+        return context, {}, not degraded
+
+    return await render_cached_page_async(request, 'djangoapp/index.html',
+                                          'djangoapp/fragments/dealerships.html',
+                                          index_scope(state), (state, page_size, bookmark), load_context)
+
+
+async def get_dealers_near_me_async(request):
+    """
+    Asynchronous variant of `get_dealers_near_me`.
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed("GET")
+    params = get_near_params(request)
+    if params is None:
+        return HttpResponseBadRequest("Expected numeric lat and long, and optionally count and radius")
+    nearby = await async_restapis.get_dealers_near(*params)
+    return await sync_to_async(render_dealers_near)(request, params, nearby)
+
+
+async def get_dealer_details_async(request, dealer_id):
+    """
+    Asynchronous variant of `get_dealer_details`.
+    """
+    if request.method != "GET":
+        return HttpResponseNotAllowed("GET")
+    is_authenticated = await sync_to_async(lambda: request.user.is_authenticated)()
+    params = get_page_params(request, settings.REVIEWS_PAGE_SIZE)
+    if params is None:
+        return HttpResponseBadRequest(INVALID_BOOKMARK)
+    page_size, bookmark = params
+
+    async def load_context():
+        (dealership, dealer_ms), ((reviews, next_bookmark), reviews_ms) = await asyncio.gather(
+            timed(async_restapis.get_dealer_by_id_from_cf(dealer_id)),
+            timed(async_restapis.get_dealer_reviews_page_from_cf(dealer_id, page_size, bookmark)))
+        degraded = degraded_services()
+        check_dealer_found(dealership, degraded)
+        cacheable = not degraded and all(review.sentiment != SENTIMENT_PENDING for review in reviews)
+        context = {"dealership": dealership, "reviews": reviews, "degraded": degraded,
+                   "page_size": page_size, "next_bookmark": next_bookmark}
+        return context, {"dealership": dealer_ms, "reviews": reviews_ms}, cacheable
+
+    return await render_cached_page_async(request, 'djangoapp/dealer_details.html',
+                                          'djangoapp/fragments/dealer_details.html',
+                                          'dealer:{}'.format(dealer_id),
+                                          (is_authenticated, page_size, bookmark), load_context)
+
+
+async def add_review_async(request, dealer_id):
+    """
+    Asynchronous variant of `add_review`.
+    """
+    if not await sync_to_async(lambda: request.user.is_authenticated)():
+        return redirect_to_login(request.get_full_path(), '/djangoapp/login')
+
+    if request.method == "GET":
+        (dealership, dealer_ms), (cars, cars_ms) = await asyncio.gather(
+            timed(async_restapis.get_dealer_by_id_from_cf(dealer_id)),
+            timed(sync_to_async(get_dealer_inventory)(dealer_id)))
+        check_dealer_found(dealership, degraded_services())
+        context = {"dealership": dealership, "cars": cars}
+        response = await sync_to_async(render)(request, 'djangoapp/add_review.html', context)
+        return add_server_timing(response, {"dealership": dealer_ms, "cars": cars_ms})
+
+    if request.method == "POST":
+        review = {}
+        review["purchase"] = request.POST.get("purchase")
+        review["review"] = request.POST.get("review")
+        review["dealership"] = dealer_id
+        review["username"] = request.user.username
+        review["name"] = request.user.first_name + " " + request.user.last_name
+        review["review_date"] = datetime.datetime.now().isoformat()
+        if request.POST.get("purchase"):
+            if "purchaseDate" not in request.POST or "carOptions" not in request.POST:
+                return HttpResponse("Missing required fields", status=400)
+            review["purchase_date"] = request.POST.get("purchaseDate")
+            car = await sync_to_async(find_car)(dealer_id, request.POST.get("carOptions"))
+            if car is None:
+                return HttpResponse("Unknown car model", status=400)
             review["car_model"] = car.name
             review["car_make"] = car.make.name
             review["car_year"] = car.year
-        payload = review
-        post_request(payload, dealer_id=dealer_id)
+        await sync_to_async(enqueue_review)(review)
         return redirect('djangoapp:dealer_details', dealer_id=dealer_id)
     return HttpResponseNotAllowed(["GET", "POST"])
@@ -43,6 +43,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'djangoapp.instrumentation.PerformanceMiddleware',
+    'djangoapp.resilience.DeadlineMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,7 +58,8 @@ ROOT_URLCONF = 'djangobackend.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates with render times reported to djangoapp.instrumentation
+        'BACKEND': 'djangoapp.instrumentation.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -125,3 +128,118 @@ STATIC_URL = 'static/'
 STATIC_ROOT = os.path.join(BASE_DIR, 'static')
 MEDIA_ROOT = os.path.join(STATIC_ROOT, 'media')
 MEDIA_URL = '/media/'
+
+
+# Upstream microservices (dealerships, reviews)
+# Every worker keeps one pooled keep-alive session; see djangoapp.restapis.get_session
+
+DEALERSHIPS_SERVICE_URL = os.environ.get('DEALERSHIPS_SERVICE_URL', 'http://localhost:3000')
+REVIEWS_SERVICE_URL = os.environ.get('REVIEWS_SERVICE_URL', 'http://localhost:5000')
+
+UPSTREAM_POOL_SIZE = int(os.environ.get('UPSTREAM_POOL_SIZE', 10))
+UPSTREAM_CONNECT_TIMEOUT = float(os.environ.get('UPSTREAM_CONNECT_TIMEOUT', 3.05))
+UPSTREAM_READ_TIMEOUT = float(os.environ.get('UPSTREAM_READ_TIMEOUT', 10))
+UPSTREAM_RETRIES = int(os.environ.get('UPSTREAM_RETRIES', 2))
+UPSTREAM_BACKOFF_FACTOR = float(os.environ.get('UPSTREAM_BACKOFF_FACTOR', 0.2))
+UPSTREAM_FANOUT_WORKERS = int(os.environ.get('UPSTREAM_FANOUT_WORKERS', 8))
+
+# Listings are fetched and rendered one page at a time; ?page_size= is capped at MAX_PAGE_SIZE
+DEALERS_PAGE_SIZE = int(os.environ.get('DEALERS_PAGE_SIZE', 50))
+REVIEWS_PAGE_SIZE = int(os.environ.get('REVIEWS_PAGE_SIZE', 25))
+MAX_PAGE_SIZE = 200
+
+# Route the upstream-bound views to their async variants; only worthwhile under djangobackend.asgi,
+# e.g. `gunicorn -k uvicorn.workers.UvicornWorker djangobackend.asgi`
+ASYNC_VIEWS = os.environ.get('ASYNC_VIEWS', 'false').lower() in ('1', 'true', 'yes')
+ASYNC_UPSTREAM_MAX_CONNECTIONS = int(os.environ.get('ASYNC_UPSTREAM_MAX_CONNECTIONS', 200))
+
+# Dealerships are served from an in-process catalog refreshed in the background every TTL seconds
+DEALER_CATALOG_ENABLED = os.environ.get('DEALER_CATALOG_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+DEALER_CATALOG_TTL = int(os.environ.get('DEALER_CATALOG_TTL', 300))
+# How often, in seconds, each catalog checks the page cache for changes announced by follow_changes;
+# without PAGE_CACHE_ENABLED the catalogs do not check and only reload after DEALER_CATALOG_TTL
+DEALER_CATALOG_SYNC_INTERVAL = float(os.environ.get('DEALER_CATALOG_SYNC_INTERVAL', 1.0))
+# Dealers listed by the nearby search (/djangoapp/near) unless ?count= says otherwise
+NEAR_DEALERS_COUNT = int(os.environ.get('NEAR_DEALERS_COUNT', 10))
+
+# Each upstream gets a circuit breaker that opens after this many consecutive failures and lets a
+# trial call through after RESET_TIMEOUT seconds; every request must finish its upstream calls within
+# REQUEST_DEADLINE seconds (0 disables it) and renders without what is left over
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', 5))
+CIRCUIT_RESET_TIMEOUT = int(os.environ.get('CIRCUIT_RESET_TIMEOUT', 30))
+REQUEST_DEADLINE = float(os.environ.get('REQUEST_DEADLINE', 8.0))
+
+# Reviews from the add-review form wait in a local outbox and are sent in the background, BATCH_SIZE at
+# a time; a failed batch is retried after RETRY_DELAY seconds, doubling up to RETRY_MAX_DELAY, at most
+# MAX_ATTEMPTS times, and due retries are looked for every FLUSH_INTERVAL seconds
+REVIEW_OUTBOX_BATCH_SIZE = int(os.environ.get('REVIEW_OUTBOX_BATCH_SIZE', 100))
+REVIEW_OUTBOX_FLUSH_INTERVAL = float(os.environ.get('REVIEW_OUTBOX_FLUSH_INTERVAL', 5))
+REVIEW_OUTBOX_RETRY_DELAY = float(os.environ.get('REVIEW_OUTBOX_RETRY_DELAY', 2))
+REVIEW_OUTBOX_RETRY_MAX_DELAY = float(os.environ.get('REVIEW_OUTBOX_RETRY_MAX_DELAY', 300))
+REVIEW_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('REVIEW_OUTBOX_MAX_ATTEMPTS', 20))
+
+
+# Watson Natural Language Understanding (review sentiment)
+# Credentials come from the NLU_API_KEY and NLU_URL environment variables
+
+NLU_VERSION = os.environ.get('NLU_VERSION', '2022-04-07')
+NLU_MAX_WORKERS = int(os.environ.get('NLU_MAX_WORKERS', 8))
+NLU_BATCH_TIMEOUT = float(os.environ.get('NLU_BATCH_TIMEOUT', 3.0))
+SENTIMENT_LRU_SIZE = int(os.environ.get('SENTIMENT_LRU_SIZE', 10000))
+SENTIMENT_CACHE_ALIAS = 'sentiment'
+
+
+# Opt-in caching of the rendered dealership index and dealer detail pages
+
+PAGE_CACHE_ENABLED = os.environ.get('PAGE_CACHE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+PAGE_CACHE_TIMEOUT = int(os.environ.get('PAGE_CACHE_TIMEOUT', 300))
+PAGE_CACHE_ALIAS = 'pages'
+
+# Each dealer's car models (with their makes) for the add-review form, kept in each process's memory.
+# Admin edits invalidate them in the process that made them; the other processes see them within
+# INVENTORY_CACHE_TIMEOUT seconds
+INVENTORY_CACHE_TIMEOUT = int(os.environ.get('INVENTORY_CACHE_TIMEOUT', 5))
+INVENTORY_CACHE_ALIAS = 'default'
+
+
+# The follow_changes command reads the _changes feed of the Cloudant (or CouchDB) databases behind the
+# microservices and invalidates the cached pages and dealer catalogs they affect. It authenticates with
+# IAM_API_KEY when set, or else with any credentials in COUCH_URL, and keeps its position in
+# CHANGES_CHECKPOINT_DIR. Each request waits up to CHANGES_POLL_TIMEOUT seconds for new changes.
+COUCH_URL = os.environ.get('COUCH_URL', 'http://localhost:5984')
+CHANGES_DATABASES = ('dealerships', 'reviews')
+CHANGES_CHECKPOINT_DIR = os.environ.get('CHANGES_CHECKPOINT_DIR', os.path.join(BASE_DIR, '.cache', 'changes'))
+CHANGES_POLL_TIMEOUT = float(os.environ.get('CHANGES_POLL_TIMEOUT', 30))
+CHANGES_BATCH_SIZE = int(os.environ.get('CHANGES_BATCH_SIZE', 500))
+
+
+# Request instrumentation: share of requests measured for Server-Timing and /metrics (0 turns it off)
+
+PERF_SAMPLE_RATE = float(os.environ.get('PERF_SAMPLE_RATE', 1.0 if DEBUG else 0.1))
+# /metrics answers staff users, and scrapers sending `Authorization: Bearer <METRICS_TOKEN>` when it is set
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+
+
+# Caches
+# https://docs.djangoproject.com/en/3.1/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Sentiment labels never change for a given text, so they are kept without expiry in a table shared
+    # by every worker (created by `manage.py createcachetable`); SENTIMENT_CACHE_BACKEND may name memcached
+    # or redis instead
+    SENTIMENT_CACHE_ALIAS: {
+        'BACKEND': os.environ.get('SENTIMENT_CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.environ.get('SENTIMENT_CACHE_LOCATION', 'djangoapp_sentiment_cache'),
+        'TIMEOUT': None,
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    # The generation counters must be shared so invalidations reach every worker: a table by default,
+    # or memcached or redis through PAGE_CACHE_BACKEND; LocMemCache only suits a single process
+    PAGE_CACHE_ALIAS: {
+        'BACKEND': os.environ.get('PAGE_CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.environ.get('PAGE_CACHE_LOCATION', 'djangoapp_page_cache'),
+    },
+}
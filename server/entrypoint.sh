@@ -10,8 +10,9 @@ done
 echo "PostgreSQL started"
 fi
 
-# Make migrations and migrate the database.
+# Make migrations, migrate the database and create the cache tables.
 echo "Making migrations and migrating the database. "
-python manage.py makemigrations main --noinput
+python manage.py makemigrations djangoapp --noinput
 python manage.py migrate --noinput
+python manage.py createcachetable
 exec "$@"
@@ -0,0 +1,20 @@
+"""gunicorn settings, read from the working directory when the server starts"""
+import os
+
+
+def on_starting(server):
+    # A per-process page cache would keep serving pages that another worker invalidated
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djangobackend.settings')
+    from django.conf import settings
+    backend = settings.CACHES[settings.PAGE_CACHE_ALIAS]['BACKEND']
+    if settings.PAGE_CACHE_ENABLED and backend.endswith('.LocMemCache') and server.cfg.workers > 1:
+        raise RuntimeError('PAGE_CACHE_ENABLED needs a shared PAGE_CACHE_BACKEND with several workers')
+
+
+def post_worker_init(worker):
+    # Each worker builds its own upstream clients and NLU token once, before taking requests
+    from djangoapp.restapis import warm_up_clients
+    warm_up_clients()
+    # and sends the reviews left in the outbox, by itself or by an earlier process
+    from djangoapp.outbox import outbox_worker
+    outbox_worker.wake()